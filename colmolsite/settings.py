@@ -62,6 +62,19 @@ DATABASES = {
 
 AUTH_PASSWORD_VALIDATORS = []
 
+# Cache dos resultados OCR (rececao.services.real_ocr_extract), partilhada entre processos
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'ocr': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.ocr_cache',
+        'TIMEOUT': 86400,
+        'OPTIONS': {'MAX_ENTRIES': 500},
+    },
+}
+
 LANGUAGE_CODE = 'pt-pt'
 TIME_ZONE = 'Europe/Lisbon'
 USE_I18N = True
@@ -73,3 +86,23 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Mensagens por página/linha do OCR e dos parsers (logger "rececao"): INFO por omissão,
+# DEBUG mostra cada linha de produto extraída, WARNING deixa só os problemas
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+    },
+    'loggers': {
+        'rececao': {
+            'handlers': ['console'],
+            'level': os.environ.get('RECECAO_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from rececao.models import InboundDocument
+from rececao.services import process_inbound
+
+
+class Command(BaseCommand):
+    help = 'Reprocessa documentos sem resultado ("Pendente"), ex: jobs perdidos num reinício do servidor'
+
+    def handle(self, *args, **options):
+        pendentes = InboundDocument.objects.filter(match_result__isnull=True).order_by('id')
+        total = pendentes.count()
+        self.stdout.write(f"📂 {total} documento(s) pendente(s)")
+
+        falhados = 0
+        for inbound in pendentes.iterator():
+            self.stdout.write(f"🔄 Documento {inbound.id}: {inbound.file.name}")
+            try:
+                process_inbound(inbound)
+            except Exception as e:
+                falhados += 1
+                self.stderr.write(f"❌ Documento {inbound.id}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"✅ {total - falhados} reprocessado(s), {falhados} com erro"))
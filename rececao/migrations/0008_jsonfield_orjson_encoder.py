@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-16 04:47
+
+import rececao.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rececao', '0007_alter_receiptline_po_number_extracted'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inbounddocument',
+            name='parsed_payload',
+            field=models.JSONField(blank=True, default=dict, encoder=rececao.models.OrjsonEncoder),
+        ),
+        migrations.AlterField(
+            model_name='matchresult',
+            name='summary',
+            field=models.JSONField(blank=True, default=dict, encoder=rececao.models.OrjsonEncoder),
+        ),
+    ]
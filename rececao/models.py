@@ -1,5 +1,32 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
+# JSON rápido (orjson), partilhado com services.py; sem ele fica o json da stdlib
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+
+class OrjsonEncoder(DjangoJSONEncoder):
+    """
+    Encoder dos JSONField com orjson (C); tipos não nativos passam pelo DjangoJSONEncoder.
+    Datas/horas também (OPT_PASSTHROUGH_DATETIME): o orjson escreve-as noutro formato
+    (microssegundos, "+00:00" em vez de "Z"), e o JSON guardado fica igual ao de antes.
+    """
+
+    def encode(self, o):
+        if ORJSON_AVAILABLE:
+            try:
+                return orjson.dumps(o, default=self.default,
+                                    option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode()
+            except TypeError:
+                pass  # ex.: inteiros > 64 bits → json da stdlib
+        return super().encode(o)
+
+
 class Supplier(models.Model):
     name = models.CharField(max_length=200, unique=True)
     email = models.EmailField(blank=True, null=True)
@@ -72,7 +99,7 @@ class InboundDocument(models.Model):
     number = models.CharField(max_length=120)
     file = models.FileField(upload_to='inbound/')
     received_at = models.DateTimeField(auto_now_add=True)
-    parsed_payload = models.JSONField(default=dict, blank=True)  # resultado do OCR/extração
+    parsed_payload = models.JSONField(default=dict, blank=True, encoder=OrjsonEncoder)  # resultado do OCR/extração
     po = models.ForeignKey(PurchaseOrder, on_delete=models.SET_NULL, null=True, blank=True, related_name='inbound_docs')
 
     def __str__(self):
@@ -91,7 +118,7 @@ class ReceiptLine(models.Model):
 class MatchResult(models.Model):
     inbound = models.OneToOneField(InboundDocument, on_delete=models.CASCADE, related_name='match_result')
     status = models.CharField(max_length=30, default='pending')  # matched / exceptions / pending
-    summary = models.JSONField(default=dict, blank=True)  # KPIs do matching (linhas OK, divergências, etc.)
+    summary = models.JSONField(default=dict, blank=True, encoder=OrjsonEncoder)  # KPIs do matching (linhas OK, divergências, etc.)
     certified_id = models.CharField(max_length=64, blank=True)  # hash/UUID da receção
 
 class ExceptionTask(models.Model):
@@ -0,0 +1,315 @@
+# rececao/parsers_pt.py
+"""
+Parsers de texto puro (sem ORM nem I/O) para faturas Elastron, guias Colmol
+e linhas de produto genéricas (código + dimensões + quantidade).
+
+Módulo isolado e totalmente anotado para poder ser compilado com mypyc
+(`mypyc rececao/parsers_pt.py`): a extensão gerada tem o mesmo nome e é
+importada em vez do .py; sem ela corre a versão interpretada.
+"""
+import logging
+import re
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Normalização de números (3 casas decimais = milhares) ---
+_NUM_SEM_ESPACOS = str.maketrans("", "", " ")
+_NUM_MILHARES = str.maketrans("", "", " ,")
+_NUM_DECIMAL = str.maketrans({",": ".", " ": None})
+
+def normalize_number(value_str: object) -> float:
+    """
+    Normaliza valores numéricos com vírgula, detectando formato de milhares vs decimais.
+    
+    Regras baseadas no NÚMERO DE DÍGITOS após a vírgula:
+    - 3 dígitos após vírgula → formato de milhares (remover vírgula)
+      Exemplos: "1,880" → 1880.0, "0,150" → 150.0, "2,000" → 2000.0, "125,000" → 125000.0
+    - 1-2 dígitos após vírgula → formato decimal (substituir vírgula por ponto)
+      Exemplos: "1,88" → 1.88, "2,5" → 2.5, "34,00" → 34.0
+    
+    Args:
+        value_str: String com número (pode ter vírgula)
+    
+    Returns:
+        float: Valor numérico convertido corretamente
+    """
+    if not value_str or not isinstance(value_str, str):
+        return 0.0
+    
+    # Cada caminho faz uma única passagem str.translate (remove espaços e trata a vírgula)
+    try:
+        # Se não tem vírgula, converter diretamente (float() já ignora espaços nas pontas)
+        if ',' not in value_str:
+            return float(value_str.translate(_NUM_SEM_ESPACOS))
+        
+        # Remover espaços (a contagem de dígitos decimais não pode incluir os das pontas)
+        value_str = value_str.strip()
+        
+        # Múltiplas vírgulas (formato inválido) ou exatamente 3 dígitos após a vírgula
+        # → formato de milhares: remover vírgula completamente ("1,880" → "1880")
+        inteiro, _, decimal_part = value_str.rpartition(',')
+        if ',' in inteiro or len(decimal_part) - decimal_part.count(' ') == 3:
+            return float(value_str.translate(_NUM_MILHARES))
+        
+        # Caso contrário (1-2 dígitos) → formato decimal normal: "2,5" → "2.5"
+        return float(value_str.translate(_NUM_DECIMAL))
+    except ValueError:
+        return 0.0
+
+
+# Fatura Elastron / Guia Colmol: uma regex multilinha percorre o texto todo (finditer)
+# e cada linha é partida em tokens pelo próprio motor de regex.
+# [^\S\n] = espaço sem mudar de linha; (?!\S) = fim do token
+_WS = r'[^\S\n]'
+_TOKEN_DECIMAL = r'\d+[.,]\d+(?!\S)'
+_UNIDADES = r'(?i:UN|MT|ML|M²|M2)'
+_TOKEN_UNIDADE = _UNIDADES + r'(?!\S)'
+
+# Linha de referência (ex: "1ORDE Nº ...") ou linha de artigo Elastron:
+# TOTAL VOL QUANT DESC ... UNIDADE PRECO IVA [LOTE] DESCRICAO (Tesseract), com >= 6 tokens
+# depois do artigo e a unidade (ML/MT/UN/M²) a partir do 4º token
+_RE_ELASTRON_ROW = re.compile(
+    rf'^{_WS}*(?:'
+    rf'(?P<ref>\d[A-Z]{{4}}{_WS}+[NnºN][^\n]*)'
+    rf'|(?P<artigo>E[O0]\d{{9,10}}){_WS}+'
+    rf'(?=\S+(?:{_WS}+\S+){{5}})'
+    rf'(?!{_TOKEN_UNIDADE})(?P<total>\S+){_WS}+'
+    rf'(?!{_TOKEN_UNIDADE})(?P<volume>\S+){_WS}+'
+    rf'(?!{_TOKEN_UNIDADE})(?P<quantidade>\S+){_WS}+'
+    rf'(?:(?!{_TOKEN_UNIDADE})(?P<desconto>\S+){_WS}+)?'
+    rf'(?:(?!{_TOKEN_UNIDADE})\S+{_WS}+)*'
+    rf'(?P<unidade>{_TOKEN_UNIDADE})'
+    rf'(?:{_WS}+(?P<preco>\S+)(?:{_WS}+(?P<iva>\S+)(?P<resto>(?:{_WS}+\S+)*))?)?'
+    rf')', re.MULTILINE)
+_RE_ELASTRON_LOTE = re.compile(r'(\d{4}-\d+(?:#)?)')
+
+# Cabeçalho "ENCOMENDA Nº ... REQUISICAO Nº ..." ou linha de produto Colmol:
+# CODIGO (>= 10 alfanuméricos, >= 8 tokens) DESCRICAO... [CX.dims] ... QTD UNID MED1 MED2 MED3 PESO IVA
+# A descrição pára no 1º decimal, unidade ou token CX.<n> (incluído na descrição)
+_RE_COLMOL_ROW = re.compile(
+    rf'^{_WS}*(?:'
+    rf'(?=[^\n]*ENCOMENDA Nº)(?P<header>[^\n]*)'
+    rf'|(?P<codigo>(?=[A-Z0-9]{{10}})\S+)(?=(?:{_WS}+\S+){{7}})'
+    rf'(?P<descricao>(?:{_WS}+(?!{_TOKEN_DECIMAL}|{_TOKEN_UNIDADE}|(?i:CX\.)\d)\S+)*'
+    rf'(?:{_WS}+(?i:CX\.)\d\S*)?)'
+    rf'(?:{_WS}+(?!{_TOKEN_DECIMAL})\S+)*'
+    rf'(?:{_WS}+(?P<quantidade>{_TOKEN_DECIMAL})'
+    rf'(?:{_WS}+(?P<unidade>\S+)(?:{_WS}+(?P<med1>\S+)(?:{_WS}+(?P<med2>\S+)'
+    rf'(?:{_WS}+(?P<med3>\S+)(?:{_WS}+(?P<peso>\S+)(?:{_WS}+(?P<iva>\S+))?)?)?)?)?)?)?'
+    rf')', re.MULTILINE)
+_RE_COLMOL_ENC = re.compile(r'ENCOMENDA Nº\.?\s*(\d+-\d+)')
+_RE_COLMOL_REQ = re.compile(r'REQUISICAO Nº\.?\s*(\d+)')
+
+
+def parse_fatura_elastron(text: str) -> list[dict]:
+    """Parser específico para faturas Elastron (compatível com Tesseract)."""
+    produtos: list[dict] = []
+    
+    current_ref = ""
+    for m in _RE_ELASTRON_ROW.finditer(text):
+        if m.group("ref"):
+            current_ref = m.group("ref").strip()
+            continue
+        
+        try:
+            artigo = m.group("artigo").replace('O', '0')
+            
+            # Campos antes da unidade: TOTAL VOL QUANT DESC
+            total = normalize_number(m.group("total"))
+            volume_str = m.group("volume")
+            volume = int(volume_str) if volume_str.isdigit() else 1
+            quantidade = normalize_number(m.group("quantidade"))
+            # Sem desconto, o 4º campo é a própria unidade
+            desconto = normalize_number(m.group("desconto") or m.group("unidade"))
+            unidade = m.group("unidade").upper()
+            
+            # Campos depois da unidade: PRECO IVA LOTE ... DESCRICAO
+            preco_un = normalize_number(m.group("preco")) if m.group("preco") else 0.0
+            iva = normalize_number(m.group("iva")) if m.group("iva") else 23.0
+            
+            # Lote e descrição
+            lote = ""
+            descricao = ""
+            if m.group("resto"):
+                remaining = ' '.join(m.group("resto").split())
+                lote_match = _RE_ELASTRON_LOTE.search(remaining)
+                if lote_match:
+                    lote = lote_match.group(1)
+                    descricao = remaining[lote_match.end():].strip()
+                else:
+                    descricao = remaining
+            
+            produtos.append({
+                "referencia_ordem": current_ref,
+                "artigo": artigo,
+                "descricao": descricao,
+                "lote_producao": lote,
+                "quantidade": quantidade,
+                "unidade": unidade,
+                "volume": volume,
+                "preco_unitario": preco_un,
+                "desconto": desconto,
+                "iva": iva,
+                "total": total
+            })
+        except (ValueError, IndexError) as e:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("⚠️ Erro ao parsear linha Elastron '%s': %s", m.group(0).strip()[:60], e)
+            continue
+    
+    return produtos
+
+
+def parse_guia_colmol(text: str) -> list[dict]:
+    """Parser específico para Guias de Remessa Colmol."""
+    produtos: list[dict] = []
+    
+    current_encomenda = ""
+    current_requisicao = ""
+    
+    for m in _RE_COLMOL_ROW.finditer(text):
+        header = m.group("header")
+        if header is not None:
+            encomenda_match = _RE_COLMOL_ENC.search(header)
+            requisicao_match = _RE_COLMOL_REQ.search(header)
+            if encomenda_match:
+                current_encomenda = encomenda_match.group(1)
+            if requisicao_match:
+                current_requisicao = requisicao_match.group(1)
+            continue
+        
+        # Sem quantidade (decimal) na linha, os campos seguintes ficam nos valores por omissão
+        # (normalize_number já devolve 0.0 para um grupo vazio/None)
+        quantidade, unidade, med1, med2, med3, peso, iva = m.group(
+            "quantidade", "unidade", "med1", "med2", "med3", "peso", "iva")
+        
+        produtos.append({
+            "referencia_ordem": f"{current_encomenda} / Req {current_requisicao}",
+            "artigo": m.group("codigo"),
+            "descricao": ' '.join(m.group("descricao").split()),
+            "lote_producao": "",
+            "quantidade": normalize_number(quantidade),
+            "unidade": unidade if unidade else "UN",
+            "volume": 0,
+            "dimensoes": f"{normalize_number(med1)}x{normalize_number(med2)}x{normalize_number(med3)}",
+            "peso": normalize_number(peso),
+            "iva": normalize_number(iva) if iva else 23.0,
+            "total": 0.0
+        })
+    
+    return produtos
+
+
+# Linhas de produto (extract_product_lines): código, dimensões LxC[xE] e quantidade no fim
+_PL_CODE = r"(?P<code>(?:[A-Z]{1}[A-Z0-9\-\/\.]{2,}))"  # BLC-D25-200x300, REF-123, etc.
+_PL_SEP = r"[xX×\- ]"  # separadores
+_PL_DIM = rf"(?P<dim>(\d{{2,4}}){_PL_SEP}(\d{{2,4}})(?:{_PL_SEP}(\d{{2,4}}))?)"
+_PL_QTY = r"(?P<qty>\d+(?:[.,]\d+)?)\s*(?:un|uni|unid|unidades)?$"
+_RE_PL_LINE = re.compile(rf"(?i)^(?=.*{_PL_CODE})(?=.*{_PL_DIM}).*{_PL_QTY}")
+# Fallback (ordem trocada): código e dimensões sensíveis a maiúsculas, quantidade não
+_RE_PL_CODE = re.compile(_PL_CODE)
+_RE_PL_DIM = re.compile(_PL_DIM)
+_RE_PL_QTY = re.compile(_PL_QTY, re.IGNORECASE)
+_RE_PL_DIM_SEP = re.compile(_PL_SEP)
+_RE_PL_DENS = re.compile(r"(D\d{2})", re.IGNORECASE)  # D23, D30, etc.
+# A quantidade (com unidade opcional) fecha a linha nos dois caminhos: a linha só pode
+# terminar num dígito ou na última letra de un/uni/unid/unidades (ı/İ/ſ: equivalentes
+# Unicode de i/s com IGNORECASE)
+_PL_FIM_UNIDADE = frozenset("nNiIıİdDsSſ")
+
+
+def extract_product_lines(text: str, lines: Optional[list[str]] = None) -> list[dict]:
+    """Extrai linhas de produto com regex tolerante a formatos reais."""
+    products: list[dict] = []
+    if lines is None:
+        lines = text.split("\n")
+
+    for raw in lines:
+        # Dimensões são obrigatórias nos dois caminhos: uma pesquisa linear (sem lookaheads
+        # nem .* com backtracking) descarta a maioria das linhas antes da regex completa.
+        # Corre na linha original: o match tem >= 5 caracteres e nunca inclui os espaços das
+        # pontas, o que dispensa o len(line) < 5 e deixa o strip só para as linhas candidatas
+        dim_m = _RE_PL_DIM.search(raw)
+        if not dim_m:
+            continue
+        line = raw.strip()
+        # Teste de tempo constante no último carácter antes das regex com lookaheads
+        last = line[-1]
+        if not last.isdecimal() and last not in _PL_FIM_UNIDADE:
+            continue
+
+        m = _RE_PL_LINE.search(line)
+        if not m:
+            # Fallback: ordem trocada; procurar blocos na linha
+            code_m = _RE_PL_CODE.search(line)
+            qty_m = _RE_PL_QTY.search(line)
+            if not (code_m and qty_m and dim_m):
+                continue
+            m_code = code_m.group("code")
+            m_qty = qty_m.group("qty")
+            m_dim = dim_m.group("dim")
+        else:
+            m_code = m.group("code")
+            m_qty = m.group("qty")
+            m_dim = m.group("dim")
+        dims_nums = _RE_PL_DIM_SEP.split(m_dim)
+
+        # quantidade
+        try:
+            qty = float(m_qty.replace(",", "."))
+        except Exception:
+            qty = 0.0
+
+        # dimensões
+        larg = comp = esp = 0
+        try:
+            if len(dims_nums) >= 2:
+                larg = int(dims_nums[0])
+                comp = int(dims_nums[1])
+                if len(dims_nums) >= 3 and dims_nums[2].isdigit():
+                    esp = int(dims_nums[2])
+        except Exception:
+            pass
+
+        produto = {
+            "codigo_fornecedor": m_code.upper(),
+            "descricao": line,
+            "linha_raw": raw,
+            "dimensoes": {
+                "comprimento": comp,
+                "largura": larg,
+                "espessura": esp
+            },
+            "quantidade": qty,
+            "unidade": "UNI",
+            "mini_codigo": "",  # calculado já de seguida
+        }
+        produto["mini_codigo"] = generate_mini_codigo(produto)
+        products.append(produto)
+
+    return products
+
+
+def generate_mini_codigo(linha: dict) -> str:
+    """Gera Mini Código tolerante a dados parciais (usa densidade se existir)."""
+    dims = linha.get("dimensoes", {})
+    codigo = linha.get("codigo_fornecedor", "")
+
+    comp = dims.get("comprimento", 0)
+    larg = dims.get("largura", 0)
+    esp = dims.get("espessura", 0)
+
+    if larg and comp and esp:
+        core = f"{larg}x{comp}x{esp}"
+    elif larg and comp:
+        core = f"{larg}x{comp}"
+    else:
+        return codigo
+
+    # Densidade só interessa com dimensões; sem "D"/"d" no código nem corre a regex
+    if "D" in codigo or "d" in codigo:
+        dens_m = _RE_PL_DENS.search(codigo)
+        if dens_m:
+            return f"{dens_m.group(1).upper()}-{core}"
+    return core
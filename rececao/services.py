@@ -1,104 +1,213 @@
 # rececao/services.py
 import hashlib
 import json
+import logging
+import multiprocessing
 import os
 import re
 import base64
 from io import BytesIO
 from PIL import Image
+import numpy as np
 import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import importlib.util
+from itertools import chain
 from decimal import Decimal
+from functools import lru_cache
+from types import MappingProxyType
 
 import PyPDF2
 import pytesseract
-from pdf2image import convert_from_path
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
 
 from django.conf import settings
-from django.http import HttpResponse
-from django.db import transaction
+from django.core.cache import caches
+from django.http import FileResponse
+from django.db import transaction, close_old_connections
+from django.db.models import Prefetch
 
+from .parsers_pt import (normalize_number, parse_fatura_elastron, parse_guia_colmol,
+                         extract_product_lines)
 from .models import (InboundDocument, ReceiptLine, CodeMapping, MatchResult,
-                     ExceptionTask, POLine, PurchaseOrder)
+                     ExceptionTask, POLine, PurchaseOrder, ORJSON_AVAILABLE, orjson)
+
+# Mensagens por página (OCR) e por linha (parsers) vão para o logging, não para print():
+# nada é formatado nem escrito quando o nível está desligado (RECECAO_LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
+# --- QR code detection (pyzbar/libzbar, fallback OpenCV) ---
+try:
+    from pyzbar.pyzbar import decode as zbar_decode, ZBarSymbol
+    PYZBAR_AVAILABLE = True
+    logger.info("✅ QR code detection disponível (pyzbar)")
+except ImportError:
+    PYZBAR_AVAILABLE = False
 
-# --- QR code detection (usando OpenCV) ---
 try:
     import cv2
-    import numpy as np
+    CV2_AVAILABLE = True
     QR_CODE_ENABLED = True
-    print("✅ QR code detection disponível (OpenCV)")
+    # Caminhos SIMD (AVX2/NEON, escolhidos em runtime pelos wheels) ligados. Threads internas
+    # do OpenCV: 1 por omissão, como o OMP_THREAD_LIMIT do Tesseract - as páginas já correm
+    # em paralelo nos pools (um processo/thread por core)
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(int(os.environ.get("OPENCV_THREADS", "1")))
+    logger.info("✅ QR code detection disponível (OpenCV)")
 except ImportError:
-    QR_CODE_ENABLED = False
-    print("⚠️ QR code não disponível (instale opencv-python para ativar)")
+    CV2_AVAILABLE = False
+    QR_CODE_ENABLED = PYZBAR_AVAILABLE
+    if not QR_CODE_ENABLED:
+        logger.warning("⚠️ QR code não disponível (instale pyzbar ou opencv-python para ativar)")
 
-# Se precisares especificar o caminho do tesseract no Windows:
-# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+# --- JSON rápido (orjson, via models) para respostas das APIs e extracao.json, fallback json da stdlib ---
 
-# --- Normalização de números (3 casas decimais = milhares) ---
-def normalize_number(value_str: str) -> float:
-    """
-    Normaliza valores numéricos com vírgula, detectando formato de milhares vs decimais.
-    
-    Regras baseadas no NÚMERO DE DÍGITOS após a vírgula:
-    - 3 dígitos após vírgula → formato de milhares (remover vírgula)
-      Exemplos: "1,880" → 1880.0, "0,150" → 150.0, "2,000" → 2000.0, "125,000" → 125000.0
-    - 1-2 dígitos após vírgula → formato decimal (substituir vírgula por ponto)
-      Exemplos: "1,88" → 1.88, "2,5" → 2.5, "34,00" → 34.0
-    
-    Args:
-        value_str: String com número (pode ter vírgula)
-    
-    Returns:
-        float: Valor numérico convertido corretamente
-    """
-    if not value_str or not isinstance(value_str, str):
-        return 0.0
-    
-    # Remover espaços
-    value_str = value_str.strip()
-    
-    # Se não tem vírgula, converter diretamente
-    if ',' not in value_str:
-        try:
-            return float(value_str.replace(' ', ''))
-        except ValueError:
-            return 0.0
-    
-    # Detectar quantas casas decimais após a vírgula
-    parts = value_str.split(',')
-    if len(parts) != 2:
-        # Múltiplas vírgulas ou formato inválido
-        try:
-            return float(value_str.replace(',', '').replace(' ', ''))
-        except ValueError:
-            return 0.0
-    
-    integer_part = parts[0].replace(' ', '')
-    decimal_part = parts[1].replace(' ', '')
-    
-    # Se tem exatamente 3 dígitos após vírgula → formato de milhares
-    # Remover vírgula completamente: "1,880" → "1880", "2,000" → "2000"
-    if len(decimal_part) == 3:
+
+def _json_loads(data):
+    """json.loads via orjson (aceita str ou bytes); os erros continuam a ser json.JSONDecodeError."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps_bytes(data) -> bytes:
+    """JSON compacto em UTF-8 (sem escapes ASCII); json da stdlib se o orjson não conseguir."""
+    if ORJSON_AVAILABLE:
         try:
-            return float(integer_part + decimal_part)
-        except ValueError:
-            return 0.0
-    
-    # Caso contrário (1-2 dígitos) → formato decimal normal
-    # Substituir vírgula por ponto: "2,5" → "2.5"
-    try:
-        return float(f"{integer_part}.{decimal_part}")
-    except ValueError:
-        return 0.0
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass  # ex.: inteiros > 64 bits
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# --- Hash rápido para a chave da cache OCR (opcional, fallback sha256) ---
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    XXHASH_AVAILABLE = False
+
+# Módulos pesados e só usados em alguns caminhos (export, PyMuPDF, tabelas, fuzzy) não são
+# importados no arranque do worker: a disponibilidade vem do find_spec (sem importar) e o
+# import é feito dentro da função que os usa.
+
+# --- Export Excel: xlsxwriter (mais rápido) com fallback para openpyxl ---
+XLSXWRITER_AVAILABLE = importlib.util.find_spec("xlsxwriter") is not None
+
+# --- Renderização de PDF em processo (PyMuPDF) e Tesseract sem subprocesso (tesserocr) ---
+PYMUPDF_AVAILABLE = importlib.util.find_spec("pymupdf") is not None
+# pypdfium2 (PDFium): fallback de texto embutido quando o PyPDF2 falha e não há PyMuPDF
+PYPDFIUM2_AVAILABLE = importlib.util.find_spec("pypdfium2") is not None
+
+try:
+    from tesserocr import PyTessBaseAPI, PSM
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+# Cada página corre num processo próprio (ProcessPoolExecutor): limitar o Tesseract
+# a 1 thread OpenMP por processo evita oversubscription dos cores.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Se precisares especificar o caminho do tesseract no Windows:
+# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
 # --- OCR.space API (Level 0 - Cloud OCR com 25k req/mês grátis) ---
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     OCR_SPACE_AVAILABLE = True
 except ImportError:
     OCR_SPACE_AVAILABLE = False
 
+# --- Upload multipart em streaming para o OCR.space (opcional) ---
+# O requests monta o corpo multipart inteiro em memória; o MultipartEncoder lê o ficheiro
+# do disco em blocos durante o envio.
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+    TOOLBELT_AVAILABLE = True
+except ImportError:
+    TOOLBELT_AVAILABLE = False
+
+
+def _http_session(status_forcelist):
+    """
+    Sessão HTTP partilhada (keep-alive: sem novo handshake TCP+TLS por documento).
+    Repete até 3x com backoff exponencial em erros de ligação e nos status indicados;
+    timeouts de leitura não são repetidos (o pedido pode já estar a ser processado).
+    """
+    retry = Retry(total=3, read=0, backoff_factor=0.5,
+                  status_forcelist=status_forcelist,
+                  allowed_methods=None,  # inclui POST
+                  raise_on_status=False)  # esgotadas as tentativas devolve a última resposta
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_OCRSPACE_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+if OCR_SPACE_AVAILABLE:
+    _OCRSPACE_SESSION = _http_session(_OCRSPACE_RETRY_STATUS)
+    # Corpo em streaming não pode ser reenviado pelo urllib3: esta sessão só repete erros
+    # de ligação e os status são repetidos em _ocrspace_post com um encoder novo
+    _OCRSPACE_STREAM_SESSION = _http_session(())
+    # 429 do Groq não é repetido na mesma chave: passa logo à chave seguinte
+    _GROQ_SESSION = _http_session((500, 502, 503, 504))
+    _OLLAMA_SESSION = _http_session((500, 502, 503, 504))
+
+# Limite de pedidos ao OCR.space partilhado por todas as threads (quota da API);
+# OCR_SPACE_RATE=0 desativa o limite
+OCR_SPACE_RATE = float(os.environ.get("OCR_SPACE_RATE", "25"))
+_ocrspace_rate_lock = threading.Lock()
+_ocrspace_next_slot = 0.0
+
+
+def _ocrspace_rate_wait():
+    """Espera pela próxima vaga de pedido ao OCR.space (intervalo mínimo 1/OCR_SPACE_RATE)."""
+    global _ocrspace_next_slot
+    if OCR_SPACE_RATE <= 0:
+        return
+    with _ocrspace_rate_lock:
+        now = time.monotonic()
+        slot = max(now, _ocrspace_next_slot)
+        _ocrspace_next_slot = slot + 1.0 / OCR_SPACE_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def _ocrspace_post(url: str, data: dict, file_path: str, timeout: int = 30):
+    """
+    POST multipart ao OCR.space. Com requests-toolbelt o ficheiro é enviado em streaming
+    (memória O(bloco) em vez de O(ficheiro)); 429/5xx repetidos até 3x com backoff.
+    """
+    if not TOOLBELT_AVAILABLE:
+        with open(file_path, 'rb') as f:
+            return _OCRSPACE_SESSION.post(url, files={'file': f}, data=data, timeout=timeout)
+
+    fields = {k: str(v) for k, v in data.items()}
+    for attempt in range(4):
+        with open(file_path, 'rb') as f:
+            encoder = MultipartEncoder(fields={**fields, 'file': (os.path.basename(file_path), f)})
+            response = _OCRSPACE_STREAM_SESSION.post(
+                url, data=encoder, headers={'Content-Type': encoder.content_type}, timeout=timeout)
+        if response.status_code not in _OCRSPACE_RETRY_STATUS or attempt == 3:
+            return response
+        time.sleep(0.5 * 2 ** attempt)
+
+
+# Mapeamento de idiomas do OCR.space (por=português, spa=espanhol, fre=francês)
+_OCRSPACE_LANG_MAP = MappingProxyType({
+    'por': 'por', 'pt': 'por', 'es': 'spa', 'spa': 'spa', 'fr': 'fre', 'fre': 'fre', 'en': 'eng',
+})
+
+
 def ocr_space_api(file_path: str, language='por'):
     """
     OCR.space API - Level 0 (prioridade máxima)
@@ -112,94 +221,96 @@ def ocr_space_api(file_path: str, language='por'):
     
     api_key = os.environ.get('OCR_SPACE_API_KEY')
     if not api_key:
-        print("⚠️ OCR_SPACE_API_KEY não encontrada - usando engines locais")
+        logger.warning("⚠️ OCR_SPACE_API_KEY não encontrada - usando engines locais")
         return None
     
     try:
         url = 'https://api.ocr.space/parse/image'
         
-        # Mapeamento de idiomas (por=português, spa=espanhol, fre=francês)
-        lang_map = {'por': 'por', 'pt': 'por', 'es': 'spa', 'spa': 'spa', 'fr': 'fre', 'fre': 'fre', 'en': 'eng'}
-        ocr_language = lang_map.get(language.lower(), 'por')
+        ocr_language = _OCRSPACE_LANG_MAP.get(language.lower(), 'por')
         
-        with open(file_path, 'rb') as f:
-            payload = {
-                'apikey': api_key,
-                'language': ocr_language,
-                'isOverlayRequired': False,
-                'detectOrientation': True,
-                'scale': True,
-                'OCREngine': 2,  # Engine 2 é mais preciso para tabelas
-                'isTable': True  # Detecção de tabelas ativada
-            }
+        payload = {
+            'apikey': api_key,
+            'language': ocr_language,
+            'isOverlayRequired': False,
+            'detectOrientation': True,
+            'scale': True,
+            'OCREngine': 2,  # Engine 2 é mais preciso para tabelas
+            'isTable': True  # Detecção de tabelas ativada
+        }
+        
+        _ocrspace_rate_wait()
+        response = _ocrspace_post(url, payload, file_path, timeout=30)
+        
+        if response.status_code == 200:
+            result = _json_loads(response.content)
             
-            response = requests.post(url, files={'file': f}, data=payload, timeout=30)
+            if result.get('IsErroredOnProcessing'):
+                logger.warning("⚠️ OCR.space error: %s", result.get('ErrorMessage', 'Unknown error'))
+                return None
             
-            if response.status_code == 200:
-                result = response.json()
-                
-                if result.get('IsErroredOnProcessing'):
-                    print(f"⚠️ OCR.space error: {result.get('ErrorMessage', 'Unknown error')}")
-                    return None
-                
-                # Extrai texto de todas as páginas
-                text_parts = []
-                if result.get('ParsedResults'):
-                    for page in result['ParsedResults']:
-                        page_text = page.get('ParsedText', '')
-                        if page_text:
-                            text_parts.append(page_text)
-                
-                full_text = '\n'.join(text_parts)
-                
-                if full_text.strip():
-                    print(f"✅ OCR.space (API): {len(full_text)} chars extraídos")
-                    return full_text
-                else:
-                    print("⚠️ OCR.space retornou texto vazio - fallback para engines locais")
-                    return None
+            # Extrai texto de todas as páginas
+            text_parts = []
+            if result.get('ParsedResults'):
+                for page in result['ParsedResults']:
+                    page_text = page.get('ParsedText', '')
+                    if page_text:
+                        text_parts.append(page_text)
+            
+            full_text = '\n'.join(text_parts)
+            
+            if full_text.strip():
+                logger.info("✅ OCR.space (API): %d chars extraídos", len(full_text))
+                return full_text
             else:
-                print(f"⚠️ OCR.space HTTP {response.status_code} - fallback para engines locais")
+                logger.warning("⚠️ OCR.space retornou texto vazio - fallback para engines locais")
                 return None
-                
+        else:
+            logger.warning("⚠️ OCR.space HTTP %s - fallback para engines locais", response.status_code)
+            return None
+            
     except requests.Timeout:
-        print("⚠️ OCR.space timeout (30s) - fallback para engines locais")
+        logger.warning("⚠️ OCR.space timeout (30s) - fallback para engines locais")
         return None
     except Exception as e:
-        print(f"⚠️ OCR.space exception: {e} - fallback para engines locais")
+        logger.warning("⚠️ OCR.space exception: %s - fallback para engines locais", e)
         return None
 
-# --- Imports opcionais para extração universal ---
-try:
-    import pdfplumber
-    PDFPLUMBER_AVAILABLE = True
-except ImportError:
-    PDFPLUMBER_AVAILABLE = False
+# --- Imports opcionais para extração universal (importados só quando usados) ---
+PDFPLUMBER_AVAILABLE = importlib.util.find_spec("pdfplumber") is not None
+CAMELOT_AVAILABLE = importlib.util.find_spec("camelot") is not None
+RAPIDFUZZ_AVAILABLE = importlib.util.find_spec("rapidfuzz") is not None
 
-try:
-    import camelot
-    CAMELOT_AVAILABLE = True
-except ImportError:
-    CAMELOT_AVAILABLE = False
+# --- LLM para Document Extraction (Groq + Ollama) ---
 
-try:
-    from rapidfuzz import fuzz, process
-    RAPIDFUZZ_AVAILABLE = True
-except ImportError:
-    RAPIDFUZZ_AVAILABLE = False
+# Resposta do Groq em streaming (SSE); GROQ_STREAM=0 desativa. Se a API recusar streaming
+# com response_format JSON (HTTP 400), só esse pedido é repetido sem streaming.
+GROQ_STREAM = os.environ.get("GROQ_STREAM", "1") != "0"
 
-# --- LLM para Document Extraction (Groq + Ollama) ---
 
-def groq_extract_document(file_path: str, ocr_text: str, api_key: str, key_name: str = "GROQ_API_KEY"):
-    """
-    Groq LLM Document Extractor (gratuito, sem instalação)
-    Usa Llama-3.3-70B para extrair dados estruturados
-    
-    Returns:
-        tuple: (extracted_data, status_code) ou (None, status_code) se falhar
-    """
-    try:
-        system_prompt = """You are a document extraction expert. Extract ALL product data from invoices, delivery notes, and purchase orders in Portuguese, Spanish, or French.
+def _groq_stream_content(response) -> str:
+    """Junta o conteúdo de uma resposta em streaming (linhas SSE 'data: {...}' até [DONE])."""
+    parts = []
+    # Bytes por linha e decode UTF-8 explícito (text/event-stream pode vir sem charset)
+    for raw_line in response.iter_lines():
+        line = raw_line.decode("utf-8")
+        if not line.startswith("data: "):
+            continue
+        data = line[6:]
+        if data == "[DONE]":
+            break
+        chunk = _json_loads(data)
+        if chunk.get("error"):
+            raise ValueError(chunk["error"])
+        for choice in chunk.get("choices", []):
+            content = choice.get("delta", {}).get("content")
+            if content:
+                parts.append(content)
+    return "".join(parts)
+
+
+# Prompt de sistema do Groq (estático, construído uma vez no carregamento do módulo)
+_GROQ_SYSTEM_PROMPT = """You are a document extraction expert. Extract ALL product data from invoices, delivery notes, and purchase orders in Portuguese, Spanish, or French.
 
 CRITICAL: Extract EVERY product line, even if incomplete or malformed.
 
@@ -281,103 +392,78 @@ Rules:
 - First number before unit = quantity (always)
 - IMPORTANT: If document has multiple PO numbers (Encomenda nr, Pedido nr, etc), extract the PO number for EACH product"""
 
+
+GROQ_MODEL = "llama-3.3-70b-versatile"
+
+
+def groq_extract_document(file_path: str, ocr_text: str, api_key: str, key_name: str = "GROQ_API_KEY",
+                          stream: bool = GROQ_STREAM):
+    """
+    Groq LLM Document Extractor (gratuito, sem instalação)
+    Usa Llama-3.3-70B para extrair dados estruturados
+    
+    Returns:
+        tuple: (extracted_data, status_code) ou (None, status_code) se falhar
+    """
+    try:
         user_prompt = f"""Extract ALL products from this document (PT/ES/FR):
 
 {ocr_text[:3000] if ocr_text else "No OCR text"}
 
 Return complete JSON with ALL products."""
 
-        response = requests.post(
+        request_body = {
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": _GROQ_SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": 0.1,
+            "max_tokens": 4000,
+            "response_format": {"type": "json_object"},
+            "stream": stream
+        }
+        # Em streaming o timeout de 30s conta entre blocos (não para a resposta inteira)
+        # e a ligação é devolvida ao pool no fim do with
+        with _GROQ_SESSION.post(
             "https://api.groq.com/openai/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
             },
-            json={
-                "model": "llama-3.3-70b-versatile",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "temperature": 0.1,
-                "max_tokens": 4000,
-                "response_format": {"type": "json_object"}
-            },
-            timeout=30
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            content = result['choices'][0]['message']['content']
+            json=request_body,
+            timeout=30,
+            stream=stream
+        ) as response:
+            if response.status_code == 400 and stream:
+                # Modelo/conta sem streaming em modo JSON → repetir este pedido sem streaming
+                print(f"⚠️ Groq sem streaming ({response.text[:200]}) - a usar resposta completa")
+                return groq_extract_document(file_path, ocr_text, api_key, key_name, stream=False)
             
-            extracted_data = json.loads(content)
-            produtos_count = len(extracted_data.get('produtos', []))
-            print(f"✅ Groq LLM ({key_name}): {produtos_count} produtos extraídos")
-            return extracted_data, 200
-        else:
-            print(f"⚠️ Groq HTTP {response.status_code} ({key_name})")
-            return None, response.status_code
+            if response.status_code == 200:
+                if stream:
+                    content = _groq_stream_content(response)
+                else:
+                    content = _json_loads(response.content)['choices'][0]['message']['content']
+                
+                extracted_data = _json_loads(content)
+                produtos_count = len(extracted_data.get('produtos', []))
+                print(f"✅ Groq LLM ({key_name}): {produtos_count} produtos extraídos")
+                return extracted_data, 200
+            else:
+                print(f"⚠️ Groq HTTP {response.status_code} ({key_name})")
+                return None, response.status_code
             
     except Exception as e:
         print(f"⚠️ Groq exception ({key_name}): {e}")
         return None, 500
 
-def ollama_extract_document(file_path: str, ocr_text: str = None):
-    """
-    LLM Document Extractor - Level -1 (pós-processador inteligente)
-    
-    Usa LLM (Groq/Ollama) para extrair dados estruturados de documentos.
-    Combina texto OCR com prompt engineering.
-    
-    Args:
-        file_path: Caminho do PDF/imagem
-        ocr_text: Texto já extraído por OCR (opcional, melhora resultados)
-    
-    Returns:
-        dict com metadados + produtos ou None se falhar
-    """
-    # Verificar se requests está disponível
-    if not OCR_SPACE_AVAILABLE:
-        print("⚠️ requests não disponível - LLM desabilitado")
-        return None
-    
-    # Tentar Groq primeiro com chave primária
-    groq_key = os.environ.get('GROQ_API_KEY')
-    if groq_key:
-        print("🔑 Tentando Groq com chave primária (GROQ_API_KEY)...")
-        groq_result, status_code = groq_extract_document(file_path, ocr_text, groq_key, "GROQ_API_KEY")
-        
-        # Se sucesso, retornar resultado
-        if groq_result and groq_result.get('produtos'):
-            return groq_result
-        
-        # Se erro 429 (rate limit), tentar segunda chave
-        if status_code == 429:
-            groq_key_2 = os.environ.get('GROQ_API_KEY_2')
-            if groq_key_2:
-                print("🔄 Rate limit na chave primária - tentando chave secundária (GROQ_API_KEY_2)...")
-                groq_result_2, status_code_2 = groq_extract_document(file_path, ocr_text, groq_key_2, "GROQ_API_KEY_2")
-                
-                if groq_result_2 and groq_result_2.get('produtos'):
-                    return groq_result_2
-                
-                print(f"⚠️ Groq chave secundária também falhou (status {status_code_2})")
-            else:
-                print("⚠️ GROQ_API_KEY_2 não configurada - sem fallback disponível")
-        
-        print("⚠️ Groq falhou ou sem produtos - tentando Ollama fallback")
-    
-    # Fallback: Ollama (se configurado)
-    ollama_url = os.environ.get('OLLAMA_API_URL')
-    ollama_model = os.environ.get('OLLAMA_MODEL', 'llama3.2-vision')
-    
-    if not ollama_url:
-        print("⚠️ Nenhum LLM configurado ou todos falharam")
-        return None
-    
-    try:
-        # Prompt melhorado com exemplos concretos PT/ES/FR
-        system_prompt = """You are a document extraction expert. Extract ALL product data from invoices, delivery notes, and purchase orders in Portuguese, Spanish, or French.
+# Chaves Groq por ordem de uso (a seguinte só é usada em rate limit da anterior)
+GROQ_KEY_NAMES = ("GROQ_API_KEY", "GROQ_API_KEY_2")
+
+
+# Prompt de sistema do Ollama, com exemplos concretos PT/ES/FR
+_OLLAMA_SYSTEM_PROMPT = """You are a document extraction expert. Extract ALL product data from invoices, delivery notes, and purchase orders in Portuguese, Spanish, or French.
 
 CRITICAL: Extract EVERY product line, even if incomplete or malformed.
 
@@ -452,6 +538,85 @@ Rules:
 - IMPORTANT: If document has multiple PO numbers (Encomenda nr, Pedido nr, etc), extract the PO number for EACH product
 - Return ONLY the JSON, no markdown, no explanations"""
 
+
+# Páginas maiores (PDFs com MediaBox acima de A4) são reduzidas antes de ir para o Ollama vision
+OLLAMA_VISION_MAX_PIXELS = 6_000_000
+OLLAMA_VISION_MAX_SIZE = (2000, 2800)
+
+
+def ollama_extract_document(file_path: str, ocr_text: str = None):
+    """
+    Extração LLM com cache: o mesmo ficheiro com o mesmo texto OCR, modelos e prompts
+    devolve o resultado anterior sem novo pedido ao Groq/Ollama. Só resultados com
+    produtos são guardados (falhas e rate limits voltam a ser tentados).
+    """
+    llm_cache = caches[OCR_CACHE_ALIAS]
+    ollama_model = os.environ.get('OLLAMA_MODEL', 'llama3.2-vision')
+    try:
+        cache_key = (f"llm:v{LLM_CACHE_VERSION}:{GROQ_MODEL}:{ollama_model}:"
+                     f"{_file_digest(file_path)}:{_text_digest(ocr_text)}")
+    except OSError:
+        cache_key = None
+    if cache_key:
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            print(f"⚡ Resultado LLM em cache para {os.path.basename(file_path)}")
+            return cached
+
+    result = _llm_extract_document(file_path, ocr_text)
+    if cache_key and result and result.get('produtos'):
+        llm_cache.set(cache_key, result, timeout=OCR_CACHE_TIMEOUT)
+    return result
+
+
+def _llm_extract_document(file_path: str, ocr_text: str = None):
+    """
+    LLM Document Extractor - Level -1 (pós-processador inteligente)
+    
+    Usa LLM (Groq/Ollama) para extrair dados estruturados de documentos.
+    Combina texto OCR com prompt engineering.
+    
+    Args:
+        file_path: Caminho do PDF/imagem
+        ocr_text: Texto já extraído por OCR (opcional, melhora resultados)
+    
+    Returns:
+        dict com metadados + produtos ou None se falhar
+    """
+    # Verificar se requests está disponível
+    if not OCR_SPACE_AVAILABLE:
+        print("⚠️ requests não disponível - LLM desabilitado")
+        return None
+    
+    # Tentar Groq primeiro; em rate limit (429) passa à chave seguinte (round-robin)
+    groq_keys = [(name, os.environ.get(name)) for name in GROQ_KEY_NAMES]
+    groq_keys = [(name, key) for name, key in groq_keys if key]
+    if groq_keys:
+        for key_name, groq_key in groq_keys:
+            print(f"🔑 Tentando Groq com {key_name}...")
+            groq_result, status_code = groq_extract_document(file_path, ocr_text, groq_key, key_name)
+            
+            # Se sucesso, retornar resultado
+            if groq_result and groq_result.get('produtos'):
+                return groq_result
+            
+            if status_code != 429:
+                break
+            print(f"🔄 Rate limit em {key_name}")
+        else:
+            print("⚠️ Todas as chaves Groq em rate limit - sem fallback disponível")
+        
+        print("⚠️ Groq falhou ou sem produtos - tentando Ollama fallback")
+    
+    # Fallback: Ollama (se configurado)
+    ollama_url = os.environ.get('OLLAMA_API_URL')
+    ollama_model = os.environ.get('OLLAMA_MODEL', 'llama3.2-vision')
+    
+    if not ollama_url:
+        print("⚠️ Nenhum LLM configurado ou todos falharam")
+        return None
+    
+    try:
         # Preparar preview do texto OCR (sem backslash em f-string)
         ocr_preview = f"OCR Text:\n{ocr_text[:2000]}" if ocr_text else "No OCR text - analyze image directly"
         
@@ -471,7 +636,7 @@ IMPORTANT:
         payload = {
             "model": ollama_model,
             "messages": [
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": _OLLAMA_SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt}
             ],
             "stream": False,
@@ -485,13 +650,19 @@ IMPORTANT:
         
         # Se modelo suporta vision, adicionar imagem
         if 'vision' in ollama_model.lower() and file_path.lower().endswith('.pdf'):
-            # Converter primeira página PDF para base64
+            # Converter primeira página PDF para base64 (renderizada pelo PyMuPDF se disponível)
             try:
-                images = convert_from_path(file_path, first_page=1, last_page=1, dpi=150)
-                if images:
+                first_page = next(_iter_pages(file_path, dpi=150, grayscale=False, max_pages=1), None)
+                if first_page:
+                    # JPEG Q85 em vez de PNG: ~10x menos bytes a enviar, sem perda de legibilidade
+                    img = first_page[2]
+                    if img.mode not in ('RGB', 'L'):
+                        img = img.convert('RGB')
+                    if img.width * img.height > OLLAMA_VISION_MAX_PIXELS:
+                        img.thumbnail(OLLAMA_VISION_MAX_SIZE, Image.Resampling.LANCZOS)
                     img_buffer = BytesIO()
-                    images[0].save(img_buffer, format='PNG')
-                    img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+                    img.save(img_buffer, format='JPEG', quality=85, optimize=True)
+                    img_base64 = base64.b64encode(img_buffer.getbuffer()).decode('ascii')
                     
                     payload["messages"][-1]["images"] = [img_base64]
                     print(f"✅ Ollama vision: imagem adicionada ({len(img_base64)} bytes)")
@@ -504,14 +675,14 @@ IMPORTANT:
         print(f"   OCR context: {len(ocr_text) if ocr_text else 0} chars")
         print(f"   Timeout: 60s")
         
-        response = requests.post(
+        response = _OLLAMA_SESSION.post(
             f"{ollama_url}/api/chat",
             json=payload,
             timeout=60  # 60s timeout para LLMs (mais lento que OCR)
         )
         
         if response.status_code == 200:
-            result = response.json()
+            result = _json_loads(response.content)
             content = result.get('message', {}).get('content', '')
             
             if not content:
@@ -526,7 +697,7 @@ IMPORTANT:
                 elif '```' in content:
                     content = content.split('```')[1].split('```')[0].strip()
                 
-                extracted_data = json.loads(content)
+                extracted_data = _json_loads(content)
                 
                 # Validar estrutura mínima
                 if not isinstance(extracted_data, dict):
@@ -557,18 +728,80 @@ IMPORTANT:
 
 # --- PaddleOCR (lazy loading para evitar problemas no startup) ---
 _paddle_ocr_instance = None
+# Recortes de texto por chamada ao reconhecedor/classificador de ângulo (PaddleOCR usa 6).
+# Uma página de guia/fatura tem dezenas de linhas: lotes maiores = menos chamadas ao
+# preditor por página. Lotes entre páginas não são possíveis: com deteção ligada o
+# PaddleOCR.ocr só aceita uma imagem de cada vez.
+PADDLE_REC_BATCH = int(os.environ.get("PADDLE_REC_BATCH", "16"))
+
+# GPU para o PaddleOCR/EasyOCR (deteção + reconhecimento): só com OCR_USE_GPU=1 e se
+# houver CUDA. Cada worker do pool de processos carrega o seu modelo na GPU, por isso a
+# memória reservada por processo é limitada (FLAGS_fraction_of_gpu_memory_to_use).
+OCR_USE_GPU = os.environ.get("OCR_USE_GPU", "0") == "1"
+OCR_GPU_MEMORY_FRACTION = os.environ.get("OCR_GPU_MEMORY_FRACTION", "0.3")
+
+
+def _paddle_gpu_available() -> bool:
+    if not OCR_USE_GPU:
+        return False
+    try:
+        # O Paddle lê as FLAGS_* do ambiente no primeiro import: definir antes dele, e
+        # set_flags para o caso de o paddle já ter sido importado noutro sítio
+        os.environ.setdefault("FLAGS_fraction_of_gpu_memory_to_use", OCR_GPU_MEMORY_FRACTION)
+        import paddle
+        if not (paddle.is_compiled_with_cuda() and paddle.device.cuda.device_count() > 0):
+            return False
+        paddle.set_flags({"FLAGS_fraction_of_gpu_memory_to_use":
+                          float(os.environ["FLAGS_fraction_of_gpu_memory_to_use"])})
+        return True
+    except Exception:
+        return False
+
+
+def _torch_gpu_available() -> bool:
+    if not OCR_USE_GPU:
+        return False
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except Exception:
+        return False
+
+# Os preditores do PaddleOCR e do EasyOCR não são thread-safe: no processo principal
+# (imagens, PDFs de uma página) vários documentos são processados em threads
+# (INBOUND_WORKERS), por isso a criação e cada chamada ao motor são serializadas.
+# Um processo criado por fork herda o estado destes locks (fechados, se outra thread os
+# tinha nesse momento) e não um lock novo: o pool de OCR arranca por spawn (get_ocr_pool)
+# e, para qualquer outro fork, _reset_ocr_engines_after_fork recria-os no filho.
+_paddle_ocr_lock = threading.Lock()
+_easyocr_lock = threading.Lock()
+
+def _paddle_may_be_available() -> bool:
+    """
+    Se o PaddleOCR pode ser usado, sem o carregar: escolhe o caminho do OCR por página no
+    processo principal, e o modelo só é criado onde a página é processada (cada worker
+    do pool carrega o seu). False se já falhou a inicialização neste processo.
+    """
+    return _paddle_ocr_instance is not False and importlib.util.find_spec("paddleocr") is not None
+
 
 def get_paddle_ocr():
     """Inicializa PaddleOCR lazy - só quando necessário."""
     global _paddle_ocr_instance
     if _paddle_ocr_instance is None:
-        try:
-            from paddleocr import PaddleOCR
-            _paddle_ocr_instance = PaddleOCR(use_angle_cls=True, lang='pt')
-            print("✅ PaddleOCR inicializado (português)")
-        except Exception as e:
-            print(f"⚠️ PaddleOCR não disponível: {e}")
-            _paddle_ocr_instance = False
+        with _paddle_ocr_lock:
+            if _paddle_ocr_instance is None:
+                try:
+                    use_gpu = _paddle_gpu_available()
+                    from paddleocr import PaddleOCR
+                    _paddle_ocr_instance = PaddleOCR(use_angle_cls=True, lang='pt',
+                                                     use_gpu=use_gpu,
+                                                     rec_batch_num=PADDLE_REC_BATCH,
+                                                     cls_batch_num=PADDLE_REC_BATCH)
+                    logger.info("✅ PaddleOCR inicializado (português, %s)", 'GPU' if use_gpu else 'CPU')
+                except Exception as e:
+                    logger.warning("⚠️ PaddleOCR não disponível: %s", e)
+                    _paddle_ocr_instance = False
     return _paddle_ocr_instance if _paddle_ocr_instance is not False else None
 
 # --- EasyOCR (lazy loading para evitar problemas no startup) ---
@@ -578,69 +811,314 @@ def get_easy_ocr():
     """Inicializa EasyOCR lazy - só quando necessário."""
     global _easyocr_instance
     if _easyocr_instance is None:
-        try:
-            import easyocr
-            _easyocr_instance = easyocr.Reader(['pt', 'es', 'fr'], gpu=False)
-            print("✅ EasyOCR inicializado (PT/ES/FR)")
-        except Exception as e:
-            print(f"⚠️ EasyOCR não disponível: {e}")
-            _easyocr_instance = False
+        with _easyocr_lock:
+            if _easyocr_instance is None:
+                try:
+                    import easyocr
+                    use_gpu = _torch_gpu_available()
+                    _easyocr_instance = easyocr.Reader(['pt', 'es', 'fr'], gpu=use_gpu)
+                    logger.info("✅ EasyOCR inicializado (PT/ES/FR, %s)", 'GPU' if use_gpu else 'CPU')
+                except Exception as e:
+                    logger.warning("⚠️ EasyOCR não disponível: %s", e)
+                    _easyocr_instance = False
     return _easyocr_instance if _easyocr_instance is not False else None
 
-# ----------------- OCR: PDF/Imagens -----------------
 
+def _reset_ocr_engines_after_fork():
+    """No filho de um fork: locks novos e motores por carregar (os do pai não são seguros)."""
+    global _paddle_ocr_lock, _easyocr_lock, _paddle_ocr_instance, _easyocr_instance
+    _paddle_ocr_lock = threading.Lock()
+    _easyocr_lock = threading.Lock()
+    _paddle_ocr_instance = None
+    _easyocr_instance = None
 
-def save_extraction_to_json(data: dict, filename: str = "extracao.json"):
-    """Salva os dados extraídos em um arquivo JSON."""
-    try:
-        json_path = os.path.join(settings.BASE_DIR, filename)
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"✅ Dados salvos em {json_path}")
-        return json_path
-    except Exception as e:
-        print(f"❌ Erro ao salvar JSON: {e}")
-        return None
 
+os.register_at_fork(after_in_child=_reset_ocr_engines_after_fork)
 
-def real_ocr_extract(file_path: str):
-    """OCR usando Tesseract. Extrai texto e faz parse para estrutura."""
-    text_content = ""
-    qr_codes = []
-    ext = os.path.splitext(file_path)[1].lower()
+# Confiança mínima de cada linha/deteção aceite do PaddleOCR e do EasyOCR
+PADDLE_MIN_CONFIDENCE = 0.5
+EASYOCR_MIN_CONFIDENCE = 0.3
 
-    print(f"🔍 Processando com Tesseract: {os.path.basename(file_path)}")
-    
-    if ext == ".pdf":
-        text_content, qr_codes = extract_text_from_pdf(file_path)
-    elif ext in [".jpg", ".jpeg", ".png", ".tiff", ".bmp"]:
-        text_content, qr_codes = extract_text_from_image(file_path)
 
-    # Validação antecipada: se texto muito curto, pode ser ficheiro ilegível/desformatado
-    texto_pdfplumber_curto = len(text_content) < 50
-    if texto_pdfplumber_curto:
-        print(f"⚠️ Texto pdfplumber muito curto ({len(text_content)} chars) - possível ficheiro ilegível")
+def _paddle_text(paddle_ocr, img_array) -> str:
+    """OCR PaddleOCR de uma imagem: uma linha por deteção com confiança suficiente."""
+    with _paddle_ocr_lock:
+        result = paddle_ocr.ocr(img_array, cls=True)
+    if not result or not result[0]:
+        return ""
+    kept = [line[1][0] for line in result[0]
+            if line and len(line) >= 2 and line[1][1] > PADDLE_MIN_CONFIDENCE]
+    return "".join(text + "\n" for text in kept)
 
-    preview = "\n".join(text_content.splitlines()[:60])
-    print("---- OCR PREVIEW (primeiras linhas) ----")
-    print(preview)
-    print("----------------------------------------")
 
-    if qr_codes:
-        print(f"✅ {len(qr_codes)} QR code(s) detectado(s)")
+def _easyocr_text(easy_ocr, img_array) -> str:
+    """OCR EasyOCR de uma imagem: deteções com confiança suficiente, separadas por espaço."""
+    with _easyocr_lock:
+        result = easy_ocr.readtext(img_array)
+    if not result:
+        return ""
+    return " ".join(d[1] for d in result if d[2] > EASYOCR_MIN_CONFIDENCE).strip() + "\n"
+
+# --- tesserocr (API do Tesseract em processo, modelo carregado uma vez) ---
+# Uma instância por thread: PyTessBaseAPI não pode ser usada por duas threads ao mesmo
+# tempo, e cada thread reutiliza a sua entre páginas e documentos.
+_tess_local = threading.local()
+
+def get_tess_api():
+    """Inicializa tesserocr lazy - uma instância por thread, reutilizada entre páginas."""
+    api = getattr(_tess_local, "api", None)
+    if api is None:
+        if not TESSEROCR_AVAILABLE:
+            api = False
+        else:
+            try:
+                api = PyTessBaseAPI(lang="por", psm=PSM.AUTO)
+                logger.info("✅ tesserocr inicializado (português)")
+            except Exception as e:
+                logger.warning("⚠️ tesserocr não disponível: %s", e)
+                api = False
+        _tess_local.api = api
+    return api if api is not False else None
 
-    if not text_content.strip():
-        print("❌ OCR vazio")
-        error_result = {
-            "error": "OCR failed - no text extracted from document",
-            "numero_requisicao": f"ERROR-{os.path.basename(file_path)}",
-            "document_number": "",
-            "po_number": "",
-            "supplier_name": "",
-            "delivery_date": "",
-            "qr_codes": qr_codes,
-            "lines": [],
-            "totals": {
+
+# --- Pool de processos do OCR por página (lazy, partilhado entre documentos) ---
+_ocr_pool_instance = None
+_ocr_pool_lock = threading.Lock()
+
+def get_ocr_pool():
+    """
+    ProcessPoolExecutor do OCR por página, criado uma vez por processo: os workers (e os
+    motores OCR já carregados neles) são reutilizados entre documentos, e documentos
+    processados em paralelo partilham os mesmos processos: metade dos CPUs, porque cada
+    preditor PaddleOCR usa mais de uma thread de cálculo.
+    
+    Os workers arrancam sempre por spawn, nunca por fork: o processo principal tem outras
+    threads (INBOUND_WORKERS) que podem estar dentro de _paddle_ocr_lock/_easyocr_lock, ou
+    com CUDA/OpenMP inicializados, no momento do fork, e um filho herdaria esses locks
+    fechados para sempre. Um processo spawn começa limpo e configura o Django
+    (django.setup) antes de importar este módulo.
+    """
+    global _ocr_pool_instance
+    with _ocr_pool_lock:
+        if _ocr_pool_instance is None:
+            import django
+            _ocr_pool_instance = ProcessPoolExecutor(
+                max_workers=max(1, (os.cpu_count() or 1) // 2),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup)
+        return _ocr_pool_instance
+
+
+def _reset_ocr_pool():
+    """Descarta o pool (ex: um worker morreu → BrokenProcessPool); o próximo pedido cria outro."""
+    global _ocr_pool_instance
+    with _ocr_pool_lock:
+        if _ocr_pool_instance is not None:
+            _ocr_pool_instance.shutdown(wait=False, cancel_futures=True)
+        _ocr_pool_instance = None
+
+
+# Páginas de um documento já renderizadas e à espera de OCR (backpressure): a renderização
+# vai no máximo este número de páginas à frente do OCR, em vez de encher a fila do pool
+# com todas as páginas do PDF em memória.
+OCR_MAX_PENDING_PAGES = 2 * (os.cpu_count() or 1)
+
+
+def _submit_page(executor, futures: list, fn, *args):
+    """Submete o OCR de uma página; se já houver OCR_MAX_PENDING_PAGES por fazer, espera que uma acabe."""
+    in_flight = [f for f in futures if not f.done()]
+    if len(in_flight) >= OCR_MAX_PENDING_PAGES:
+        wait(in_flight, return_when=FIRST_COMPLETED)
+    futures.append(executor.submit(fn, *args))
+
+
+# Pré-binarização Otsu antes do Tesseract: desligada por omissão. O motor LSTM trabalha
+# sobre a imagem em tons de cinzento e binarizar antes pode baixar a precisão em
+# digitalizações fracas; ligar (TESSERACT_BINARIZE=1) só depois de comparar nos documentos.
+TESSERACT_BINARIZE = os.environ.get("TESSERACT_BINARIZE", "0") == "1"
+
+
+def binarize_for_tesseract(image):
+    """
+    Imagem para o Tesseract: tons de cinzento (1 byte/pixel) e, com TESSERACT_BINARIZE,
+    binarizada com Otsu (OpenCV). Só para o Tesseract: PaddleOCR/EasyOCR recebem a
+    imagem original.
+    Aceita uma imagem PIL ou o array numpy da página já convertido (sem nova cópia).
+    """
+    if not isinstance(image, Image.Image):
+        if not CV2_AVAILABLE:
+            return Image.fromarray(image).convert("L")
+        arr = image
+        if arr.ndim == 3:
+            arr = cv2.cvtColor(arr, cv2.COLOR_RGBA2GRAY if arr.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+        if not TESSERACT_BINARIZE:
+            return Image.fromarray(arr)
+    else:
+        if image.mode != "L":
+            image = image.convert("L")
+        if not CV2_AVAILABLE or not TESSERACT_BINARIZE:
+            return image
+        arr = np.asarray(image)
+    _, bw = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return Image.fromarray(bw)
+
+
+# --- Pool de threads do OCR por página só com Tesseract (tesserocr liberta o GIL) ---
+_ocr_thread_pool_instance = None
+
+def get_ocr_thread_pool():
+    """
+    ThreadPoolExecutor do OCR por página quando o único motor é o tesserocr: as páginas
+    ficam no mesmo processo (sem copiar os bytes da imagem para outro processo) e as
+    threads (cada uma com a sua PyTessBaseAPI) são reutilizadas entre documentos.
+    """
+    global _ocr_thread_pool_instance
+    with _ocr_pool_lock:
+        if _ocr_thread_pool_instance is None:
+            _ocr_thread_pool_instance = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1, thread_name_prefix="tesserocr")
+        return _ocr_thread_pool_instance
+
+
+# Tempo máximo (segundos) do Tesseract por página, no tesserocr e no pytesseract
+TESSERACT_TIMEOUT = int(os.environ.get("TESSERACT_TIMEOUT", "60"))
+
+
+def tesseract_ocr(image, psm: int = 3) -> str:
+    """
+    Tesseract via tesserocr (sem subprocesso); fallback para pytesseract.
+    Nos dois casos uma página que exceda TESSERACT_TIMEOUT levanta RuntimeError("...timeout"),
+    como o pytesseract, para não bloquear o worker.
+    """
+    image = binarize_for_tesseract(image)
+    api = get_tess_api()
+    if api:
+        api.SetPageSegMode(psm)
+        # Píxeis em bruto (1 byte/píxel): SetImage codificaria a imagem PIL num ficheiro
+        # em memória para o Leptonica voltar a descodificar
+        api.SetImageBytes(image.tobytes(), image.width, image.height, 1, image.width)
+        # Recognize com prazo (ms); o GetUTF8Text seguinte reutiliza o resultado
+        if not api.Recognize(TESSERACT_TIMEOUT * 1000):
+            api.Clear()
+            raise RuntimeError(f"Tesseract timeout ({TESSERACT_TIMEOUT}s) ou falha no reconhecimento")
+        return api.GetUTF8Text()
+    return pytesseract.image_to_string(
+        image, config=f"--psm {psm} --oem 3 -l por", lang="por", timeout=TESSERACT_TIMEOUT)
+
+# ----------------- OCR: PDF/Imagens -----------------
+
+
+# Escrita do extracao.json fora do caminho do pedido (1 worker → gravações pela ordem de chegada)
+_json_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="extracao-json")
+
+
+def _write_json_file(json_path: str, payload: bytes):
+    try:
+        with open(json_path, 'wb') as f:
+            f.write(payload)
+        print(f"✅ Dados salvos em {json_path}")
+    except OSError as e:
+        print(f"❌ Erro ao salvar JSON: {e}")
+
+
+def save_extraction_to_json(data: dict, filename: str = "extracao.json"):
+    """Salva os dados extraídos em um arquivo JSON (compacto, gravado em background)."""
+    try:
+        json_path = os.path.join(settings.BASE_DIR, filename)
+        # Serializa já (os dados podem ser alterados a seguir); só a escrita em disco é adiada
+        payload = _json_dumps_bytes(data)
+        _json_writer.submit(_write_json_file, json_path, payload)
+        print(f"📝 Gravação de {json_path} agendada")
+        return json_path
+    except Exception as e:
+        print(f"❌ Erro ao salvar JSON: {e}")
+        return None
+
+
+# --- Cache de resultados OCR/LLM (chave = hash do conteúdo do ficheiro) ---
+OCR_CACHE_ALIAS = "ocr"
+OCR_CACHE_TIMEOUT = 86400
+# Incrementar quando os parsers/cascata OCR mudarem (invalida os resultados em cache)
+OCR_CACHE_VERSION = 1
+# Incrementar quando os prompts do Groq/Ollama mudarem
+LLM_CACHE_VERSION = 1
+
+
+def _file_digest(file_path: str) -> str:
+    """
+    Hash do conteúdo do ficheiro (o mesmo scan reenviado dá o mesmo hash).
+    xxh3-128 (não criptográfico, muito mais rápido em PDFs grandes) se o xxhash estiver
+    instalado; senão sha256. O prefixo distingue os dois para não haver colisões entre eles.
+    """
+    with open(file_path, "rb") as f:
+        if XXHASH_AVAILABLE:
+            return "xxh3:" + hashlib.file_digest(f, xxhash.xxh3_128).hexdigest()
+        return "sha256:" + hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _text_digest(text: str) -> str:
+    data = (text or "").encode("utf-8")
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _ocr_cache_key(file_path: str) -> str:
+    """Chave de cache do resultado de real_ocr_extract."""
+    return f"ocr:v{OCR_CACHE_VERSION}:{_file_digest(file_path)}"
+
+
+def real_ocr_extract(file_path: str):
+    """OCR usando Tesseract. Extrai texto e faz parse para estrutura."""
+    text_content = ""
+    qr_codes = []
+    ext = os.path.splitext(file_path)[1].lower()
+
+    # Ficheiro já processado (mesmo conteúdo) → devolve o resultado em cache sem OCR
+    ocr_cache = caches[OCR_CACHE_ALIAS]
+    try:
+        cache_key = _ocr_cache_key(file_path)
+    except OSError as e:
+        logger.warning("⚠️ Cache OCR indisponível: %s", e)
+        cache_key = None
+    if cache_key:
+        cached = ocr_cache.get(cache_key)
+        if cached is not None:
+            logger.info("⚡ Resultado OCR em cache para %s", os.path.basename(file_path))
+            save_extraction_to_json(cached)
+            return cached
+
+    logger.info("🔍 Processando com Tesseract: %s", os.path.basename(file_path))
+    
+    if ext == ".pdf":
+        text_content, qr_codes = extract_text_from_pdf(file_path)
+    elif ext in [".jpg", ".jpeg", ".png", ".tiff", ".bmp"]:
+        text_content, qr_codes = extract_text_from_image(file_path)
+
+    # Validação antecipada: se texto muito curto, pode ser ficheiro ilegível/desformatado
+    texto_pdfplumber_curto = len(text_content) < 50
+    if texto_pdfplumber_curto:
+        logger.warning("⚠️ Texto pdfplumber muito curto (%d chars) - possível ficheiro ilegível", len(text_content))
+
+    preview = "\n".join(text_content.splitlines()[:60])
+    logger.info("---- OCR PREVIEW (primeiras linhas) ----\n%s\n----------------------------------------",
+                preview)
+
+    if qr_codes:
+        logger.info("✅ %d QR code(s) detectado(s)", len(qr_codes))
+
+    if not text_content.strip():
+        logger.error("❌ OCR vazio")
+        error_result = {
+            "error": "OCR failed - no text extracted from document",
+            "numero_requisicao": f"ERROR-{os.path.basename(file_path)}",
+            "document_number": "",
+            "po_number": "",
+            "supplier_name": "",
+            "delivery_date": "",
+            "qr_codes": qr_codes,
+            "lines": [],
+            "totals": {
                 "total_lines": 0,
                 "total_quantity": 0
             },
@@ -650,339 +1128,706 @@ def real_ocr_extract(file_path: str):
 
     result = parse_portuguese_document(text_content, qr_codes, texto_pdfplumber_curto, file_path=file_path)
     save_extraction_to_json(result)
+    if cache_key:
+        ocr_cache.set(cache_key, result, timeout=OCR_CACHE_TIMEOUT)
     return result
 
 
+# Página digitalizada: sem texto útil e com imagens a cobrir pelo menos metade da página
+SCANNED_PAGE_MIN_CHARS = 20
+SCANNED_PAGE_IMAGE_RATIO = 0.5
+
+
+def _page_is_scanned(page, text_chars: int) -> bool:
+    """Página (PyMuPDF) sem texto embutido útil e ocupada por imagem (scan)."""
+    import pymupdf as fitz
+    if text_chars >= SCANNED_PAGE_MIN_CHARS:
+        return False
+    page_area = abs(page.rect)
+    if not page_area:
+        return False
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return image_area >= SCANNED_PAGE_IMAGE_RATIO * page_area
+
+
+def _classify_pdf(doc, probe_pages: int = 3) -> str:
+    """
+    Classifica o PDF (já aberto no PyMuPDF) pelas primeiras páginas:
+    "scanned" (sem texto embutido → OCR), "mixed" (texto embutido e páginas digitalizadas)
+    ou "text".
+    """
+    chars = 0
+    has_scanned_page = False
+    for page in doc.pages(0, min(probe_pages, doc.page_count)):
+        page_chars = len(page.get_text().strip())
+        chars += page_chars
+        has_scanned_page = has_scanned_page or _page_is_scanned(page, page_chars)
+    if doc.page_count and chars < SCANNED_PAGE_MIN_CHARS:
+        return "scanned"
+    return "mixed" if has_scanned_page else "text"
+
+
+def _ocr_scanned_pages(doc, parts: list):
+    """
+    PDF misto: substitui (in place) o texto das páginas digitalizadas pelo OCR da página.
+    O PyMuPDF não é thread-safe: as páginas são renderizadas aqui, uma a uma, e o OCR
+    corre em paralelo nos mesmos pools de extract_text_from_pdf_with_ocr (threads só com
+    tesserocr, processos nos restantes motores); uma só página é feita neste processo.
+    Sem QR: a passagem scan_pdf_qrcodes do texto embutido já lê estas páginas.
+    """
+    import pymupdf as fitz
+    paddle_ocr = _paddle_may_be_available()
+    ocr_engine = "PaddleOCR" if paddle_ocr else "Tesseract"
+    scanned = [index for index, page_text in enumerate(parts)
+               if _page_is_scanned(doc[index], len(page_text.strip()))]
+    use_threads = (TESSEROCR_AVAILABLE and not paddle_ocr
+                   and importlib.util.find_spec("easyocr") is None)
+
+    def render(index):
+        pix = doc[index].get_pixmap(dpi=OCR_DPI, alpha=False, colorspace=fitz.csGRAY)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+    if len(scanned) == 1:
+        index = scanned[0]
+        parts[index] = _ocr_page(render(index), index + 1, doc.page_count, ocr_engine,
+                                 scan_qr=False)[1]
+        return
+
+    futures = []
+    for index in scanned:
+        image = render(index)
+        if use_threads:
+            _submit_page(get_ocr_thread_pool(), futures,
+                         _ocr_page, image, index + 1, doc.page_count, ocr_engine, False)
+        else:
+            raster = (image.mode, image.size, image.tobytes())
+            _submit_page(get_ocr_pool(), futures,
+                         _ocr_one_page, raster, index + 1, doc.page_count, ocr_engine, False)
+        del image
+    try:
+        for future in futures:
+            page_number, page_text, _ = future.result()
+            parts[page_number - 1] = page_text
+    except BrokenProcessPool:
+        _reset_ocr_pool()
+        raise
+
+
+def _pdfium_text(file_path: str) -> str:
+    """Texto embutido via pypdfium2 (PDFium, muito mais rápido que o PyPDF2)."""
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        parts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            parts.append(textpage.get_text_range().replace("\r\n", "\n"))
+            textpage.close()
+            page.close()
+        return "\n".join(parts) + "\n"
+    finally:
+        pdf.close()
+
+
+def _extract_embedded_text(file_path: str) -> str:
+    """
+    Texto embutido do PDF.
+    O texto continua a vir do PyPDF2 porque os parsers (Elastron, Colmol...) dependem
+    da ordem dos tokens que ele produz. O PyMuPDF (um só documento aberto) classifica o PDF:
+    os digitalizados saltam o PyPDF2 e, nos mistos, só as páginas digitalizadas passam
+    por OCR; serve ainda de fallback se o PyPDF2 falhar (e, sem PyMuPDF, o pypdfium2).
+    """
+    doc = None
+    kind = "text"
+    if PYMUPDF_AVAILABLE:
+        try:
+            import pymupdf as fitz
+            doc = fitz.open(file_path)
+            kind = _classify_pdf(doc)
+        except Exception as e:
+            logger.warning("⚠️ PyMuPDF falhou na sonda de texto: %s", e)
+
+    try:
+        if kind == "scanned":
+            return ""
+        try:
+            parts = []
+            embedded_chars = 0
+            with open(file_path, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                for page_num, page in enumerate(reader.pages, start=1):
+                    page_text = page.extract_text() or ""
+                    parts.append(page_text)
+                    embedded_chars += len(page_text.strip())
+                    # PDF digitalizado: 2 páginas sem texto útil → não ler o resto, seguir para
+                    # OCR do documento todo. Nos mistos o texto das páginas seguintes é usado
+                    # (só as digitalizadas passam por OCR), por isso lê-se sempre até ao fim
+                    if page_num == 2 and embedded_chars < 20 and kind != "mixed":
+                        break
+        except Exception as e:
+            if doc is not None:
+                logger.warning("⚠️ PyPDF2 falhou (%s) - a usar texto do PyMuPDF", e)
+                return "\n".join(page.get_text() for page in doc) + "\n"
+            if not PYPDFIUM2_AVAILABLE:
+                raise
+            logger.warning("⚠️ PyPDF2 falhou (%s) - a usar texto do pypdfium2", e)
+            return _pdfium_text(file_path)
+        
+        if kind == "mixed":
+            logger.info("📄 PDF misto - OCR só das páginas digitalizadas")
+            _ocr_scanned_pages(doc, parts)
+        return "\n".join(parts) + "\n"
+    finally:
+        if doc is not None:
+            doc.close()
+
+
 def extract_text_from_pdf(file_path: str):
     """
     Cascata de extração de PDF (4 níveis):
-    1. Texto embutido (PyPDF2) - mais rápido
+    1. Texto embutido (PyPDF2, com sonda PyMuPDF) - mais rápido
     2. OCR.space API - cloud, preciso, grátis 25k/mês
     3. PaddleOCR/EasyOCR/Tesseract - local, offline
     """
     try:
         # LEVEL 1: Tenta texto embutido primeiro (mais rápido)
-        text = ""
-        with open(file_path, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                page_text = page.extract_text() or ""
-                text += page_text + "\n"
+        text = _extract_embedded_text(file_path)
 
         if text.strip() and len(text.strip()) > 50:
-            print(f"✅ PDF text extraction: {len(text)} chars")
+            logger.info("✅ PDF text extraction: %d chars", len(text))
             # Mesmo com texto embutido, tenta detectar QR codes
             qr_codes = []
             if QR_CODE_ENABLED:
                 try:
-                    print("🔍 Procurando QR codes no PDF...")
-                    pages = convert_from_path(file_path, dpi=300)
-                    for page_num, page_img in enumerate(pages, start=1):
-                        page_qr = detect_and_read_qrcodes(page_img,
-                                                          page_number=page_num)
-                        qr_codes.extend(page_qr)
+                    logger.info("🔍 Procurando QR codes no PDF...")
+                    qr_codes = scan_pdf_qrcodes(file_path)
                 except Exception as e:
-                    print(f"⚠️ Erro ao buscar QR codes: {e}")
+                    logger.warning("⚠️ Erro ao buscar QR codes: %s", e)
             return text.strip(), qr_codes
 
         # LEVEL 2: OCR.space API (cloud, grátis, preciso)
-        print("📄 PDF sem texto embutido - tentando OCR.space API...")
+        # O scan de QR codes (CPU local) corre numa thread enquanto se espera pela resposta
+        # HTTP: o tempo total passa de soma para máximo dos dois
+        logger.info("📄 PDF sem texto embutido - tentando OCR.space API...")
+        qr_future = None
+        if QR_CODE_ENABLED and OCR_SPACE_AVAILABLE and os.environ.get('OCR_SPACE_API_KEY'):
+            logger.info("🔍 Procurando QR codes no PDF (em paralelo com OCR.space)...")
+            qr_executor = ThreadPoolExecutor(max_workers=1)
+            qr_future = qr_executor.submit(scan_pdf_qrcodes, file_path)
+            qr_executor.shutdown(wait=False)
         ocr_text = ocr_space_api(file_path, language='por')
         
+        # QR codes (se disponível)
+        qr_codes = None
+        if qr_future is not None:
+            try:
+                qr_codes = qr_future.result()
+            except Exception as e:
+                logger.warning("⚠️ Erro ao buscar QR codes: %s", e)
+        
         if ocr_text and len(ocr_text.strip()) > 50:
-            # QR codes (se disponível)
-            qr_codes = []
-            if QR_CODE_ENABLED:
-                try:
-                    print("🔍 Procurando QR codes no PDF...")
-                    pages = convert_from_path(file_path, dpi=300)
-                    for page_num, page_img in enumerate(pages, start=1):
-                        page_qr = detect_and_read_qrcodes(page_img, page_number=page_num)
-                        qr_codes.extend(page_qr)
-                except Exception as e:
-                    print(f"⚠️ Erro ao buscar QR codes: {e}")
-            return ocr_text.strip(), qr_codes
+            return ocr_text.strip(), qr_codes or []
 
         # LEVEL 3: Engines locais (PaddleOCR → EasyOCR → Tesseract)
-        print("📄 OCR.space falhou - usando engines locais (PaddleOCR/EasyOCR/Tesseract)...")
-        return extract_text_from_pdf_with_ocr(file_path)
+        # Os QR já lidos em paralelo com o OCR.space não são procurados outra vez nas páginas
+        logger.info("📄 OCR.space falhou - usando engines locais (PaddleOCR/EasyOCR/Tesseract)...")
+        return extract_text_from_pdf_with_ocr(file_path, qr_codes)
 
     except Exception as e:
-        print(f"❌ Erro no extract_text_from_pdf: {e}")
+        logger.error("❌ Erro no extract_text_from_pdf: %s", e)
         return extract_text_from_pdf_with_ocr(file_path)
 
 
-def parse_qrcode_fiscal_pt(qr_data: str):
-    """Parse de QR code fiscal português (formato A:valor*B:valor*...) com nomes descritivos."""
-
-    # Mapeamento dos códigos para nomes descritivos (Especificações Técnicas AT)
-    FIELD_NAMES = {
-        "A": "nif_emitente",
-        "B": "nif_adquirente",
-        "C": "pais_adquirente",
-        "D": "tipo_documento",
-        "E": "estado_documento",
-        "F": "data_documento",
-        "G": "identificacao_documento",
-        "H": "atcud",
-        "I1": "espaco_fiscal",
-        "I2": "base_tributavel_isenta_iva",
-        "I3": "base_tributavel_taxa_reduzida",
-        "I4": "total_iva_taxa_reduzida",
-        "I5": "base_tributavel_taxa_intermedia",
-        "I6": "total_iva_taxa_intermedia",
-        "I7": "base_tributavel_taxa_normal",
-        "I8": "total_iva_taxa_normal",
-        "J1": "espaco_fiscal_2",
-        "J2": "base_tributavel_isenta_iva_2",
-        "J3": "base_tributavel_taxa_reduzida_2",
-        "J4": "total_iva_taxa_reduzida_2",
-        "J5": "base_tributavel_taxa_intermedia_2",
-        "J6": "total_iva_taxa_intermedia_2",
-        "J7": "base_tributavel_taxa_normal_2",
-        "J8": "total_iva_taxa_normal_2",
-        "K1": "espaco_fiscal_3",
-        "K2": "base_tributavel_isenta_iva_3",
-        "K3": "base_tributavel_taxa_reduzida_3",
-        "K4": "total_iva_taxa_reduzida_3",
-        "K5": "base_tributavel_taxa_intermedia_3",
-        "K6": "total_iva_taxa_intermedia_3",
-        "K7": "base_tributavel_taxa_normal_3",
-        "K8": "total_iva_taxa_normal_3",
-        "L": "nao_sujeito_iva",
-        "M": "imposto_selo",
-        "N": "total_impostos",
-        "O": "total_documento",
-        "P": "retencao_na_fonte",
-        "Q": "hash",
-        "R": "certificado",
-        "S": "outras_infos"
-    }
+# Mapeamento dos códigos do QR fiscal para nomes descritivos (Especificações Técnicas AT)
+QR_FIELD_NAMES = {
+    "A": "nif_emitente",
+    "B": "nif_adquirente",
+    "C": "pais_adquirente",
+    "D": "tipo_documento",
+    "E": "estado_documento",
+    "F": "data_documento",
+    "G": "identificacao_documento",
+    "H": "atcud",
+    "I1": "espaco_fiscal",
+    "I2": "base_tributavel_isenta_iva",
+    "I3": "base_tributavel_taxa_reduzida",
+    "I4": "total_iva_taxa_reduzida",
+    "I5": "base_tributavel_taxa_intermedia",
+    "I6": "total_iva_taxa_intermedia",
+    "I7": "base_tributavel_taxa_normal",
+    "I8": "total_iva_taxa_normal",
+    "J1": "espaco_fiscal_2",
+    "J2": "base_tributavel_isenta_iva_2",
+    "J3": "base_tributavel_taxa_reduzida_2",
+    "J4": "total_iva_taxa_reduzida_2",
+    "J5": "base_tributavel_taxa_intermedia_2",
+    "J6": "total_iva_taxa_intermedia_2",
+    "J7": "base_tributavel_taxa_normal_2",
+    "J8": "total_iva_taxa_normal_2",
+    "K1": "espaco_fiscal_3",
+    "K2": "base_tributavel_isenta_iva_3",
+    "K3": "base_tributavel_taxa_reduzida_3",
+    "K4": "total_iva_taxa_reduzida_3",
+    "K5": "base_tributavel_taxa_intermedia_3",
+    "K6": "total_iva_taxa_intermedia_3",
+    "K7": "base_tributavel_taxa_normal_3",
+    "K8": "total_iva_taxa_normal_3",
+    "L": "nao_sujeito_iva",
+    "M": "imposto_selo",
+    "N": "total_impostos",
+    "O": "total_documento",
+    "P": "retencao_na_fonte",
+    "Q": "hash",
+    "R": "certificado",
+    "S": "outras_infos"
+}
+
+# Campo "CODIGO:valor" entre asteriscos (o código vai até ao 1º ":", o valor até ao próximo "*")
+_RE_QR_FIELD = re.compile(r'(?:^|\*)([^*:]*):([^*]*)')
+
 
+@lru_cache(maxsize=1024)
+def _qr_fiscal_fields(qr_data: str):
+    """Campos (nome descritivo, valor) de um QR fiscal PT, ou None; em cache por conteúdo."""
+    # Uma passagem de regex: pares (código, valor) dos campos com ":"
+    pairs = _RE_QR_FIELD.findall(qr_data)
+
+    # Valida se é realmente um QR fiscal português
+    # QR fiscal deve ter pelo menos o campo A (NIF emitente)
+    if not any(code == "A" for code, _ in pairs):
+        return None
+
+    # Converte para nomes descritivos
+    return tuple((QR_FIELD_NAMES.get(code, code), value) for code, value in pairs)
+
+
+def parse_qrcode_fiscal_pt(qr_data: str):
+    """
+    Parse de QR code fiscal português (formato A:valor*B:valor*...) com nomes descritivos.
+    O mesmo QR lido em várias páginas ou reenviado noutro documento só é parseado uma vez;
+    cada chamada devolve um dict novo (o resultado é guardado e pode ser alterado).
+    """
     try:
         if not qr_data or "*" not in qr_data:
             return None
+        fields = _qr_fiscal_fields(qr_data)
+        return dict(fields) if fields is not None else None
+    except Exception as e:
+        logger.warning("⚠️ Erro ao parsear QR fiscal: %s", e)
+        return None
 
-        parsed_raw = {}
-        fields = qr_data.split("*")
 
-        for field in fields:
-            if ":" in field:
-                key, value = field.split(":", 1)
-                parsed_raw[key] = value
+def _build_qr_info(qr_data: str, page_number=None):
+    """Estrutura um QR code lido: dados fiscais PT parseados (se possível) + página."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("✅ QR: %s…", qr_data[:80])
 
-        # Valida se é realmente um QR fiscal português
-        # QR fiscal deve ter pelo menos o campo A (NIF emitente)
-        if not parsed_raw or "A" not in parsed_raw:
-            return None
+    # Tenta parsear QR code fiscal português
+    parsed = parse_qrcode_fiscal_pt(qr_data)
+    if parsed:
+        # Se parseou com sucesso, coloca os dados estruturados no campo "data"
+        qr_info = {"data": parsed, "raw_data": qr_data}
+    else:
+        # Se não conseguiu parsear, mantém como string
+        qr_info = {"data": qr_data}
 
-        # Converte para nomes descritivos
-        parsed = {}
-        for code, value in parsed_raw.items():
-            field_name = FIELD_NAMES.get(code, code)
-            parsed[field_name] = value
+    if page_number is not None:
+        qr_info["page"] = page_number
 
-        return parsed if parsed else None
-    except Exception as e:
-        print(f"⚠️ Erro ao parsear QR fiscal: {e}")
-        return None
+    return qr_info
+
+
+# Nível de cinzento acima do qual um píxel já não conta como módulo escuro de um QR
+QR_DARK_PIXEL_MAX = 128
+
+# Detector OpenCV reutilizado entre páginas: um por thread (o QR de cada página corre
+# numa thread à parte e o QRCodeDetector não é documentado como thread-safe)
+_qr_local = threading.local()
+
+def _get_qr_detector():
+    detector = getattr(_qr_local, "detector", None)
+    if detector is None:
+        detector = _qr_local.detector = cv2.QRCodeDetector()
+    return detector
 
 
 def detect_and_read_qrcodes(image, page_number=None):
-    """Lê QR codes usando OpenCV e retorna lista estruturada."""
+    """
+    Lê QR codes e retorna lista estruturada.
+    Usa pyzbar (uma passagem, todos os códigos) e OpenCV como fallback, também quando o
+    pyzbar não lê nenhum QR (o detector do OpenCV apanha alguns que o zbar falha).
+    Aceita uma imagem PIL ou um array numpy já convertido (sem nova cópia).
+    Sem pré-passagem numa cópia reduzida: abaixo de ~150 DPI os QR fiscais não são lidos
+    nem localizados (ver QR_SCAN_DPI), e as páginas sem QR pagariam as duas passagens.
+    """
     if not QR_CODE_ENABLED:
         return []
 
     try:
-        arr = np.array(image)
-        if len(arr.shape) == 3 and arr.shape[2] == 3:
+        if PYZBAR_AVAILABLE:
+            result = [_build_qr_info(symbol.data.decode("utf-8", errors="replace"), page_number)
+                      for symbol in zbar_decode(image, symbols=[ZBarSymbol.QRCODE])
+                      if symbol.data]
+            if result:
+                return result
+
+        arr = np.asarray(image)
+        # Página sem nenhum píxel escuro (em branco) não tem módulos de QR: salta o detector
+        if arr.size and arr.min() > QR_DARK_PIXEL_MAX:
+            return []
+        # Imagens em cinzento (ndim == 2) vão direto para o detector, sem cvtColor
+        if arr.ndim == 3 and arr.shape[2] == 3:
             arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
-        elif len(arr.shape) == 3 and arr.shape[2] == 4:
+        elif arr.ndim == 3 and arr.shape[2] == 4:
             arr = cv2.cvtColor(arr, cv2.COLOR_RGBA2BGR)
 
-        # Usa o detector de QR code do OpenCV
-        detector = cv2.QRCodeDetector()
-        data, vertices_array, _ = detector.detectAndDecode(arr)
+        # Detector de QR code do OpenCV: detectAndDecodeMulti (OpenCV 4.5.4+) já apanha
+        # o QR único, por isso só versões sem ele fazem o detectAndDecode
+        detector = _get_qr_detector()
+        if hasattr(detector, "detectAndDecodeMulti"):
+            found, decoded, _, _ = detector.detectAndDecodeMulti(arr)
+            decoded = decoded if found else ()
+        else:
+            data, vertices_array, _ = detector.detectAndDecode(arr)
+            decoded = (data,) if vertices_array is not None else ()
 
         result = []
-        if vertices_array is not None and data:
-            print(f"✅ QR: {data[:80]}…")
-
-            # Tenta parsear QR code fiscal português
-            parsed = parse_qrcode_fiscal_pt(data)
-            if parsed:
-                # Se parseou com sucesso, coloca os dados estruturados no campo "data"
-                qr_info = {"data": parsed, "raw_data": data}
-            else:
-                # Se não conseguiu parsear, mantém como string
-                qr_info = {"data": data}
-
-            if page_number is not None:
-                qr_info["page"] = page_number
-
-            result.append(qr_info)
-
-        # Tenta detectar múltiplos QR codes (OpenCV 4.5.4+)
-        try:
-            multi_data = detector.detectAndDecodeMulti(arr)
-            if multi_data[0]:  # Se detectou algum
-                for i, qr_data in enumerate(multi_data[1]):
-                    # Verifica se já não foi adicionado
-                    already_added = False
-                    for existing in result:
-                        if existing.get("raw_data") == qr_data or existing.get(
-                                "data") == qr_data:
-                            already_added = True
-                            break
-
-                    if qr_data and not already_added:
-                        print(f"✅ QR: {qr_data[:80]}…")
-
-                        # Tenta parsear QR code fiscal português
-                        parsed = parse_qrcode_fiscal_pt(qr_data)
-                        if parsed:
-                            qr_info = {"data": parsed, "raw_data": qr_data}
-                        else:
-                            qr_info = {"data": qr_data}
-
-                        if page_number is not None:
-                            qr_info["page"] = page_number
-
-                        result.append(qr_info)
-        except:
-            pass  # Versão do OpenCV pode não suportar detectAndDecodeMulti
+        seen = set()  # conteúdo bruto dos QR já adicionados
+        for qr_data in decoded:
+            if qr_data and qr_data not in seen:
+                seen.add(qr_data)
+                result.append(_build_qr_info(qr_data, page_number))
 
         return result
     except Exception as e:
-        print(f"⚠️ QR erro: {e}")
+        logger.warning("⚠️ QR erro: %s", e)
         return []
 
 
-def extract_text_from_pdf_with_ocr(file_path: str):
-    """Converte todas as páginas para imagem e aplica PaddleOCR (ou Tesseract como fallback)."""
-    import time
-    import numpy as np
+def _ocr_page(page, page_number: int, total_pages: int, ocr_engine: str, scan_qr: bool = True):
+    """
+    QR + OCR de uma página (cascata PaddleOCR → EasyOCR → Tesseract).
+    scan_qr=False quando os QR da página já foram (ou vão ser) lidos noutra passagem.
+    
+    Returns:
+        tuple: (page_number, page_text, qr_codes)
+    """
+    logger.info("🔍 Página %d/%d - %s", page_number, total_pages, ocr_engine)
+    
+    page_start = time.time()
+    
+    # QR numa thread à parte, em paralelo com o OCR (OpenCV/zbar e os motores OCR
+    # libertam o GIL); shutdown(wait=False) deixa a tarefa submetida terminar sozinha
+    # Página convertida para numpy uma única vez: QR, PaddleOCR e EasyOCR partilham o array
+    img_array = np.asarray(page)
+    qr_future = None
+    if scan_qr:
+        qr_executor = ThreadPoolExecutor(max_workers=1)
+        qr_future = qr_executor.submit(detect_and_read_qrcodes, img_array, page_number)
+        qr_executor.shutdown(wait=False)
+    
+    # OCR da página - cascata de 3 níveis
+    paddle_ocr = get_paddle_ocr()
+    page_text = ""
+    paddle_failed = False
+    easy_failed = False
+    ocr_engine_used = None
+    
     try:
-        # Tenta usar PaddleOCR primeiro
-        paddle_ocr = get_paddle_ocr()
+        # Nível 1: PaddleOCR (rápido e preciso)
+        if paddle_ocr:
+            try:
+                page_text = _paddle_text(paddle_ocr, img_array)
+                
+                if page_text.strip():
+                    ocr_engine_used = "PaddleOCR"
+                else:
+                    paddle_failed = True
+                    logger.info("⚠️ PaddleOCR não extraiu texto da página %d, tentando EasyOCR...", page_number)
+            except Exception as paddle_error:
+                paddle_failed = True
+                logger.warning("⚠️ PaddleOCR falhou na página %d: %s, tentando EasyOCR...",
+                               page_number, paddle_error)
+        
+        # Nível 2: EasyOCR (se PaddleOCR falhou)
+        if (not paddle_ocr or paddle_failed) and not page_text.strip():
+            easy_ocr = get_easy_ocr()
+            if easy_ocr:
+                try:
+                    page_text = _easyocr_text(easy_ocr, img_array)
+                    
+                    if page_text.strip():
+                        ocr_engine_used = "EasyOCR"
+                    else:
+                        easy_failed = True
+                        logger.info("⚠️ EasyOCR não extraiu texto da página %d, tentando Tesseract...",
+                                    page_number)
+                except Exception as easy_error:
+                    easy_failed = True
+                    logger.warning("⚠️ EasyOCR falhou na página %d: %s, tentando Tesseract...",
+                                   page_number, easy_error)
+        
+        # Nível 3: Tesseract (fallback final)
+        if not page_text.strip():
+            page_text = tesseract_ocr(img_array, psm=3)
+            if page_text.strip():
+                ocr_engine_used = "Tesseract"
+        
+        if page_text.strip() and ocr_engine_used:
+            logger.info("✅ Página %d processada com %s", page_number, ocr_engine_used)
+            
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            logger.warning("⚠️ Timeout OCR na página %d - imagem de má qualidade", page_number)
+        else:
+            raise
+    except Exception as e:
+        logger.warning("⚠️ Erro OCR na página %d: %s", page_number, e)
+    
+    qr_codes = qr_future.result() if qr_future is not None else []
+    
+    page_time = time.time() - page_start
+    if page_time > 10:
+        logger.warning("⚠️ Página %d demorou %.1fs - qualidade baixa", page_number, page_time)
+    
+    return page_number, page_text, qr_codes
+
+
+def _ocr_one_page(raster: tuple, page_number: int, total_pages: int, ocr_engine: str,
+                  scan_qr: bool = True):
+    """Worker do ProcessPoolExecutor: recebe a página em bruto (mode, size, samples) e aplica _ocr_page."""
+    mode, size, samples = raster
+    page = Image.frombytes(mode, size, samples)
+    return _ocr_page(page, page_number, total_pages, ocr_engine, scan_qr)
+
+
+# Resolução das páginas para OCR (e para os QR lidos da mesma imagem). 300 DPI por omissão:
+# abaixo disso os QR fiscais pequenos deixam de ser lidos (ver QR_SCAN_DPI); baixar via
+# OCR_DPI só compensa em instalações sem QR codes (menos píxeis → OCR mais rápido).
+OCR_DPI = int(os.environ.get("OCR_DPI", "300"))
+
+
+def _iter_pages(file_path: str, dpi: int = OCR_DPI, grayscale: bool = True, max_pages: int = None,
+                page_filter=None):
+    """
+    Rasteriza o PDF uma página de cada vez: QR e OCR usam a mesma imagem e só há
+    uma página em memória de cada vez. É o único rasterizador do módulo: PyMuPDF
+    renderiza no próprio processo (sem pdftoppm nem ficheiros temporários); o pdf2image
+    (JPEG, pdftoppm com várias threads) só é importado e usado se não houver PyMuPDF.
+    Por omissão em tons de cinzento (1/3 dos bytes do RGB) e a OCR_DPI.
+    max_pages limita a renderização às primeiras páginas; page_filter (página PyMuPDF → bool)
+    salta as páginas que não precisam de ser renderizadas (sem PyMuPDF é ignorado).
+    
+    Yields:
+        tuple: (page_number, total_pages, imagem PIL)
+    """
+    if PYMUPDF_AVAILABLE:
+        import pymupdf as fitz
+        with fitz.open(file_path) as doc:
+            total_pages = doc.page_count
+            for i, pdf_page in enumerate(doc.pages(0, max_pages), start=1):
+                if page_filter is not None and not page_filter(pdf_page):
+                    continue
+                pix = pdf_page.get_pixmap(dpi=dpi, alpha=False,
+                                          colorspace=fitz.csGRAY if grayscale else fitz.csRGB)
+                mode = "L" if grayscale else "RGB"
+                yield i, total_pages, Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+                del pix
+        return
+    
+    # Último recurso sem PyMuPDF: pdftoppm em subprocesso (importado só aqui). As páginas
+    # ficam em ficheiros num diretório temporário e são abertas uma a uma, em vez de
+    # todas descodificadas em memória antes da primeira ser usada
+    from pdf2image import convert_from_path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_paths = convert_from_path(file_path, dpi=dpi, fmt="jpeg", grayscale=grayscale,
+                                       last_page=max_pages, thread_count=os.cpu_count() or 1,
+                                       output_folder=tmp_dir, paths_only=True)
+        total_pages = len(page_paths)
+        for i, page_path in enumerate(page_paths, start=1):
+            page = Image.open(page_path)
+            page.load()  # descodifica já e fecha o ficheiro (o diretório é apagado no fim)
+            yield i, total_pages, page
+            del page
+
+
+# Resolução da passagem só-QR (PDFs com texto embutido). Não baixar: a 150 DPI nenhum dos
+# QR fiscais das faturas reais é lido (nem localizado nas FWH), e re-renderizar a 300 DPI
+# as páginas sem QR tornaria a passagem mais lenta do que renderizar logo a 300.
+QR_SCAN_DPI = 300
+
+
+def _page_may_have_qr(page) -> bool:
+    """
+    Um QR numa página PDF é uma imagem ou um desenho vetorial (retângulos preenchidos):
+    páginas só com texto não precisam de ser renderizadas para a procura de QR.
+    """
+    return bool(page.get_image_info()) or bool(page.get_cdrawings())
+
+
+def scan_pdf_qrcodes(file_path: str, dpi: int = QR_SCAN_DPI):
+    """
+    Procura QR codes nas páginas do PDF (uma página renderizada de cada vez).
+    Com PyMuPDF, as páginas só de texto (sem imagens nem desenhos) não são renderizadas.
+    """
+    qr_codes = []
+    for page_num, _, page_img in _iter_pages(file_path, dpi=dpi, page_filter=_page_may_have_qr):
+        qr_codes.extend(detect_and_read_qrcodes(page_img, page_number=page_num))
+    return qr_codes
+
+
+def _tesseract_batch(page_paths: list, psm: int = 3):
+    """
+    OCR de várias páginas num único processo tesseract (ficheiro-lista com os caminhos),
+    carregando o modelo uma vez. Devolve o texto de cada página, pela mesma ordem.
+    """
+    list_path = os.path.splitext(page_paths[0])[0] + "_lista.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(page_paths) + "\n")
+    
+    try:
+        text = pytesseract.image_to_string(
+            list_path, config=f"--psm {psm} --oem 3 -l por", lang="por",
+            timeout=60 * len(page_paths))
+    except RuntimeError as e:
+        if "timeout" in str(e).lower():
+            logger.warning("⚠️ Timeout OCR nas páginas %s… - imagem de má qualidade", page_paths[0])
+            return [""] * len(page_paths)
+        raise
+    
+    # O tesseract separa as páginas com form feed (\x0c)
+    pages_text = text.split("\x0c")
+    return (pages_text + [""] * len(page_paths))[:len(page_paths)]
+
+
+def _ocr_pdf_tesseract_batch(file_path: str, scan_qr: bool = True):
+    """
+    OCR só com pytesseract (sem PaddleOCR/EasyOCR/tesserocr): em vez de um processo
+    tesseract por página, as páginas são gravadas num diretório temporário e divididas
+    em blocos contíguos, um processo tesseract por bloco (em paralelo). Os QR codes
+    são lidos (se scan_qr) numa thread à parte enquanto as páginas vão sendo renderizadas.
+    
+    Returns:
+        list: [(page_number, page_text, qr_codes), ...]
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=1) as qr_executor:
+        page_paths = []
+        qr_futures = []
+        for i, total_pages, page in _iter_pages(file_path):
+            # Cinzento (1 byte/pixel, binarizada só com TESSERACT_BINARIZE) → sempre PGM
+            path = os.path.join(tmp_dir, f"page_{i:04d}.pgm")
+            binarize_for_tesseract(page).save(path)
+            page_paths.append(path)
+            if scan_qr:
+                qr_futures.append(qr_executor.submit(detect_and_read_qrcodes, page, i))
+        
+        if not page_paths:
+            return []
+        
+        workers = max(1, min(os.cpu_count() or 1, len(page_paths)))
+        chunk_size = -(-len(page_paths) // workers)
+        chunks = [page_paths[k:k + chunk_size] for k in range(0, len(page_paths), chunk_size)]
+        logger.info("🔍 Tesseract em lote: %d páginas em %d processo(s)", len(page_paths), len(chunks))
+        with ThreadPoolExecutor(max_workers=len(chunks)) as ocr_executor:
+            texts = [t for chunk_texts in ocr_executor.map(_tesseract_batch, chunks) for t in chunk_texts]
+        
+        if not scan_qr:
+            return [(i, page_text, []) for i, page_text in enumerate(texts, start=1)]
+        return [(i, page_text, qr_future.result())
+                for i, (page_text, qr_future) in enumerate(zip(texts, qr_futures), start=1)]
+
+
+def extract_text_from_pdf_with_ocr(file_path: str, qr_codes: list = None):
+    """
+    Converte todas as páginas para imagem e aplica PaddleOCR (ou Tesseract como fallback).
+    As páginas são processadas em paralelo no pool de processos partilhado (get_ocr_pool,
+    uma página por tarefa) ou, se o único motor for o tesserocr, no pool de threads
+    (get_ocr_thread_pool);
+    só com pytesseract disponível, o Tesseract corre em lote (_ocr_pdf_tesseract_batch).
+    qr_codes: QR já lidos do PDF (ex: na passagem paralela ao OCR.space) - as páginas
+    não voltam a ser procuradas e estes são devolvidos.
+    """
+    scan_qr = qr_codes is None
+    try:
+        # Tenta usar PaddleOCR primeiro. O modelo não é carregado aqui: no caminho do pool
+        # cada worker carrega o seu, e numa só página _ocr_page carrega-o neste processo
+        paddle_ocr = _paddle_may_be_available()
         ocr_engine = "PaddleOCR" if paddle_ocr else "Tesseract"
         
-        print(f"📄 Converter PDF → imagens (OCR com {ocr_engine})…")
+        logger.info("📄 Converter PDF → imagens (OCR com %s)…", ocr_engine)
         
-        # Converter PDF → imagens primeiro
+        if not paddle_ocr and not TESSEROCR_AVAILABLE and importlib.util.find_spec("easyocr") is None:
+            results = _ocr_pdf_tesseract_batch(file_path, scan_qr)
+            return _join_ocr_pages(results, qr_codes)
+        
+        # Cada página é renderizada (cinzento, OCR_DPI) e enviada logo para
+        # os processos como bytes em bruto (sem encode/decode) ou, só com tesserocr, para
+        # as threads; a imagem é libertada a seguir e os resultados são juntos por nº de página.
+        # A página N+1 renderiza enquanto as anteriores estão em OCR, com no máximo
+        # OCR_MAX_PENDING_PAGES à espera (_submit_page)
         start_time = time.time()
-        pages = convert_from_path(file_path, dpi=300)  # DPI 300 para melhor qualidade
+        pages = _iter_pages(file_path)
+        first_page = next(pages, None)
+        total_pages = first_page[1] if first_page else 0
+        futures = []
+        if total_pages == 1:
+            pass  # uma só página: OCR mais abaixo, neste processo
+        elif not paddle_ocr and importlib.util.find_spec("easyocr") is None:
+            # Só tesserocr: threads no próprio processo, a imagem PIL segue sem cópia
+            executor = get_ocr_thread_pool()
+            for i, _, page in chain([first_page] if first_page else [], pages):
+                _submit_page(executor, futures, _ocr_page, page, i, total_pages, ocr_engine, scan_qr)
+        else:
+            executor = get_ocr_pool()
+            for i, _, page in chain([first_page] if first_page else [], pages):
+                raster = (page.mode, page.size, page.tobytes())
+                _submit_page(executor, futures, _ocr_one_page, raster, i, total_pages, ocr_engine,
+                             scan_qr)
         conversion_time = time.time() - start_time
         
         # Se conversão demorou muito (>20s), ficheiro pode ter problemas
         if conversion_time > 20:
-            print(f"⚠️ Conversão PDF demorou {conversion_time:.1f}s - possível ficheiro problemático")
+            logger.warning("⚠️ Conversão PDF demorou %.1fs - possível ficheiro problemático", conversion_time)
         
-        all_text = ""
-        all_qr_codes = []
-        
-        for i, page in enumerate(pages, 1):
-            print(f"🔍 Página {i}/{len(pages)} - {ocr_engine}")
-            
-            # Limite de tempo por página: 15 segundos
-            page_start = time.time()
-            
-            qr_codes = detect_and_read_qrcodes(page, page_number=i)
-            all_qr_codes.extend(qr_codes)
-            
-            # OCR da página - cascata de 3 níveis
-            page_text = ""
-            paddle_failed = False
-            easy_failed = False
-            ocr_engine_used = None
-            
-            try:
-                # Nível 1: PaddleOCR (rápido e preciso)
-                if paddle_ocr:
-                    try:
-                        img_array = np.array(page)
-                        result = paddle_ocr.ocr(img_array, cls=True)
-                        
-                        if result and result[0]:
-                            for line in result[0]:
-                                if line and len(line) >= 2:
-                                    text = line[1][0]
-                                    confidence = line[1][1]
-                                    if confidence > 0.5:
-                                        page_text += text + "\n"
-                        
-                        if page_text.strip():
-                            ocr_engine_used = "PaddleOCR"
-                        else:
-                            paddle_failed = True
-                            print(f"⚠️ PaddleOCR não extraiu texto da página {i}, tentando EasyOCR...")
-                    except Exception as paddle_error:
-                        paddle_failed = True
-                        print(f"⚠️ PaddleOCR falhou na página {i}: {paddle_error}, tentando EasyOCR...")
-                
-                # Nível 2: EasyOCR (se PaddleOCR falhou)
-                if (not paddle_ocr or paddle_failed) and not page_text.strip():
-                    easy_ocr = get_easy_ocr()
-                    if easy_ocr:
-                        try:
-                            import numpy as np
-                            img_array = np.array(page)
-                            result = easy_ocr.readtext(img_array)
-                            
-                            if result:
-                                for detection in result:
-                                    text = detection[1]
-                                    confidence = detection[2]
-                                    if confidence > 0.3:
-                                        page_text += text + " "
-                                page_text = page_text.strip() + "\n"
-                            
-                            if page_text.strip():
-                                ocr_engine_used = "EasyOCR"
-                            else:
-                                easy_failed = True
-                                print(f"⚠️ EasyOCR não extraiu texto da página {i}, tentando Tesseract...")
-                        except Exception as easy_error:
-                            easy_failed = True
-                            print(f"⚠️ EasyOCR falhou na página {i}: {easy_error}, tentando Tesseract...")
-                
-                # Nível 3: Tesseract (fallback final)
-                if not page_text.strip():
-                    page_text = pytesseract.image_to_string(
-                        page, config="--psm 3 --oem 3 -l por", lang="por", timeout=60)
-                    if page_text.strip():
-                        ocr_engine_used = "Tesseract"
-                
-                if page_text.strip():
-                    all_text += f"\n--- Página {i} ---\n{page_text}\n"
-                    if ocr_engine_used:
-                        print(f"✅ Página {i} processada com {ocr_engine_used}")
-                    
-            except RuntimeError as e:
-                if "timeout" in str(e).lower():
-                    print(f"⚠️ Timeout OCR na página {i} - imagem de má qualidade")
-                else:
-                    raise
-            except Exception as e:
-                print(f"⚠️ Erro OCR na página {i}: {e}")
-            
-            page_time = time.time() - page_start
-            if page_time > 10:
-                print(f"⚠️ Página {i} demorou {page_time:.1f}s - qualidade baixa")
+        if total_pages == 1:
+            # Corre já neste processo (sem cópia da imagem nem arranque de workers)
+            results = [_ocr_page(first_page[2], 1, 1, ocr_engine, scan_qr)]
+        else:
+            results = sorted((f.result() for f in futures), key=lambda r: r[0])
         
-        print(f"✅ OCR completo: {len(pages)} páginas")
-        return all_text.strip(), all_qr_codes
+        return _join_ocr_pages(results, qr_codes)
+    except BrokenProcessPool as e:
+        logger.error("❌ OCR PDF erro (pool de processos): %s", e)
+        _reset_ocr_pool()
+        return "", qr_codes or []
     except Exception as e:
-        print(f"❌ OCR PDF erro: {e}")
-        return "", []
+        logger.error("❌ OCR PDF erro: %s", e)
+        return "", qr_codes or []
+
+
+def _join_ocr_pages(results: list, qr_codes: list = None):
+    """
+    Junta [(page_number, page_text, qr_codes), ...] no texto final com marcadores de página.
+    qr_codes (já lidos fora do OCR) substitui os QR das páginas.
+    """
+    all_text = ""
+    all_qr_codes = []
+    for i, page_text, page_qr_codes in results:
+        all_qr_codes.extend(page_qr_codes)
+        if page_text.strip():
+            all_text += f"\n--- Página {i} ---\n{page_text}\n"
+    
+    logger.info("✅ OCR completo: %d páginas", len(results))
+    return all_text.strip(), all_qr_codes if qr_codes is None else qr_codes
 
 
 def extract_text_from_image(file_path: str):
     """OCR para imagem com cascata de 3 níveis: PaddleOCR → EasyOCR → Tesseract."""
-    import numpy as np
     try:
         img = Image.open(file_path)
-        qr_codes = detect_and_read_qrcodes(img)
+        # Convertida para numpy uma única vez (QR, PaddleOCR e EasyOCR)
+        img_array = np.asarray(img)
+        qr_codes = detect_and_read_qrcodes(img_array)
         
         ocr_text = ""
         paddle_failed = False
@@ -993,116 +1838,178 @@ def extract_text_from_image(file_path: str):
         paddle_ocr = get_paddle_ocr()
         if paddle_ocr:
             try:
-                img_array = np.array(img)
-                result = paddle_ocr.ocr(img_array, cls=True)
-                
-                if result and result[0]:
-                    for line in result[0]:
-                        if line and len(line) >= 2:
-                            text = line[1][0]
-                            confidence = line[1][1]
-                            if confidence > 0.5:
-                                ocr_text += text + "\n"
+                ocr_text = _paddle_text(paddle_ocr, img_array)
                 
                 if ocr_text.strip():
                     ocr_engine_used = "PaddleOCR"
                 else:
                     paddle_failed = True
-                    print(f"⚠️ PaddleOCR não extraiu texto da imagem, tentando EasyOCR...")
+                    logger.warning("⚠️ PaddleOCR não extraiu texto da imagem, tentando EasyOCR...")
             except Exception as paddle_error:
                 paddle_failed = True
-                print(f"⚠️ PaddleOCR falhou: {paddle_error}, tentando EasyOCR...")
+                logger.warning("⚠️ PaddleOCR falhou: %s, tentando EasyOCR...", paddle_error)
         
         # Nível 2: EasyOCR (se PaddleOCR falhou)
         if (not paddle_ocr or paddle_failed) and not ocr_text.strip():
             easy_ocr = get_easy_ocr()
             if easy_ocr:
                 try:
-                    img_array = np.array(img)
-                    result = easy_ocr.readtext(img_array)
-                    
-                    if result:
-                        for detection in result:
-                            text = detection[1]
-                            confidence = detection[2]
-                            if confidence > 0.3:
-                                ocr_text += text + " "
-                        ocr_text = ocr_text.strip() + "\n"
+                    ocr_text = _easyocr_text(easy_ocr, img_array)
                     
                     if ocr_text.strip():
                         ocr_engine_used = "EasyOCR"
                     else:
                         easy_failed = True
-                        print(f"⚠️ EasyOCR não extraiu texto da imagem, tentando Tesseract...")
+                        logger.warning("⚠️ EasyOCR não extraiu texto da imagem, tentando Tesseract...")
                 except Exception as easy_error:
                     easy_failed = True
-                    print(f"⚠️ EasyOCR falhou: {easy_error}, tentando Tesseract...")
+                    logger.warning("⚠️ EasyOCR falhou: %s, tentando Tesseract...", easy_error)
         
         # Nível 3: Tesseract (fallback final)
         if not ocr_text.strip():
-            ocr_text = pytesseract.image_to_string(img,
-                                                   config="--psm 6 --oem 3 -l por",
-                                                   lang="por")
+            # tesserocr em processo (API por thread já carregada); pytesseract só sem ele
+            ocr_text = tesseract_ocr(img, psm=6)
             if ocr_text.strip():
                 ocr_engine_used = "Tesseract"
         
         if ocr_engine_used:
-            print(f"✅ Imagem processada com {ocr_engine_used}")
+            logger.info("✅ Imagem processada com %s", ocr_engine_used)
         
         return ocr_text.strip(), qr_codes
     except Exception as e:
-        print(f"❌ OCR imagem erro: {e}")
+        logger.error("❌ OCR imagem erro: %s", e)
         return "", []
 
 
 # ----------------- PARSE: heurísticas PT -----------------
 
-
-def extract_guia_remessa_products(text: str):
+# Regexes compiladas uma vez ao importar o módulo (os parsers correm-nas linha a linha)
+
+# Guia de Remessa genérica (extract_guia_remessa_products)
+_RE_GR_REF = re.compile(
+    r"^\s*(\d[A-Z]{2,6}\s+N[oº°]\s*\d+[/\-]\d+[A-Z]{0,4}\s+de\s+\d{2}-\d{2}-\d{4})",
+    re.IGNORECASE)
+# Formato: E0748001901  131,59 1  34,00 3,00 ML 3,99 23,00 5159-250602064 BALTIC fb, TOFFEE
+# Artigo: letras + números (mais flexível)
+# Volume: pode ser decimal
+# Lote: pode estar vazio ou ter vários formatos
+# Unidade: pode ter 2-10 caracteres
+_RE_GR_PRODUCT = re.compile(
+    r"^([A-Z]+\d+[A-Z0-9]*)\s+"  # Artigo (flexível: E0748001901, ABC123, etc.)
+    r"([\d,\.]+)\s+"  # Total
+    r"([\d,\.]+)\s+"  # Volume (aceita decimais)
+    r"([\d,\.]+)\s+"  # Quantidade
+    r"([\d,\.]+)\s+"  # Desconto
+    r"([A-Z]{2,10})\s+"  # Unidade (mais flexível)
+    r"([\d,\.]+)\s+"  # Preço Unitário
+    r"([\d,\.]+)\s+"  # IVA
+    r"([\w\-#]*)\s*"  # Lote (opcional, pode estar vazio)
+    r"(.+?)\s*$",  # Descrição (resto da linha)
+    re.IGNORECASE)
+
+# Guia genérica
+_RE_PEDIDO = re.compile(r'(?:PEDIDO|ORDER|ENCOMENDA)\s*[:/]?\s*(\d+)', re.IGNORECASE)
+_RE_GEN_CODIGO = re.compile(r'^([A-Z0-9]{8,})\s+(.+)', re.IGNORECASE)
+# Procurar: [número] [espaço(s)] [UNIDADE] - unidades de quantidade (não peso):
+# UN, MT, M2, M², PC, CX, etc. KG/G (peso) ficam de fora
+_RE_GEN_QTD = re.compile(
+    r'([\d,\.]+)\s+(UN|UNI|UNID|UNIDADES|MT|M2|M²|M3|M³|ML|L|CX|PC|PCS|PAR|SET|RL|FD|PAC)\b',
+    re.IGNORECASE)
+_RE_PRODUTO_GEN = re.compile(
+    r'^([A-Z0-9]{8,})\s+'
+    r'(.+?)\s+'
+    r'([\d,\.]+)\s+'
+    r'([A-Z]{2,4})(?:\s|$)',
+    re.IGNORECASE)
+_RE_DIMS = re.compile(r'(\d{3,4})[xX×](\d{3,4})[xX×](\d{3,4})')
+# Linhas que algum dos padrões acima pode aceitar: começam por um código (8+ alfanuméricos
+# seguidos de espaço) ou têm PEDIDO/ORDER/ENCOMENDA. Um finditer sobre o texto todo
+# encontra-as; as restantes linhas nunca chegam ao Python
+_RE_GEN_CANDIDATE = re.compile(
+    r'^[^\S\n]*(?:[A-Z0-9]{8,}[^\S\n]|[^\n]*?(?:PEDIDO|ORDER|ENCOMENDA))[^\n]*',
+    re.IGNORECASE | re.MULTILINE)
+
+# Cabeçalho / totais (parse_portuguese_document)
+_RE_REQ = re.compile(r"(?:req|requisição)\.?\s*n?[oº]?\s*:?\s*([A-Z0-9\-/]+)", re.IGNORECASE)
+_RE_DOC = re.compile(r"(?:guia|gr|documento|fatura)\.?\s*n?[oº]?\s*:?\s*([A-Z0-9\-/]+)", re.IGNORECASE)
+_RE_DATA = re.compile(r"(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})")
+_RE_FORN = re.compile(r"(?:fornecedor|empresa)\.?\s*:?\s*([^\n]+)", re.IGNORECASE)
+_RE_OC_NUMBER = re.compile(r'ORDEM\s+COMPRA\s+N[ºo]?\s*([A-Z0-9]+)', re.IGNORECASE)
+_RE_PO_REF = re.compile(r'^([A-Z0-9]+)\s+[NnºN]', re.IGNORECASE)
+
+# Ordem de compra (parse_ordem_compra)
+# Linha de quantidade: 1.000 UN 2025-10-17 [texto opcional]
+_RE_OC_QTY = re.compile(r'^([\d,\.]+)\s+([A-Za-z]{2,4})(?:\s+(\d{4}-\d{2}-\d{2}))?')
+# Linha de referência: 26.100145 COLCHAO 1,95X1,40=27"SPA CHERRY VISCO"COLMOL
+_RE_OC_REF = re.compile(r'^(\d+\.\d+)\s+(.+)$')
+_OC_UNIDADES_VALIDAS = frozenset({'UN', 'UNI', 'UNID', 'PC', 'PCS', 'KG', 'G', 'M', 'M2', 'M3', 'L', 'ML',
+                                  'CX', 'PAR', 'PAC', 'SET', 'RL', 'FD'})
+_RE_OC_DIMS = re.compile(r'(\d),(\d{2})[xX×](\d),(\d{2})')
+# Linhas de quantidade e de referência começam por dígito, vírgula ou ponto: um finditer
+# sobre o texto todo encontra-as; as restantes linhas nunca chegam ao Python
+_RE_OC_CANDIDATE = re.compile(r'^[^\S\n]*([\d,.][^\n]*)', re.MULTILINE)
+
+# Bon de commande (parse_bon_commande)
+_RE_BC_CLIENTE = re.compile(r'ADRESSE DE LIVRAISON\s+([^\n]+)', re.IGNORECASE)
+_RE_BC_DATA = re.compile(r'DATE\s*:\s*(\d{2}\.\d{2}\.\d{2})', re.IGNORECASE)
+_RE_BC_CONTREMARQUE = re.compile(r'CONTREMARQUE\s*:\s*([^\n]+)', re.IGNORECASE)
+_RE_BC_HEADER = re.compile(r'Désignation.*Quantité.*Prix', re.IGNORECASE)
+_RE_BC_END = re.compile(r'^TOTAL|^ADRESSE|^BON DE COMMANDE', re.IGNORECASE)
+# [PRODUTO com possíveis dimensões] [QTY] [PREÇO€] [TOTAL€]
+_RE_BC_PRODUTO = re.compile(r'^(.+?)\s+(\d+)\s+([\d,\.]+)\s*€\s+([\d,\.]+)\s*€')
+_RE_BC_DIMS = re.compile(r'(\d{2,3})\s*[xX×]\s*(\d{2,3})')
+_RE_BC_CODIGO = re.compile(r'^([A-Z\s]+?)\s+\d')
+
+# Pedido espanhol (parse_pedido_espanhol)
+_RE_ES_PEDIDO = re.compile(r'(?:Pedido|Número).*?(\d+)', re.IGNORECASE)
+_RE_ES_FECHA = re.compile(r'Fecha.*?(\d{2}/\d{2}/\d{4})', re.IGNORECASE)
+_RE_ES_PROVEEDOR = re.compile(r'Proveedor.*?([A-Z\s\.]+)', re.IGNORECASE)
+_RE_ES_HEADER = re.compile(r'Artículo|Descripción|Cantidad|Código', re.IGNORECASE)
+_RE_ES_END = re.compile(r'^Total|^Importe neto|^Notas|^Plazo|^Base I\.V\.A', re.IGNORECASE)
+_RE_ES_QTY_LINE = re.compile(r'^[\d,]+$')
+_RE_ES_CODE_LINE = re.compile(r'^[A-Z0-9]{6,}$')
+# Formatos 1B (DESCRIPCIÓN CÓDIGO TOTAL PRECIO UNIDADES) e 1 (CÓDIGO DESCRIPCIÓN UNIDADES
+# PRECIO IMPORTE) partilham os três números finais: uma só regex para a cauda e o código é
+# um token inteiro antes dela, sem os dois `(.+?)` sobre a linha toda
+_RE_ES_TAIL3 = re.compile(r'\s+([\d,]+)\s+([\d,]+)\s+([\d,]+)$')
+_RE_ES_CODE_TOKEN = re.compile(r'[A-Z0-9]{4,}')
+# Formato 2: CÓDIGO DESCRIPCIÓN CANTIDAD
+_RE_ES_FORMATO2 = re.compile(r'^([A-Z0-9]{6,})\s+(.+?)\s+([\d,]+)$')
+_RE_ES_DIMS = re.compile(r'(\d{2,3})[xX×](\d{2,3})')
+# Palavras de endereço (falsos positivos na descrição): uma só passagem em C sobre a
+# descrição em vez de um `in` por palavra
+_RE_ES_ADDRESS_WORDS = re.compile(r'POLIGONO|NAVE|CALLE|RUA|AVENIDA|ZONA|INDUSTRIAL')
+# Os formatos 1, 1B e 2 terminam todos num número ([\d,]+$): linhas com outro último
+# carácter saltam as três regexes
+_ES_LINE_END_CHARS = frozenset('0123456789,')
+
+# Janela do cabeçalho (req/doc/data/fornecedor) e do rodapé (só fornecedor)
+HEADER_SCAN_LINES = 80
+FOOTER_SCAN_LINES = 40
+
+
+def extract_guia_remessa_products(text: str, lines=None):
     """
     Extrai produtos da tabela de Guia de Remessa com parser flexível.
     Campos: Artigo, Descrição, Lote Produção, Quant., Un., Vol., Preço Un., Desconto, Iva, Total
     """
     products = []
-    lines = text.split("\n")
+    if lines is None:
+        lines = text.split("\n")
 
     current_ref = ""
 
-    # Regex para detectar referências de ordem (mais flexível)
-    ref_pattern = re.compile(
-        r"^\s*(\d[A-Z]{2,6}\s+N[oº°]\s*\d+[/\-]\d+[A-Z]{0,4}\s+de\s+\d{2}-\d{2}-\d{4})",
-        re.IGNORECASE)
-
-    # Regex mais flexível para linha de produto
-    # Formato: E0748001901  131,59 1  34,00 3,00 ML 3,99 23,00 5159-250602064 BALTIC fb, TOFFEE
-    # Artigo: letras + números (mais flexível)
-    # Volume: pode ser decimal
-    # Lote: pode estar vazio ou ter vários formatos
-    # Unidade: pode ter 2-10 caracteres
-    product_pattern = re.compile(
-        r"^([A-Z]+\d+[A-Z0-9]*)\s+"  # Artigo (flexível: E0748001901, ABC123, etc.)
-        r"([\d,\.]+)\s+"  # Total
-        r"([\d,\.]+)\s+"  # Volume (aceita decimais)
-        r"([\d,\.]+)\s+"  # Quantidade
-        r"([\d,\.]+)\s+"  # Desconto
-        r"([A-Z]{2,10})\s+"  # Unidade (mais flexível)
-        r"([\d,\.]+)\s+"  # Preço Unitário
-        r"([\d,\.]+)\s+"  # IVA
-        r"([\w\-#]*)\s*"  # Lote (opcional, pode estar vazio)
-        r"(.+?)\s*$",  # Descrição (resto da linha)
-        re.IGNORECASE)
-
     for line in lines:
         stripped = line.strip()
 
         # Verifica se é uma referência de ordem
-        ref_match = ref_pattern.match(stripped)
+        ref_match = _RE_GR_REF.match(stripped)
         if ref_match:
             current_ref = ref_match.group(1).strip()
             continue
 
         # Verifica se é uma linha de produto
-        prod_match = product_pattern.match(stripped)
+        prod_match = _RE_GR_PRODUCT.match(stripped)
         if prod_match:
             try:
                 artigo = prod_match.group(1).strip()
@@ -1137,204 +2044,75 @@ def extract_guia_remessa_products(text: str):
 
                 products.append(product)
             except (ValueError, IndexError) as e:
-                print(
-                    f"⚠️ Erro ao parsear linha de produto '{stripped[:50]}...': {e}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("⚠️ Erro ao parsear linha de produto '%s...': %s", stripped[:50], e)
                 continue
 
     if products:
-        print(f"✅ Extraídos {len(products)} produtos da Guia de Remessa")
+        logger.info("✅ Extraídos %d produtos da Guia de Remessa", len(products))
     else:
-        print("⚠️ Nenhum produto encontrado no formato Guia de Remessa")
+        logger.warning("⚠️ Nenhum produto encontrado no formato Guia de Remessa")
 
     return products
 
 
-def detect_document_type(text: str):
-    """Detecta automaticamente o tipo de documento português, francês e espanhol."""
-    text_lower = text.lower()
-    
-    # Documentos espanhóis
-    if ("pedido" in text_lower and ("españa" in text_lower or "spain" in text_lower)) or \
-       ("pedido" in text_lower and any(kw in text_lower for kw in ["artículo", "articulo", "descripción", "descripcion", "unidades", "cantidad"])):
-        return "PEDIDO_ESPANHOL"
-    
-    # Documentos franceses
-    if "bon de commande" in text_lower or ("commande" in text_lower and "désignation" in text_lower):
-        return "BON_COMMANDE"
-    
-    # Documentos portugueses
-    if "ordem compra" in text_lower or "ordem de compra" in text_lower:
-        return "ORDEM_COMPRA"
-    elif "elastron" in text_lower and "fatura" in text_lower:
-        return "FATURA_ELASTRON"
-    elif "colmol" in text_lower and ("guia" in text_lower or "comunicação de saída" in text_lower):
-        return "GUIA_COLMOL"
-    elif "fatura" in text_lower or "ft" in text_lower:
-        return "FATURA_GENERICA"
-    elif "guia de remessa" in text_lower or "guia remessa" in text_lower:
-        return "GUIA_GENERICA"
-    elif "recibo" in text_lower or "receipt" in text_lower:
-        return "RECIBO"
-    else:
-        return "DOCUMENTO_GENERICO"
-
-
-def parse_fatura_elastron(text: str):
-    """Parser específico para faturas Elastron (compatível com Tesseract)."""
-    produtos = []
-    lines = text.split("\n")
-    
-    current_ref = ""
-    for i, line in enumerate(lines):
-        line_stripped = line.strip()
-        
-        if re.match(r'^\d[A-Z]{4}\s+[NnºN]', line_stripped):
-            current_ref = line_stripped
-            continue
-        
-        artigo_match = re.match(r'^(E[O0]\d{9,10})\s+(.+)', line_stripped)
-        if artigo_match:
-            try:
-                artigo = artigo_match.group(1).replace('O', '0')
-                resto = artigo_match.group(2).strip()
-                
-                parts = resto.split()
-                if len(parts) < 6:
-                    continue
-                
-                # Tesseract format: TOTAL VOL QUANT DESC UNID PRECO IVA LOTE... DESCRICAO
-                # Encontrar unidade (ML, MT, UN)
-                unidade_idx = -1
-                unidade = "ML"
-                for idx, part in enumerate(parts):
-                    if part.upper() in ['ML', 'MT', 'UN', 'M²', 'M2']:
-                        unidade = part.upper()
-                        unidade_idx = idx
-                        break
-                
-                if unidade_idx < 3:
-                    continue
-                
-                # Campos antes da unidade: TOTAL VOL QUANT DESC
-                total = normalize_number(parts[0])
-                volume = int(parts[1]) if parts[1].isdigit() else 1
-                quantidade = normalize_number(parts[2])
-                desconto = normalize_number(parts[3])
-                
-                # Campos depois da unidade: PRECO IVA LOTE ... DESCRICAO
-                preco_un = normalize_number(parts[unidade_idx + 1]) if unidade_idx + 1 < len(parts) else 0.0
-                iva = normalize_number(parts[unidade_idx + 2]) if unidade_idx + 2 < len(parts) else 23.0
-                
-                # Lote e descrição
-                lote = ""
-                descricao = ""
-                if unidade_idx + 3 < len(parts):
-                    remaining = ' '.join(parts[unidade_idx + 3:])
-                    lote_match = re.search(r'(\d{4}-\d+(?:#)?)', remaining)
-                    if lote_match:
-                        lote = lote_match.group(1)
-                        descricao = remaining[lote_match.end():].strip()
-                    else:
-                        descricao = remaining
-                
-                produtos.append({
-                    "referencia_ordem": current_ref,
-                    "artigo": artigo,
-                    "descricao": descricao,
-                    "lote_producao": lote,
-                    "quantidade": quantidade,
-                    "unidade": unidade,
-                    "volume": volume,
-                    "preco_unitario": preco_un,
-                    "desconto": desconto,
-                    "iva": iva,
-                    "total": total
-                })
-            except (ValueError, IndexError) as e:
-                print(f"⚠️ Erro ao parsear linha Elastron '{line_stripped[:60]}': {e}")
-                continue
-    
-    return produtos
+# Palavras-chave da classificação de documentos, procuradas numa só passagem pelo texto.
+# O lookahead apanha ocorrências sobrepostas, mas a alternância do re é ordenada: no mesmo
+# ponto ganha a primeira alternativa que encaixa, não a mais longa. Por isso a regex junta-as
+# da mais longa para a mais curta ("guia de remessa" antes de "guia"), e "guia" é reposto
+# em detect_document_type quando só a forma longa foi encontrada.
+_DOC_TYPE_KEYWORDS = (
+    "pedido", "españa", "spain", "artículo", "articulo", "descripción", "descripcion",
+    "unidades", "cantidad", "bon de commande", "commande", "désignation",
+    "ordem compra", "ordem de compra", "elastron", "fatura", "colmol",
+    "guia de remessa", "guia remessa", "guia", "comunicação de saída",
+    "recibo", "receipt", "ft",
+)
+_DOC_TYPE_RE = re.compile(
+    "(?=(" + "|".join(re.escape(kw) for kw in sorted(_DOC_TYPE_KEYWORDS, key=len, reverse=True))
+    + "))", re.IGNORECASE)
+# Pedido espanhol: "pedido" + país ou cabeçalho de tabela
+_DOC_TYPE_ES_PAIS = frozenset({"españa", "spain"})
+_DOC_TYPE_ES_TABELA = frozenset({"artículo", "articulo", "descripción", "descripcion",
+                                 "unidades", "cantidad"})
 
 
-def parse_guia_colmol(text: str):
-    """Parser específico para Guias de Remessa Colmol."""
-    produtos = []
-    lines = text.split("\n")
-    
-    current_encomenda = ""
-    current_requisicao = ""
-    
-    for i, line in enumerate(lines):
-        line_stripped = line.strip()
-        
-        if "ENCOMENDA Nº" in line_stripped:
-            encomenda_match = re.search(r'ENCOMENDA Nº\.?\s*(\d+-\d+)', line_stripped)
-            requisicao_match = re.search(r'REQUISICAO Nº\.?\s*(\d+)', line_stripped)
-            if encomenda_match:
-                current_encomenda = encomenda_match.group(1)
-            if requisicao_match:
-                current_requisicao = requisicao_match.group(1)
-            continue
-        
-        if re.match(r'^[A-Z0-9]{10,}', line_stripped):
-            parts = line_stripped.split()
-            if len(parts) >= 8:
-                try:
-                    codigo = parts[0]
-                    
-                    descricao_parts = []
-                    j = 1
-                    # Parar na descrição quando encontrar: número decimal, unidade (UN/MT/ML), ou padrão CX.
-                    while j < len(parts):
-                        part = parts[j]
-                        # Número decimal (quantidade)
-                        if re.match(r'^\d+[.,]\d+$', part):
-                            break
-                        # Unidades conhecidas (às vezes vem antes da quantidade)
-                        if part.upper() in ['UN', 'MT', 'ML', 'M²', 'M2']:
-                            break
-                        # Padrão de dimensões (CX.1150x...)
-                        if re.match(r'^CX\.\d', part, re.IGNORECASE):
-                            descricao_parts.append(part)
-                            j += 1
-                            break
-                        descricao_parts.append(part)
-                        j += 1
-                    
-                    descricao = ' '.join(descricao_parts)
-                    
-                    # Agora procurar quantidade (pode ter espaços antes)
-                    while j < len(parts) and not re.match(r'^\d+[.,]\d+$', parts[j]):
-                        j += 1
-                    
-                    quantidade = normalize_number(parts[j]) if j < len(parts) else 0.0
-                    unidade = parts[j+1] if j+1 < len(parts) else "UN"
-                    med1 = normalize_number(parts[j+2]) if j+2 < len(parts) else 0.0
-                    med2 = normalize_number(parts[j+3]) if j+3 < len(parts) else 0.0
-                    med3 = normalize_number(parts[j+4]) if j+4 < len(parts) else 0.0
-                    peso = normalize_number(parts[j+5]) if j+5 < len(parts) else 0.0
-                    iva = normalize_number(parts[j+6]) if j+6 < len(parts) else 23.0
-                    
-                    produtos.append({
-                        "referencia_ordem": f"{current_encomenda} / Req {current_requisicao}",
-                        "artigo": codigo,
-                        "descricao": descricao,
-                        "lote_producao": "",
-                        "quantidade": quantidade,
-                        "unidade": unidade,
-                        "volume": 0,
-                        "dimensoes": f"{med1}x{med2}x{med3}",
-                        "peso": peso,
-                        "iva": iva,
-                        "total": 0.0
-                    })
-                except (ValueError, IndexError) as e:
-                    print(f"⚠️ Erro ao parsear linha Colmol: {e}")
-                    continue
+def detect_document_type(text: str):
+    """Detecta automaticamente o tipo de documento português, francês e espanhol."""
+    found = {m.group(1).lower() for m in _DOC_TYPE_RE.finditer(text)}
+    if "guia de remessa" in found or "guia remessa" in found:
+        found.add("guia")
     
-    return produtos
+    # Documentos espanhóis
+    if "pedido" in found and not (_DOC_TYPE_ES_PAIS.isdisjoint(found)
+                                  and _DOC_TYPE_ES_TABELA.isdisjoint(found)):
+        return "PEDIDO_ESPANHOL"
+    
+    # Documentos franceses
+    if "bon de commande" in found or ("commande" in found and "désignation" in found):
+        return "BON_COMMANDE"
+    
+    # Documentos portugueses
+    if "ordem compra" in found or "ordem de compra" in found:
+        return "ORDEM_COMPRA"
+    elif "elastron" in found and "fatura" in found:
+        return "FATURA_ELASTRON"
+    elif "colmol" in found and ("guia" in found or "comunicação de saída" in found):
+        return "GUIA_COLMOL"
+    elif "fatura" in found or "ft" in found:
+        return "FATURA_GENERICA"
+    elif "guia de remessa" in found or "guia remessa" in found:
+        return "GUIA_GENERICA"
+    elif "recibo" in found or "receipt" in found:
+        return "RECIBO"
+    else:
+        return "DOCUMENTO_GENERICO"
+
+
+@lru_cache(maxsize=4096)
+def _mm_to_m(mm: str) -> str:
+    """Medida de _RE_DIMS em mm ("1950") formatada em metros ("1.95"); em cache por valor."""
+    return f"{float(mm)/1000:.2f}"
 
 
 def parse_guia_generica(text: str):
@@ -1345,21 +2123,19 @@ def parse_guia_generica(text: str):
     Suporta formatos complexos onde descrição contém números:
     - CBAGD00067 CX EUROSPUMA 3044 VE 125,000 UN 1,880 0,150 0,080 84,600 KG
     - Extrai quantidade correta (125,000) ignorando números na descrição (3044)
+    
+    Só as linhas candidatas (_RE_GEN_CANDIDATE, uma passagem pelo texto) são analisadas,
+    por isso, ao contrário dos outros parsers, não recebe as linhas já separadas.
     """
     produtos = []
-    lines = text.split("\n")
-    
     pedido_atual = ""
     
-    # Unidades conhecidas (ordenadas por especificidade)
-    UNIDADES_CONHECIDAS = r'\b(UN|UNI|UNID|UNIDADES|MT|M2|M²|M3|M³|KG|G|ML|L|CX|PC|PCS|PAR|SET|RL|FD|PAC)\b'
-    
-    for i, line in enumerate(lines):
-        stripped = line.strip()
+    for candidate in _RE_GEN_CANDIDATE.finditer(text):
+        stripped = candidate.group().strip()
         if not stripped or len(stripped) < 10:
             continue
         
-        pedido_match = re.search(r'(?:PEDIDO|ORDER|ENCOMENDA)\s*[:/]?\s*(\d+)', stripped, re.IGNORECASE)
+        pedido_match = _RE_PEDIDO.search(stripped)
         if pedido_match:
             pedido_atual = pedido_match.group(1)
             continue
@@ -1369,20 +2145,13 @@ def parse_guia_generica(text: str):
         # Usar PRIMEIRA unidade de quantidade (não peso) e número adjacente
         # Exemplo: CBAGD00067 CX EUROSPUMA 3044 VE 125,000 UN 1,880 0,150 0,080 84,600 KG
         #          → quantidade=125,000 UN (não 84,600 KG que é peso)
-        codigo_match = re.match(r'^([A-Z0-9]{8,})\s+(.+)', stripped, re.IGNORECASE)
+        codigo_match = _RE_GEN_CODIGO.match(stripped)
         if codigo_match:
             codigo = codigo_match.group(1).strip()
             resto_linha = codigo_match.group(2).strip()
             
-            # Procurar padrão: [NÚMERO] [ESPAÇO] [UNIDADE_QUANTIDADE]
-            # Unidades de quantidade (não peso): UN, MT, M2, M², PC, CX, etc.
-            # Excluir KG/G (peso) da primeira procura
-            qtd_unidades = r'(UN|UNI|UNID|UNIDADES|MT|M2|M²|M3|M³|ML|L|CX|PC|PCS|PAR|SET|RL|FD|PAC)'
-            
-            # Procurar: [número] [espaço(s)] [UNIDADE]
-            # Regex: ([\d,\.]+)\s+(UN|MT|etc.)
-            qtd_pattern = rf'([\d,\.]+)\s+{qtd_unidades}\b'
-            qtd_match = re.search(qtd_pattern, resto_linha, re.IGNORECASE)
+            # Procurar padrão: [NÚMERO] [ESPAÇO] [UNIDADE_QUANTIDADE] (excluindo KG/G - peso)
+            qtd_match = _RE_GEN_QTD.search(resto_linha)
             
             if qtd_match:
                 quantidade_str = qtd_match.group(1).strip()
@@ -1392,16 +2161,17 @@ def parse_guia_generica(text: str):
                 pos_qtd_inicio = qtd_match.start()
                 descricao = resto_linha[:pos_qtd_inicio].strip()
                 
-                print(f"✅ Parser genérico Estratégia 1: {codigo} | {descricao} | {quantidade_str} {unidade}")
+                logger.debug("✅ Parser genérico Estratégia 1: %s | %s | %s %s",
+                             codigo, descricao, quantidade_str, unidade)
                 
                 try:
                     # Usar função de normalização (3 casas decimais = milhares)
                     quantidade = normalize_number(quantidade_str)
                     
                     dims = ""
-                    dim_match = re.search(r'(\d{3,4})[xX×](\d{3,4})[xX×](\d{3,4})', descricao)
+                    dim_match = _RE_DIMS.search(descricao)
                     if dim_match:
-                        dims = f"{float(dim_match.group(1))/1000:.2f}x{float(dim_match.group(2))/1000:.2f}x{float(dim_match.group(3))/1000:.2f}"
+                        dims = "x".join(map(_mm_to_m, dim_match.groups()))
                     
                     produtos.append({
                         "referencia_ordem": pedido_atual or "",
@@ -1418,18 +2188,11 @@ def parse_guia_generica(text: str):
                     })
                     continue
                 except ValueError as e:
-                    print(f"⚠️ Erro conversão quantidade: {e}")
+                    logger.debug("⚠️ Erro conversão quantidade: %s", e)
                     pass
         
         # Estratégia 2 (fallback): Regex original para formatos simples
-        produto_match = re.match(
-            r'^([A-Z0-9]{8,})\s+'
-            r'(.+?)\s+'
-            r'([\d,\.]+)\s+'
-            r'([A-Z]{2,4})(?:\s|$)',
-            stripped,
-            re.IGNORECASE
-        )
+        produto_match = _RE_PRODUTO_GEN.match(stripped)
         
         if produto_match:
             codigo = produto_match.group(1).strip()
@@ -1443,9 +2206,9 @@ def parse_guia_generica(text: str):
                 continue
             
             dims = ""
-            dim_match = re.search(r'(\d{3,4})[xX×](\d{3,4})[xX×](\d{3,4})', descricao)
+            dim_match = _RE_DIMS.search(descricao)
             if dim_match:
-                dims = f"{float(dim_match.group(1))/1000:.2f}x{float(dim_match.group(2))/1000:.2f}x{float(dim_match.group(3))/1000:.2f}"
+                dims = "x".join(map(_mm_to_m, dim_match.groups()))
             
             produtos.append({
                 "referencia_ordem": pedido_atual or "",
@@ -1468,32 +2231,31 @@ def parse_ordem_compra(text: str):
     """
     Parser específico para Ordens de Compra com linhas separadas.
     Formato: Referência + Descrição numa linha, Quantidade + Unidade + Data noutra linha.
+    
+    Só as linhas candidatas (_RE_OC_CANDIDATE, uma passagem pelo texto) são analisadas,
+    por isso, ao contrário dos outros parsers, não recebe as linhas já separadas.
     """
     produtos = []
-    lines = text.split("\n")
     
     # Encontrar referências de produtos
     referencias = []
     quantidades = []
     
-    for line in lines:
-        stripped = line.strip()
-        if not stripped:
-            continue
+    for candidate in _RE_OC_CANDIDATE.finditer(text):
+        stripped = candidate.group(1).rstrip()
         
         # Detectar linha de quantidade + unidade PRIMEIRO (mais específico)
         # Formato: 1.000 UN 2025-10-17 [texto opcional]
         # Aceita: uppercase/lowercase units, data opcional, texto trailing opcional
         # Exemplo: "1.000 UN 2025-10-17", "1.000 un", "3.5 KG 2025-10-17 RECEBIDO"
-        qty_match = re.match(r'^([\d,\.]+)\s+([A-Za-z]{2,4})(?:\s+(\d{4}-\d{2}-\d{2}))?', stripped)
+        qty_match = _RE_OC_QTY.match(stripped)
         if qty_match:
             quantidade_str = qty_match.group(1)
             unidade = qty_match.group(2).upper()
             data_entrega = qty_match.group(3) if qty_match.group(3) else ""
             
             # Validar unidade: lista de unidades conhecidas OU tem data (evita false positives)
-            unidades_validas = {'UN', 'UNI', 'UNID', 'PC', 'PCS', 'KG', 'G', 'M', 'M2', 'M3', 'L', 'ML', 'CX', 'PAR', 'PAC', 'SET', 'RL', 'FD'}
-            is_valid_unit = unidade in unidades_validas or data_entrega
+            is_valid_unit = unidade in _OC_UNIDADES_VALIDAS or data_entrega
             
             if is_valid_unit:
                 try:
@@ -1519,7 +2281,7 @@ def parse_ordem_compra(text: str):
         # Detectar linha de referência + descrição (menos específico)
         # Formato: 26.100145 COLCHAO 1,95X1,40=27"SPA CHERRY VISCO"COLMOL
         # Só faz match se NÃO for linha de quantidade (já verificado acima)
-        ref_match = re.match(r'^(\d+\.\d+)\s+(.+)$', stripped)
+        ref_match = _RE_OC_REF.match(stripped)
         if ref_match:
             referencias.append({
                 'codigo': ref_match.group(1),
@@ -1537,6 +2299,23 @@ def parse_ordem_compra(text: str):
         min_count = min(len(referencias), len(quantidades))
         print(f"   Processando apenas {min_count} produtos emparelhados")
     
+    # Campos fixos de cada produto, na ordem de sempre: cada linha é uma cópia (dict(base, ...)
+    # copia a tabela de hash de uma vez) só com os campos variáveis atribuídos
+    linha_base = {
+        "artigo": "",
+        "descricao": "",
+        "quantidade": 0.0,
+        "unidade": "UN",
+        "data_entrega": "",
+        "dimensoes": "",
+        "referencia_ordem": "",
+        "lote_producao": "",
+        "volume": 0,
+        "peso": 0.0,
+        "iva": 23.0,
+        "total": 0.0
+    }
+    
     # Combinar referências com quantidades (ordem sequencial 1:1)
     paired_count = min(len(referencias), len(quantidades))
     for i in range(paired_count):
@@ -1546,29 +2325,24 @@ def parse_ordem_compra(text: str):
             
             # Extrair dimensões da descrição se existirem
             dims = ""
-            dim_match = re.search(r'(\d),(\d{2})[xX×](\d),(\d{2})', ref['descricao'])
+            dim_match = _RE_OC_DIMS.search(ref['descricao'])
             if dim_match:
                 dims = f"{dim_match.group(1)}.{dim_match.group(2)}x{dim_match.group(3)}.{dim_match.group(4)}"
             
-            produtos.append({
-                "artigo": ref['codigo'],
-                "descricao": ref['descricao'],
-                "quantidade": qty_info['quantidade'],
-                "unidade": qty_info['unidade'],
-                "data_entrega": qty_info['data_entrega'],
-                "dimensoes": dims,
-                "referencia_ordem": "",
-                "lote_producao": "",
-                "volume": 0,
-                "peso": 0.0,
-                "iva": 23.0,
-                "total": 0.0
-            })
+            produtos.append(dict(
+                linha_base,
+                artigo=ref['codigo'],
+                descricao=ref['descricao'],
+                quantidade=qty_info['quantidade'],
+                unidade=qty_info['unidade'],
+                data_entrega=qty_info['data_entrega'],
+                dimensoes=dims,
+            ))
     
     return produtos
 
 
-def parse_bon_commande(text: str):
+def parse_bon_commande(text: str, lines=None):
     """
     Parser dedicado para BON DE COMMANDE (Notas de Encomenda francesas).
     
@@ -1583,26 +2357,46 @@ def parse_bon_commande(text: str):
     - Total da linha
     """
     produtos = []
-    lines = text.split("\n")
+    if lines is None:
+        lines = text.split("\n")
     
     # Buscar cliente
     cliente = ""
-    cliente_match = re.search(r'ADRESSE DE LIVRAISON\s+([^\n]+)', text, re.IGNORECASE)
+    cliente_match = _RE_BC_CLIENTE.search(text)
     if cliente_match:
         cliente = cliente_match.group(1).strip()
     
     # Buscar data
     data = ""
-    data_match = re.search(r'DATE\s*:\s*(\d{2}\.\d{2}\.\d{2})', text, re.IGNORECASE)
+    data_match = _RE_BC_DATA.search(text)
     if data_match:
         data = data_match.group(1)
     
     # Buscar contremarque
     contremarque = ""
-    cm_match = re.search(r'CONTREMARQUE\s*:\s*([^\n]+)', text, re.IGNORECASE)
+    cm_match = _RE_BC_CONTREMARQUE.search(text)
     if cm_match:
         contremarque = cm_match.group(1).strip()
     
+    # Campos comuns a todas as linhas do documento, na ordem de sempre
+    linha_base = {
+        "artigo": "",
+        "descricao": "",
+        "quantidade": 0.0,
+        "unidade": "UN",
+        "preco_unitario": 0.0,
+        "total": 0.0,
+        "dimensoes": "",
+        "cliente": cliente,
+        "data_encomenda": data,
+        "contremarque": contremarque,
+        "referencia_ordem": "",
+        "lote_producao": "",
+        "volume": 0,
+        "peso": 0.0,
+        "iva": 20.0  # IVA França padrão
+    }
+    
     in_product_section = False
     
     for line in lines:
@@ -1611,26 +2405,23 @@ def parse_bon_commande(text: str):
             continue
         
         # Detectar início da seção de produtos
-        if re.search(r'Désignation.*Quantité.*Prix', stripped, re.IGNORECASE):
+        if _RE_BC_HEADER.search(stripped):
             in_product_section = True
             continue
         
         # Detectar fim da seção (TOTAL ou endereço)
-        if re.search(r'^TOTAL|^ADRESSE|^BON DE COMMANDE', stripped, re.IGNORECASE):
+        if _RE_BC_END.search(stripped):
             in_product_section = False
             continue
         
-        if in_product_section:
+        if in_product_section and '€' in stripped:
             # Formato: MATELAS SAN REMO 140x190  2 202.00€ 404.00€
             # Produto pode ter dimensões (140x190, 180x200, etc)
             # Quantidade é número inteiro
             # Preços em formato europeu (202.00€)
             
             # Padrão: [PRODUTO com possíveis dimensões] [QTY] [PREÇO€] [TOTAL€]
-            match = re.match(
-                r'^(.+?)\s+(\d+)\s+([\d,\.]+)\s*€\s+([\d,\.]+)\s*€',
-                stripped
-            )
+            match = _RE_BC_PRODUTO.match(stripped)
             
             if match:
                 designacao = match.group(1).strip()
@@ -1644,41 +2435,59 @@ def parse_bon_commande(text: str):
                     
                     # Extrair dimensões da designação se existirem
                     dims = ""
-                    dim_match = re.search(r'(\d{2,3})\s*[xX×]\s*(\d{2,3})', designacao)
+                    dim_match = _RE_BC_DIMS.search(designacao)
                     if dim_match:
                         dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
                     
                     # Extrair código/referência se existir (formato tipo SAN REMO, RIVIERA)
                     codigo = ""
-                    cod_match = re.match(r'^([A-Z\s]+?)\s+\d', designacao)
+                    cod_match = _RE_BC_CODIGO.match(designacao)
                     if cod_match:
                         codigo = cod_match.group(1).strip()
                     
-                    produtos.append({
-                        "artigo": codigo if codigo else designacao[:20],
-                        "descricao": designacao,
-                        "quantidade": float(quantidade),
-                        "unidade": "UN",
-                        "preco_unitario": preco_unitario,
-                        "total": total_linha,
-                        "dimensoes": dims,
-                        "cliente": cliente,
-                        "data_encomenda": data,
-                        "contremarque": contremarque,
-                        "referencia_ordem": "",
-                        "lote_producao": "",
-                        "volume": 0,
-                        "peso": 0.0,
-                        "iva": 20.0  # IVA França padrão
-                    })
+                    produtos.append(dict(
+                        linha_base,
+                        artigo=codigo if codigo else designacao[:20],
+                        descricao=designacao,
+                        quantidade=float(quantidade),
+                        preco_unitario=preco_unitario,
+                        total=total_linha,
+                        dimensoes=dims,
+                    ))
                 except ValueError as e:
-                    print(f"⚠️ Erro ao converter valores numéricos em '{stripped[:50]}': {e}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("⚠️ Erro ao converter valores numéricos em '%s': %s", stripped[:50], e)
                     continue
     
     return produtos
 
 
-def parse_pedido_espanhol(text: str):
+def _parse_float_or_none(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _is_valid_pedido_row(codigo: str, descricao: str, quantidade) -> bool:
+    """
+    Validações anti-falso-positivo comuns a todos os formatos do pedido espanhol.
+    `quantidade` a None (não convertível) não invalida a linha por si só.
+    """
+    # 1. Código não pode ser número puro (evita números de documento)
+    if codigo.isdigit():
+        return False
+    # 2. Código não pode começar com PT (evita NIFs portugueses)
+    if codigo.startswith('PT'):
+        return False
+    # 3. Quantidade não pode ser muito alta (evita telefones/códigos postais)
+    if quantidade is not None and quantidade > 100:  # Produtos geralmente < 100 unidades
+        return False
+    # 4. Descrição não pode conter palavras de endereço
+    return _RE_ES_ADDRESS_WORDS.search(descricao.upper()) is None
+
+
+def parse_pedido_espanhol(text: str, lines=None):
     """
     Parser dedicado para PEDIDO espanhol (NATURCOLCHON, COSGUI, etc).
     
@@ -1690,27 +2499,45 @@ def parse_pedido_espanhol(text: str):
        LUSTOPVS135190 COLCHON TOP VISCO 2019 135X190 4,00
     """
     produtos = []
-    lines = text.split("\n")
+    if lines is None:
+        lines = text.split("\n")
     
     # Buscar número de pedido
     pedido_num = ""
-    ped_match = re.search(r'(?:Pedido|Número).*?(\d+)', text, re.IGNORECASE)
+    ped_match = _RE_ES_PEDIDO.search(text)
     if ped_match:
         pedido_num = ped_match.group(1)
     
     # Buscar data
     fecha = ""
-    fecha_match = re.search(r'Fecha.*?(\d{2}/\d{2}/\d{4})', text, re.IGNORECASE)
+    fecha_match = _RE_ES_FECHA.search(text)
     if fecha_match:
         fecha = fecha_match.group(1)
     
     # Buscar proveedor
     proveedor = ""
-    prov_match = re.search(r'Proveedor.*?([A-Z\s\.]+)', text, re.IGNORECASE)
+    prov_match = _RE_ES_PROVEEDOR.search(text)
     if prov_match:
         proveedor = prov_match.group(1).strip()
     
-    in_product_section = False
+    # Campos comuns a todas as linhas do documento, na ordem de sempre
+    linha_base = {
+        "artigo": "",
+        "descricao": "",
+        "quantidade": 0.0,
+        "unidade": "UN",
+        "preco_unitario": 0.0,
+        "total": 0.0,
+        "dimensoes": "",
+        "pedido_numero": pedido_num,
+        "fecha": fecha,
+        "proveedor": proveedor,
+        "referencia_ordem": "",
+        "lote_producao": "",
+        "volume": 0,
+        "peso": 0.0,
+        "iva": 21.0  # IVA Espanha padrão
+    }
     
     # Multi-line buffer: tentar juntar 3 linhas para formato COSGUI (qty, desc, code em linhas separadas)
     i = 0
@@ -1720,15 +2547,10 @@ def parse_pedido_espanhol(text: str):
             i += 1
             continue
         
-        # Detectar início da seção de produtos (keywords podem vir em linhas separadas)
-        if re.search(r'Artículo|Descripción|Cantidad|Código', stripped, re.IGNORECASE):
-            in_product_section = True
-            i += 1
-            continue
-        
-        # Detectar fim da seção
-        if re.search(r'^Total|^Importe neto|^Notas|^Plazo|^Base I\.V\.A', stripped, re.IGNORECASE):
-            in_product_section = False
+        # Linhas de cabeçalho da tabela e de fim de secção não são produtos. Não há estado
+        # de "secção de produtos": os produtos são procurados em todas as linhas, porque
+        # os cabeçalhos podem vir depois deles (keywords em linhas separadas)
+        if _RE_ES_HEADER.search(stripped) or _RE_ES_END.search(stripped):
             i += 1
             continue
         
@@ -1740,45 +2562,21 @@ def parse_pedido_espanhol(text: str):
             line3 = lines[i+2].strip()
             
             # Padrão: linha1=quantidade, linha2=descrição, linha3=código
-            if (re.match(r'^[\d,]+$', line1) and  # Quantidade pura
+            if (_RE_ES_QTY_LINE.match(line1) and  # Quantidade pura
                 len(line2) > 10 and  # Descrição tem texto
-                re.match(r'^[A-Z0-9]{6,}$', line3)):  # Código alfanumérico
-                
-                # VALIDAÇÕES ANTI-FALSO-POSITIVO:
-                # 1. Código não pode ser número puro (evita números de documento)
-                if re.match(r'^\d+$', line3):
-                    i += 1
-                    continue
-                
-                # 2. Código não pode começar com PT (evita NIFs portugueses)
-                if line3.startswith('PT'):
-                    i += 1
-                    continue
-                
-                # 3. Quantidade não pode ser muito alta (evita telefones/códigos postais)
-                try:
-                    qty_check = normalize_number(line1)
-                    if qty_check > 100:  # Produtos geralmente < 100 unidades
-                        i += 1
-                        continue
-                except:
-                    pass
+                _RE_ES_CODE_LINE.match(line3)):  # Código alfanumérico
                 
-                # 4. Descrição não pode conter palavras de endereço
-                address_words = ['POLIGONO', 'NAVE', 'CALLE', 'RUA', 'AVENIDA', 'ZONA', 'INDUSTRIAL']
-                if any(word in line2.upper() for word in address_words):
+                if not _is_valid_pedido_row(line3, line2, normalize_number(line1)):
                     i += 1
                     continue
                 
                 # Reconstruir linha no formato esperado: CÓDIGO DESCRIPCIÓN CANTIDAD
                 reconstructed = f"{line3} {line2} {line1}"
-                print(f"🔧 Buffer multi-linha: '{line1}' + '{line2}' + '{line3}' → '{reconstructed}'")
+                logger.debug("🔧 Buffer multi-linha: '%s' + '%s' + '%s' → '%s'",
+                             line1, line2, line3, reconstructed)
                 
                 # Tentar match no formato 2
-                match2 = re.match(
-                    r'^([A-Z0-9]{6,})\s+(.+?)\s+([\d,]+)$',
-                    reconstructed
-                )
+                match2 = _RE_ES_FORMATO2.match(reconstructed)
                 
                 if match2:
                     codigo = match2.group(1)
@@ -1790,106 +2588,75 @@ def parse_pedido_espanhol(text: str):
                         
                         # Extrair dimensões
                         dims = ""
-                        dim_match = re.search(r'(\d{2,3})[xX×](\d{2,3})', descripcion)
+                        dim_match = _RE_ES_DIMS.search(descripcion)
                         if dim_match:
                             dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
                         
-                        produtos.append({
-                            "artigo": codigo,
-                            "descricao": descripcion,
-                            "quantidade": cantidad,
-                            "unidade": "UN",
-                            "preco_unitario": 0.0,
-                            "total": 0.0,
-                            "dimensoes": dims,
-                            "pedido_numero": pedido_num,
-                            "fecha": fecha,
-                            "proveedor": proveedor,
-                            "referencia_ordem": "",
-                            "lote_producao": "",
-                            "volume": 0,
-                            "peso": 0.0,
-                            "iva": 21.0
-                        })
-                        print(f"✅ Produto multi-linha extraído: {codigo} - {descripcion} - {cantidad}")
+                        produtos.append(dict(
+                            linha_base,
+                            artigo=codigo,
+                            descricao=descripcion,
+                            quantidade=cantidad,
+                            dimensoes=dims,
+                        ))
+                        logger.debug("✅ Produto multi-linha extraído: %s - %s - %s",
+                                     codigo, descripcion, cantidad)
                         i += 3  # Pular as 3 linhas processadas
                         continue
                     except ValueError:
                         pass
         
-        if in_product_section or True:  # SEMPRE tentar parsear (headers podem vir depois)
+        # Os formatos 1, 1B e 2 terminam num número: as outras linhas não são testadas
+        if stripped[-1] in _ES_LINE_END_CHARS:
             # Formato 1B: DESCRIPCIÓN CÓDIGO TOTAL PRECIO UNIDADES (formato invertido NATURCOLCHON)
             # Exemplo: COLCHON PRAGA DE 150X200 CM*NUEVO* COPR1520 875,00 175,00 5,00
             # VERIFICAR PRIMEIRO pois tem 3 números (mais específico)
-            match1b = re.match(
-                r'^(.+?)\s+([A-Z0-9]{4,})\s+([\d,]+)\s+([\d,]+)\s+([\d,]+)$',
-                stripped
-            )
-            
             # Formato 1: CÓDIGO DESCRIPCIÓN UNIDADES PRECIO IMPORTE
             # Exemplo: COPR1520 COLCHON PRAGA DE 150X200 CM*NUEVO* 5,00 175,00 875,00
-            match1 = re.match(
-                r'^([A-Z0-9]{4,})\s+(.+?)\s+([\d,]+)\s+([\d,]+)\s+([\d,]+)$',
-                stripped
-            )
+            tail = _RE_ES_TAIL3.search(stripped)
+            formato1b = formato1 = False
+            if tail:
+                head = stripped[:tail.start()]
+                # 1B: código é o último token antes dos números
+                parts = head.rsplit(None, 1)
+                if len(parts) == 2 and _RE_ES_CODE_TOKEN.fullmatch(parts[1]):
+                    formato1b = True
+                else:
+                    # 1: código é o primeiro token (sem descrição, só com 3+ espaços até aos números)
+                    parts = head.split(None, 1)
+                    formato1 = (_RE_ES_CODE_TOKEN.fullmatch(parts[0]) is not None
+                                and (len(parts) == 2 or tail.start(1) - tail.start() >= 3))
             
-            if match1b:
+            if formato1b:
                 # Formato invertido: descrição vem primeiro
-                descripcion = match1b.group(1).strip()
-                codigo = match1b.group(2)
-                total_str = match1b.group(3).replace(',', '.')
-                precio_str = match1b.group(4).replace(',', '.')
-                cantidad_str = match1b.group(5).replace(',', '.')
-                
-                # VALIDAÇÕES ANTI-FALSO-POSITIVO (igual buffer multi-linha)
-                is_valid = True
-                # 1. Código não pode ser número puro
-                if re.match(r'^\d+$', codigo):
-                    is_valid = False
-                # 2. Código não pode começar com PT (NIFs)
-                if codigo.startswith('PT'):
-                    is_valid = False
-                # 3. Quantidade não pode ser > 100
-                try:
-                    if float(cantidad_str) > 100:
-                        is_valid = False
-                except:
-                    pass
-                # 4. Descrição não pode ter palavras de endereço
-                address_words = ['POLIGONO', 'NAVE', 'CALLE', 'RUA', 'AVENIDA', 'ZONA', 'INDUSTRIAL']
-                if any(word in descripcion.upper() for word in address_words):
-                    is_valid = False
+                descripcion = parts[0].strip()
+                codigo = parts[1]
+                total_str = tail.group(1).replace(',', '.')
+                precio_str = tail.group(2).replace(',', '.')
+                cantidad = _parse_float_or_none(tail.group(3).replace(',', '.'))
                 
-                if is_valid:
+                # Quantidade ilegível também descarta a linha
+                if cantidad is not None and _is_valid_pedido_row(codigo, descripcion, cantidad):
                     try:
-                        cantidad = float(cantidad_str)
                         precio = float(precio_str)
                         total = float(total_str)
                         
                         # Extrair dimensões
                         dims = ""
-                        dim_match = re.search(r'(\d{2,3})[xX×](\d{2,3})', descripcion)
+                        dim_match = _RE_ES_DIMS.search(descripcion)
                         if dim_match:
                             dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
                         
-                        produtos.append({
-                            "artigo": codigo,
-                            "descricao": descripcion,
-                            "quantidade": cantidad,
-                            "unidade": "UN",
-                            "preco_unitario": precio,
-                            "total": total,
-                            "dimensoes": dims,
-                            "pedido_numero": pedido_num,
-                            "fecha": fecha,
-                            "proveedor": proveedor,
-                            "referencia_ordem": "",
-                            "lote_producao": "",
-                            "volume": 0,
-                            "peso": 0.0,
-                            "iva": 21.0  # IVA Espanha padrão
-                        })
-                        print(f"✅ Formato 1B extraído: {codigo} - {descripcion} - {cantidad}")
+                        produtos.append(dict(
+                            linha_base,
+                            artigo=codigo,
+                            descricao=descripcion,
+                            quantidade=cantidad,
+                            preco_unitario=precio,
+                            total=total,
+                            dimensoes=dims,
+                        ))
+                        logger.debug("✅ Formato 1B extraído: %s - %s - %s", codigo, descripcion, cantidad)
                         i += 1
                         continue
                     except ValueError:
@@ -1898,74 +2665,49 @@ def parse_pedido_espanhol(text: str):
                 i += 1
                 continue
             
-            elif match1:
-                codigo = match1.group(1)
-                descripcion = match1.group(2).strip()
-                cantidad_str = match1.group(3).replace(',', '.')
-                precio_str = match1.group(4).replace(',', '.')
-                total_str = match1.group(5).replace(',', '.')
+            elif formato1:
+                codigo = parts[0]
+                descripcion = parts[1].strip() if len(parts) == 2 else ""
+                cantidad = _parse_float_or_none(tail.group(1).replace(',', '.'))
+                precio_str = tail.group(2).replace(',', '.')
+                total_str = tail.group(3).replace(',', '.')
                 
-                # VALIDAÇÕES ANTI-FALSO-POSITIVO (igual buffer multi-linha)
-                # 1. Código não pode ser número puro
-                if re.match(r'^\d+$', codigo):
-                    i += 1
-                    continue
-                # 2. Código não pode começar com PT (NIFs)
-                if codigo.startswith('PT'):
-                    i += 1
-                    continue
-                # 3. Quantidade não pode ser > 100
-                try:
-                    if float(cantidad_str) > 100:
-                        i += 1
-                        continue
-                except:
-                    pass
-                # 4. Descrição não pode ter palavras de endereço
-                address_words = ['POLIGONO', 'NAVE', 'CALLE', 'RUA', 'AVENIDA', 'ZONA', 'INDUSTRIAL']
-                if any(word in descripcion.upper() for word in address_words):
+                if not _is_valid_pedido_row(codigo, descripcion, cantidad):
                     i += 1
                     continue
                 
-                try:
-                    cantidad = float(cantidad_str)
-                    precio = float(precio_str)
-                    total = float(total_str)
+                # Quantidade ilegível: tentar ainda o formato 2
+                if cantidad is not None:
+                    try:
+                        precio = float(precio_str)
+                        total = float(total_str)
                     
-                    # Extrair dimensões
-                    dims = ""
-                    dim_match = re.search(r'(\d{2,3})[xX×](\d{2,3})', descripcion)
-                    if dim_match:
-                        dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
+                        # Extrair dimensões
+                        dims = ""
+                        dim_match = _RE_ES_DIMS.search(descripcion)
+                        if dim_match:
+                            dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
                     
-                    produtos.append({
-                        "artigo": codigo,
-                        "descricao": descripcion,
-                        "quantidade": cantidad,
-                        "unidade": "UN",
-                        "preco_unitario": precio,
-                        "total": total,
-                        "dimensoes": dims,
-                        "pedido_numero": pedido_num,
-                        "fecha": fecha,
-                        "proveedor": proveedor,
-                        "referencia_ordem": "",
-                        "lote_producao": "",
-                        "volume": 0,
-                        "peso": 0.0,
-                        "iva": 21.0  # IVA Espanha padrão
-                    })
-                    print(f"✅ Formato 1 extraído: {codigo} - {descripcion} - {cantidad}")
-                    continue
-                except ValueError:
-                    pass
+                        produtos.append(dict(
+                            linha_base,
+                            artigo=codigo,
+                            descricao=descripcion,
+                            quantidade=cantidad,
+                            preco_unitario=precio,
+                            total=total,
+                            dimensoes=dims,
+                        ))
+                        logger.debug("✅ Formato 1 extraído: %s - %s - %s", codigo, descripcion, cantidad)
+                        # Avançar antes do continue: sem isto a mesma linha era extraída em
+                        # ciclo infinito (ver PedidoEspanholTests)
+                        i += 1
+                        continue
+                    except ValueError:
+                        pass
             
             # Formato 2: CÓDIGO DESCRIPCIÓN CANTIDAD
             # Exemplo: LUSTOPVS135190 COLCHON TOP VISCO 2019 135X190 4,00
-            match2 = re.match(
-                r'^([A-Z0-9]{6,})\s+(.+?)\s+([\d,]+)$',
-                stripped
-            )
+            match2 = _RE_ES_FORMATO2.match(stripped)
             
             if match2:
                 codigo = match2.group(1)
@@ -1977,27 +2719,17 @@ def parse_pedido_espanhol(text: str):
                     
                     # Extrair dimensões
                     dims = ""
-                    dim_match = re.search(r'(\d{2,3})[xX×](\d{2,3})', descripcion)
+                    dim_match = _RE_ES_DIMS.search(descripcion)
                     if dim_match:
                         dims = f"{dim_match.group(1)}x{dim_match.group(2)}"
                     
-                    produtos.append({
-                        "artigo": codigo,
-                        "descricao": descripcion,
-                        "quantidade": cantidad,
-                        "unidade": "UN",
-                        "preco_unitario": 0.0,
-                        "total": 0.0,
-                        "dimensoes": dims,
-                        "pedido_numero": pedido_num,
-                        "fecha": fecha,
-                        "proveedor": proveedor,
-                        "referencia_ordem": "",
-                        "lote_producao": "",
-                        "volume": 0,
-                        "peso": 0.0,
-                        "iva": 21.0
-                    })
+                    produtos.append(dict(
+                        linha_base,
+                        artigo=codigo,
+                        descricao=descripcion,
+                        quantidade=cantidad,
+                        dimensoes=dims,
+                    ))
                 except ValueError:
                     pass
         
@@ -2018,6 +2750,7 @@ def universal_kv_extract(text: str, file_path: str = None):
     """
     if not RAPIDFUZZ_AVAILABLE:
         return {}
+    from rapidfuzz import fuzz, process
     
     result = {}
     lines = text.split('\n')
@@ -2068,6 +2801,7 @@ def universal_table_extract(file_path: str):
     # Método 1: Camelot (melhor para tabelas com bordas)
     if CAMELOT_AVAILABLE and file_path.lower().endswith('.pdf'):
         try:
+            import camelot
             tables = camelot.read_pdf(file_path, pages='all', flavor='lattice')
             
             if len(tables) > 0:
@@ -2124,6 +2858,7 @@ def universal_table_extract(file_path: str):
     # Método 2: pdfplumber (melhor para tabelas sem bordas)
     if PDFPLUMBER_AVAILABLE and file_path.lower().endswith('.pdf') and len(produtos) == 0:
         try:
+            import pdfplumber
             with pdfplumber.open(file_path) as pdf:
                 for page in pdf.pages:
                     tables = page.extract_tables()
@@ -2186,10 +2921,27 @@ def universal_table_extract(file_path: str):
     return produtos
 
 
+# Regex genéricos para linhas de produto (artigo + descrição + quantidade + preço)
+_GENERIC_PRODUCT_LINE_RES = (
+    # Padrão 1: CÓDIGO DESCRIÇÃO QTY PREÇO
+    re.compile(r'^\s*([A-Z0-9\-]+)\s+(.{10,60}?)\s+(\d+[,.]?\d*)\s+(\d+[,.]?\d+)\s*$'),
+    # Padrão 2: CÓDIGO | DESCRIÇÃO | QTY
+    re.compile(r'^\s*([A-Z0-9\-]+)\s*\|\s*(.{10,60}?)\s*\|\s*(\d+[,.]?\d*)'),
+    # Padrão 3: QTY DESCRIÇÃO CÓDIGO
+    re.compile(r'^\s*(\d+[,.]?\d*)\s+(.{10,60}?)\s+([A-Z0-9\-]+)\s*$'),
+)
+# Candidato a código de produto: token com letras e dígitos (ex: ABC123456789012, 10PT-3,
+# em maiúsculas ou minúsculas) ou só numérico com 4+ dígitos (ex: 123456)
+_PRODUCT_CODE_CANDIDATE_RE = re.compile(
+    r'\b(?:(?=[A-Z0-9\-]*[A-Z])(?=[A-Z0-9\-]*\d)[A-Z0-9\-]{4,}|\d{4,})\b', re.IGNORECASE)
+
+
 def parse_generic_document(text: str, file_path: str = None):
     """
     Parser genérico universal - última tentativa quando parsers específicos falharem.
     Combina regex heurísticos + table extraction + fuzzy matching.
+    A extração de tabelas volta a abrir o PDF (Camelot + pdfplumber); só corre se o texto
+    já extraído tiver algum candidato a código de produto, senão as tabelas também não têm.
     """
     produtos = []
     metadata = {}
@@ -2199,31 +2951,23 @@ def parse_generic_document(text: str, file_path: str = None):
         metadata = universal_kv_extract(text, file_path)
         print(f"📋 Metadados extraídos (fuzzy): {list(metadata.keys())}")
     
-    # 2. Tentativa de extração por tabelas
-    if file_path:
+    # 2. Tentativa de extração por tabelas (segunda leitura do PDF: só com candidatos a código)
+    if file_path and _PRODUCT_CODE_CANDIDATE_RE.search(text):
         produtos = universal_table_extract(file_path)
+    elif file_path:
+        print("⏭️ Sem candidatos a código de produto no texto - extração de tabelas ignorada")
     
     # 3. Se ainda não tem produtos, tenta regex genéricos
     if len(produtos) == 0:
         lines = text.split('\n')
         
-        # Regex genérico para linhas de produto (artigo + descrição + quantidade + preço)
-        generic_patterns = [
-            # Padrão 1: CÓDIGO DESCRIÇÃO QTY PREÇO
-            r'^\s*([A-Z0-9\-]+)\s+(.{10,60}?)\s+(\d+[,.]?\d*)\s+(\d+[,.]?\d+)\s*$',
-            # Padrão 2: CÓDIGO | DESCRIÇÃO | QTY
-            r'^\s*([A-Z0-9\-]+)\s*\|\s*(.{10,60}?)\s*\|\s*(\d+[,.]?\d*)',
-            # Padrão 3: QTY DESCRIÇÃO CÓDIGO
-            r'^\s*(\d+[,.]?\d*)\s+(.{10,60}?)\s+([A-Z0-9\-]+)\s*$'
-        ]
-        
         for line in lines:
             line_stripped = line.strip()
             if len(line_stripped) < 10:
                 continue
             
-            for pattern_idx, pattern in enumerate(generic_patterns):
-                match = re.match(pattern, line_stripped)
+            for pattern_idx, pattern in enumerate(_GENERIC_PRODUCT_LINE_RES):
+                match = pattern.match(line_stripped)
                 if match:
                     try:
                         if pattern_idx == 0:  # CÓDIGO DESC QTY PREÇO
@@ -2292,38 +3036,44 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
         "baixa_qualidade_texto": texto_pdfplumber_curto,
     }
 
-    patterns = {
-        "req": r"(?:req|requisição)\.?\s*n?[oº]?\s*:?\s*([A-Z0-9\-/]+)",
-        "doc": r"(?:guia|gr|documento|fatura)\.?\s*n?[oº]?\s*:?\s*([A-Z0-9\-/]+)",
-        "data": r"(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})",
-        "fornecedor": r"(?:fornecedor|empresa)\.?\s*:?\s*([^\n]+)",
-    }
-
-    for ln in lines:
-        low = ln.lower().strip()
-
+    # Padrões case-insensitive aplicados à linha original (sem cópia .lower() por linha)
+    # Só as primeiras HEADER_SCAN_LINES linhas: o cabeçalho está sempre no topo do documento
+    for ln in lines[:HEADER_SCAN_LINES]:
         if not result["numero_requisicao"]:
-            m = re.search(patterns["req"], low, re.IGNORECASE)
+            m = _RE_REQ.search(ln)
             if m:
                 result["numero_requisicao"] = m.group(1).upper()
 
         if not result["document_number"]:
-            m = re.search(patterns["doc"], low, re.IGNORECASE)
+            m = _RE_DOC.search(ln)
             if m:
                 result["document_number"] = m.group(1).upper()
 
         if not result["delivery_date"]:
-            m = re.search(patterns["data"], ln)
+            m = _RE_DATA.search(ln)
             if m:
                 result["delivery_date"] = m.group(1)
 
         if not result["supplier_name"]:
-            m = re.search(patterns["fornecedor"], low)
+            m = _RE_FORN.search(ln.strip())
+            if m:
+                result["supplier_name"] = m.group(1).lower().title()
+
+        # Os 4 campos do cabeçalho já encontrados → não percorrer o resto do documento
+        if (result["numero_requisicao"] and result["document_number"]
+                and result["delivery_date"] and result["supplier_name"]):
+            break
+
+    # Fornecedor em falta → procurar também no rodapé (assinaturas/dados da empresa)
+    if not result["supplier_name"]:
+        for ln in lines[max(HEADER_SCAN_LINES, len(lines) - FOOTER_SCAN_LINES):]:
+            m = _RE_FORN.search(ln.strip())
             if m:
-                result["supplier_name"] = m.group(1).title()
+                result["supplier_name"] = m.group(1).lower().title()
+                break
 
     if doc_type == "PEDIDO_ESPANHOL":
-        produtos = parse_pedido_espanhol(text)
+        produtos = parse_pedido_espanhol(text, lines=lines)
         if produtos:
             result["produtos"] = produtos
             print(f"✅ Extraídos {len(produtos)} produtos do Pedido Espanhol")
@@ -2338,7 +3088,7 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
         else:
             print("⚠️ Parser Pedido Espanhol retornou 0 produtos")
     elif doc_type == "BON_COMMANDE":
-        produtos = parse_bon_commande(text)
+        produtos = parse_bon_commande(text, lines=lines)
         if produtos:
             result["produtos"] = produtos
             print(f"✅ Extraídos {len(produtos)} produtos do Bon de Commande")
@@ -2361,7 +3111,7 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
             print(f"✅ Extraídos {len(produtos)} produtos da Ordem de Compra")
             
             # Extrair número da ordem de compra
-            oc_match = re.search(r'ORDEM\s+COMPRA\s+N[ºo]?\s*([A-Z0-9]+)', text, re.IGNORECASE)
+            oc_match = _RE_OC_NUMBER.search(text)
             if oc_match:
                 result["po_number"] = oc_match.group(1)
                 result["document_number"] = oc_match.group(1)
@@ -2399,11 +3149,11 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
                 print(f"✅ Extraídos {len(produtos)} produtos com parser genérico de guias")
         
         if not result.get("produtos"):
-            guia_products = extract_guia_remessa_products(text)
+            guia_products = extract_guia_remessa_products(text, lines=lines)
             if guia_products:
                 result["produtos"] = guia_products
             else:
-                product_lines = extract_product_lines(text)
+                product_lines = extract_product_lines(text, lines=lines)
                 legacy = []
                 for p in product_lines:
                     legacy.append({
@@ -2439,16 +3189,18 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
                     result["po_number"] = metadata['encomenda']
 
     if result["produtos"]:
-        result["totals"]["total_lines"] = len(result["produtos"])
-        result["totals"]["total_quantity"] = sum(p.get("quantidade", 0) for p in result["produtos"])
-        
-        if not result["po_number"] and result["produtos"]:
-            for produto in result["produtos"]:
-                ref = produto.get("referencia_ordem", "")
-                po_match = re.match(r'^([A-Z0-9]+)\s+[NnºN]', ref, re.IGNORECASE)
+        # Uma só passagem: total de quantidades + nº de encomenda da 1ª referência que o tenha
+        total_quantity = 0
+        po_number = result["po_number"]
+        for produto in result["produtos"]:
+            total_quantity += produto.get("quantidade", 0)
+            if not po_number:
+                po_match = _RE_PO_REF.match(produto.get("referencia_ordem", ""))
                 if po_match:
-                    result["po_number"] = po_match.group(1).upper()
-                    break
+                    po_number = po_match.group(1).upper()
+        result["totals"]["total_lines"] = len(result["produtos"])
+        result["totals"]["total_quantity"] = total_quantity
+        result["po_number"] = po_number
     elif result["lines"]:
         result["totals"]["total_lines"] = len(result["lines"])
         result["totals"]["total_quantity"] = sum(x["qty"] for x in result["lines"])
@@ -2459,109 +3211,6 @@ def parse_portuguese_document(text: str, qr_codes=None, texto_pdfplumber_curto=F
     return result
 
 
-def extract_product_lines(text: str):
-    """Extrai linhas de produto com regex tolerante a formatos reais."""
-    products = []
-    lines = text.split("\n")
-
-    code_pat = r"(?P<code>(?:[A-Z]{1}[A-Z0-9\-\/\.]{2,}))"  # BLC-D25-200x300, REF-123, etc.
-    dens_pat = r"(?P<densidade>D\d{2})?"  # D23, D30, etc. (opcional)
-    sep = r"[xX×\- ]"  # separadores
-    dim_pat = rf"(?P<dim>(\d{{2,4}}){sep}(\d{{2,4}})(?:{sep}(\d{{2,4}}))?)"
-    qty_pat = r"(?P<qty>\d+(?:[.,]\d+)?)\s*(?:un|uni|unid|unidades)?$"
-
-    line_regex = re.compile(
-        rf"(?i)^(?=.*{code_pat})(?=.*{dim_pat}).*{qty_pat}")
-
-    for raw in lines:
-        line = raw.strip()
-        if len(line) < 5:
-            continue
-
-        m = line_regex.search(line)
-        if not m:
-            # Fallback: ordem trocada; procurar blocos na linha
-            code_m = re.search(code_pat, line)
-            dim_m = re.search(dim_pat, line)
-            qty_m = re.search(qty_pat, line, flags=re.IGNORECASE)
-            if not (code_m and qty_m and dim_m):
-                continue
-            m_code = code_m.group("code")
-            m_qty = qty_m.group("qty")
-            m_dim = dim_m.group("dim")
-            dims_nums = re.split(sep, m_dim)
-        else:
-            m_code = m.group("code")
-            m_qty = m.group("qty")
-            m_dim = m.group("dim")
-            dims_nums = re.split(sep, m_dim)
-
-        # quantidade
-        try:
-            qty = float(m_qty.replace(",", "."))
-        except Exception:
-            qty = 0.0
-
-        # dimensões
-        larg = comp = esp = 0
-        try:
-            if len(dims_nums) >= 2:
-                larg = int(dims_nums[0])
-                comp = int(dims_nums[1])
-                if len(dims_nums) >= 3 and dims_nums[2].isdigit():
-                    esp = int(dims_nums[2])
-        except Exception:
-            pass
-
-        # densidade (se houver)
-        densidade = ""
-        dm = re.search(r"(D\d{2})", line, flags=re.IGNORECASE)
-        if dm:
-            densidade = dm.group(1).upper()
-
-        produto = {
-            "codigo_fornecedor": m_code.upper(),
-            "descricao": line,
-            "linha_raw": raw,
-            "dimensoes": {
-                "comprimento": comp,
-                "largura": larg,
-                "espessura": esp
-            },
-            "quantidade": qty,
-            "unidade": "UNI",
-            "mini_codigo": "",  # calculado já de seguida
-        }
-        produto["mini_codigo"] = generate_mini_codigo(produto)
-        products.append(produto)
-
-    return products
-
-
-def generate_mini_codigo(linha):
-    """Gera Mini Código tolerante a dados parciais (usa densidade se existir)."""
-    dims = linha.get("dimensoes", {})
-    codigo = linha.get("codigo_fornecedor", "")
-
-    comp = dims.get("comprimento", 0)
-    larg = dims.get("largura", 0)
-    esp = dims.get("espessura", 0)
-
-    dens_m = re.search(r"(D\d{2})", codigo, flags=re.IGNORECASE)
-    densidade = (dens_m.group(1).upper() if dens_m else "")
-
-    if larg and comp and esp:
-        core = f"{larg}x{comp}x{esp}"
-    elif larg and comp:
-        core = f"{larg}x{comp}"
-    else:
-        core = ""
-
-    if densidade and core:
-        return f"{densidade}-{core}"
-    return core or codigo
-
-
 def get_realistic_fallback():
     """Fallback realista (não usado se OCR funcionar)."""
     return {
@@ -2611,11 +3260,40 @@ def get_realistic_fallback():
 # ----------------- Mapeamento + Matching + Export -----------------
 
 
+def _code_mappings_for(supplier, codes):
+    """CodeMappings do fornecedor para os códigos dados, numa só query: {supplier_code: mapping}."""
+    codes = {code for code in codes if code}
+    if not codes:
+        return {}
+    return {m.supplier_code: m
+            for m in CodeMapping.objects.filter(supplier=supplier, supplier_code__in=codes)}
+
+
+def _purchase_orders_by_number(numbers):
+    """PurchaseOrders com os números dados, numa só query: {number: po}."""
+    numbers = set(numbers)
+    if not numbers:
+        return {}
+    return {po.number: po for po in PurchaseOrder.objects.filter(number__in=numbers)}
+
+
+def _po_line_index(pos):
+    """POLines das POs dadas, numa só query: {(po_id, internal_sku): po_line}."""
+    po_ids = {po.id for po in pos if po}
+    if not po_ids:
+        return {}
+    return {(line.po_id, line.internal_sku): line
+            for line in POLine.objects.filter(po_id__in=po_ids)}
+
+
 def map_supplier_codes(supplier, payload):
     mapped = []
 
     # Suporta novo formato com 'produtos' (Guia de Remessa extraída)
     if "produtos" in payload and payload["produtos"]:
+        # Uma só query para os mapeamentos de todos os artigos (em vez de uma por produto)
+        mappings = _code_mappings_for(
+            supplier, [produto.get("artigo") for produto in payload["produtos"]])
         for produto in payload["produtos"]:
             # Extrair código do fornecedor da referência de ordem (ex: "1ECWH Nº 10874/25EU" -> "1ECWH")
             referencia = produto.get("referencia_ordem", "")
@@ -2627,8 +3305,7 @@ def map_supplier_codes(supplier, payload):
             # IMPORTANTE: Lookup usando article_code, não supplier_code!
             # supplier_code (ex:"1ECWH") é igual para todas as linhas deste fornecedor
             # article_code (ex:"E0748001901") é único por produto
-            mapping = CodeMapping.objects.filter(
-                supplier=supplier, supplier_code=article_code).first() if article_code else None
+            mapping = mappings.get(article_code) if article_code else None
             mapped.append({
                 "supplier_code": supplier_code or "",
                 "article_code": article_code or "UNKNOWN",
@@ -2641,10 +3318,11 @@ def map_supplier_codes(supplier, payload):
             })
     # Formato antigo com 'lines' (no formato antigo, supplier_code era o SKU do produto)
     elif "lines" in payload:
+        mappings = _code_mappings_for(
+            supplier, [l.get("supplier_code") for l in payload.get("lines", [])])
         for l in payload.get("lines", []):
             supplier_code = l.get("supplier_code")
-            mapping = CodeMapping.objects.filter(
-                supplier=supplier, supplier_code=supplier_code).first()
+            mapping = mappings.get(supplier_code)
             mapped.append({
                 **l,
                 "article_code": supplier_code,  # No formato antigo, supplier_code era o artigo/SKU
@@ -2703,7 +3381,11 @@ def create_po_from_nota_encomenda(inbound: InboundDocument, payload: dict):
             )
             print(f"✅ Criada PO {po_number} para fornecedor {inbound.supplier.name}")
         
-        # Criar POLines para cada produto deste grupo
+        # Criar POLines para cada produto deste grupo: linhas já existentes da PO lidas numa
+        # só query; novas gravadas com bulk_create e existentes com bulk_update no fim
+        lines_by_sku = {} if not existing_po else {line.internal_sku: line for line in po.lines.all()}
+        new_lines = []
+        changed_lines = {}
         lines_created = 0
         for produto in produtos_grupo:
             # Extrair dados do produto (garantir que não são None)
@@ -2715,26 +3397,32 @@ def create_po_from_nota_encomenda(inbound: InboundDocument, payload: dict):
             if not article_code or qty_ordered <= 0:
                 continue
             
-            # Usar get_or_create para evitar duplicados - se SKU já existe, agregar quantidade
-            po_line, created = POLine.objects.get_or_create(
-                po=po,
-                internal_sku=article_code,
-                defaults={
-                    'description': description,
-                    'unit': unit,
-                    'qty_ordered': qty_ordered,
-                    'tolerance': 0
-                }
-            )
-            
-            if not created:
+            # Evitar duplicados - se SKU já existe, agregar quantidade
+            po_line = lines_by_sku.get(article_code)
+            if po_line is None:
+                po_line = POLine(
+                    po=po,
+                    internal_sku=article_code,
+                    description=description,
+                    unit=unit,
+                    qty_ordered=qty_ordered,
+                    tolerance=0
+                )
+                lines_by_sku[article_code] = po_line
+                new_lines.append(po_line)
+            else:
                 # Linha já existia - somar quantidades (ambos são Decimal agora)
                 po_line.qty_ordered += qty_ordered
-                po_line.save()
+                if po_line.pk:
+                    changed_lines[po_line.pk] = po_line
                 print(f"📊 Agregado {qty_ordered} {unit} ao produto {article_code} na PO {po_number} (total: {po_line.qty_ordered})")
             
             lines_created += 1
         
+        POLine.objects.bulk_create(new_lines, batch_size=500)
+        if changed_lines:
+            POLine.objects.bulk_update(changed_lines.values(), ["qty_ordered"], batch_size=500)
+        
         print(f"✅ Criadas {lines_created} linhas na PO {po_number}")
         pos_criadas.append(po)
         
@@ -2751,15 +3439,19 @@ def create_po_from_nota_encomenda(inbound: InboundDocument, payload: dict):
     return primeira_po if primeira_po else None
 
 
-@transaction.atomic
-def process_inbound(inbound: InboundDocument):
+def extract_inbound_payload(inbound: InboundDocument) -> dict:
+    """OCR + pós-processamento Ollama do ficheiro do documento (sem acesso à BD)."""
     # Estratégia híbrida: OCR rápido + Ollama pós-processamento
     # 1. Primeiro: OCR rápido para obter texto (sempre disponível)
     ocr_payload = real_ocr_extract(inbound.file.path)
-    ocr_text = ocr_payload.get('texto_completo', '')
-    
     # 2. Depois: Tentar Ollama com texto OCR como contexto (melhora precisão)
-    ollama_data = ollama_extract_document(inbound.file.path, ocr_text=ocr_text)
+    return llm_inbound_payload(inbound.file.path, ocr_payload)
+
+
+def llm_inbound_payload(file_path: str, ocr_payload: dict) -> dict:
+    """Pós-processamento LLM do resultado do OCR; sem dados do LLM devolve o payload do OCR."""
+    ocr_text = ocr_payload.get('texto_completo', '')
+    ollama_data = ollama_extract_document(file_path, ocr_text=ocr_text)
     
     if ollama_data and ollama_data.get('produtos'):
         # Ollama extraiu dados com sucesso - usar dados LLM
@@ -2794,6 +3486,100 @@ def process_inbound(inbound: InboundDocument):
         print("🔄 Ollama não disponível/falhou - usando dados OCR cascade")
         payload = ocr_payload
 
+    return payload
+
+
+def process_inbound(inbound: InboundDocument):
+    """
+    Processa um documento recebido: extração (OCR/LLM, segundos de CPU e rede) fora de
+    qualquer transação; só a escrita na BD (_finalize_inbound) corre em transaction.atomic.
+    """
+    payload = extract_inbound_payload(inbound)
+    return _finalize_inbound(inbound, payload)
+
+
+# Processamento em background dos uploads (o pedido HTTP não espera pelo OCR).
+# Duas filas independentes: "inbound" faz o OCR (CPU local) e passa o resultado à
+# fila "llm" (espera de rede pelo Groq/Ollama + escrita na BD), para que um
+# documento à espera do LLM não ocupe um worker de OCR.
+# As filas vivem só em memória: documentos ainda na fila quando o processo reinicia
+# ficam sem MatchResult ("Pendente"); `python manage.py reprocess_pending` volta a
+# processá-los.
+_inbound_executor = None
+_llm_executor = None
+_inbound_executors_lock = threading.Lock()
+
+
+def _get_inbound_executors():
+    global _inbound_executor, _llm_executor
+    with _inbound_executors_lock:
+        if _inbound_executor is None:
+            _inbound_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("INBOUND_WORKERS", "2")),
+                thread_name_prefix="inbound")
+            _llm_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("LLM_WORKERS", "4")),
+                thread_name_prefix="llm")
+        return _inbound_executor, _llm_executor
+
+
+def _record_inbound_failure(inbound_id: int, error: Exception):
+    """
+    Regista a falha de um job em background como no fim de _finalize_inbound (exceção
+    de OCR + MatchResult "error"), para o documento não ficar "Pendente" para sempre.
+    """
+    logger.exception("❌ Erro ao processar documento %s em background: %s", inbound_id, error)
+    try:
+        with transaction.atomic():
+            ExceptionTask.objects.create(
+                inbound_id=inbound_id,
+                line_ref="OCR",
+                issue=f"Falha no processamento do documento: {error}"[:255])
+            MatchResult.objects.update_or_create(
+                inbound_id=inbound_id,
+                defaults={"status": "error", "summary": {"error": str(error)}})
+    except Exception:
+        logger.exception("❌ Não foi possível registar a falha do documento %s", inbound_id)
+
+
+def _process_inbound_job(inbound_id: int):
+    try:
+        inbound = InboundDocument.objects.get(id=inbound_id)
+        ocr_payload = real_ocr_extract(inbound.file.path)
+        _llm_executor.submit(_finalize_inbound_job, inbound_id, ocr_payload)
+    except Exception as e:
+        _record_inbound_failure(inbound_id, e)
+    finally:
+        # Thread fora do ciclo de pedidos do Django: fechar a ligação à BD desta thread
+        close_old_connections()
+
+
+def _finalize_inbound_job(inbound_id: int, ocr_payload: dict):
+    try:
+        inbound = InboundDocument.objects.get(id=inbound_id)
+        payload = llm_inbound_payload(inbound.file.path, ocr_payload)
+        _finalize_inbound(inbound, payload)
+    except Exception as e:
+        _record_inbound_failure(inbound_id, e)
+    finally:
+        close_old_connections()
+
+
+def process_inbound_async(inbound: InboundDocument):
+    """Agenda process_inbound nas filas de background, depois do commit do documento."""
+    inbound_executor, _ = _get_inbound_executors()
+    inbound_id = inbound.id
+    transaction.on_commit(lambda: inbound_executor.submit(_process_inbound_job, inbound_id))
+
+
+# Tipos emitidos por detect_document_type que trazem linhas de produto;
+# o tipo_documento devolvido pelo LLM é texto livre → fallback por regex
+_DOCS_WITH_PRODUCTS = frozenset({"FATURA_ELASTRON", "FATURA_GENERICA", "GUIA_COLMOL", "GUIA_GENERICA"})
+_RE_DOCS_WITH_PRODUCTS = re.compile(r"FATURA|GUIA")
+
+
+@transaction.atomic
+def _finalize_inbound(inbound: InboundDocument, payload: dict):
     if payload.get("error"):
         ExceptionTask.objects.create(
             inbound=inbound,
@@ -2819,7 +3605,8 @@ def process_inbound(inbound: InboundDocument):
     # - Texto muito curto (<100 chars)
     # - Documento é guia/fatura mas 0 produtos extraídos
     doc_type = payload.get("tipo_documento", "")
-    is_document_with_products = any(x in doc_type for x in ["FATURA", "GUIA"])
+    is_document_with_products = (doc_type in _DOCS_WITH_PRODUCTS
+                                 or _RE_DOCS_WITH_PRODUCTS.search(doc_type) is not None)
     
     if len(texto_extraido) < 100:
         ExceptionTask.objects.create(
@@ -2875,8 +3662,9 @@ def process_inbound(inbound: InboundDocument):
     # criar linhas de receção
     inbound.lines.all().delete()
     mapped_lines = map_supplier_codes(inbound.supplier, payload)
-    for ml in mapped_lines:
-        ReceiptLine.objects.create(
+    # Um INSERT multi-linha em vez de um por linha
+    ReceiptLine.objects.bulk_create([
+        ReceiptLine(
             inbound=inbound,
             supplier_code=ml["supplier_code"],
             article_code=ml.get("article_code", ""),
@@ -2886,6 +3674,8 @@ def process_inbound(inbound: InboundDocument):
             qty_received=ml.get("qty", 0),
             po_number_extracted=ml.get("po_number_extracted", ""),  # Armazenar numero_encomenda
         )
+        for ml in mapped_lines
+    ], batch_size=500)
 
     # ===== VINCULAÇÃO DE PO (ANTES DE QUALQUER EXCEÇÃO/MATCHING) =====
     # NOTA: Se doc_type == 'FT', já criou e vinculou PO acima, não desvincular!
@@ -2908,15 +3698,25 @@ def process_inbound(inbound: InboundDocument):
         doc_items = payload.get("produtos", payload.get("lines", []))
         ok = len(doc_items)
     elif inbound.doc_type == 'GR':
-        from .models import POLine
+        # Só as colunas usadas no matching; lista (e não .iterator()) porque os códigos
+        # de todas as linhas são precisos antes do loop para a query única de CodeMappings
+        receipt_lines = list(inbound.lines.only(
+            "inbound", "article_code", "qty_received", "po_number_extracted"))
+        mappings = _code_mappings_for(inbound.supplier, [r.article_code for r in receipt_lines])
+        # POs específicas das linhas e POLines das POs candidatas lidas uma vez: o matching
+        # passa a ser por dicionário em vez de 2 queries por linha
+        pos_by_number = _purchase_orders_by_number(
+            r.po_number_extracted for r in receipt_lines if r.po_number_extracted)
+        po_lines = _po_line_index([inbound.po, *pos_by_number.values()])
+        updated_po_lines = {}
         
-        for r in inbound.lines.all():
+        for r in receipt_lines:
             # Buscar PO correta usando po_number_extracted da linha (se múltiplas POs)
             target_po = inbound.po  # PO padrão vinculada ao documento
             
             if r.po_number_extracted:
                 # Tentar encontrar PO específica para este produto
-                specific_po = PurchaseOrder.objects.filter(number=r.po_number_extracted).first()
+                specific_po = pos_by_number.get(r.po_number_extracted)
                 if specific_po:
                     target_po = specific_po
                     print(f"🔍 Produto {r.article_code} → PO específica {specific_po.number}")
@@ -2932,10 +3732,7 @@ def process_inbound(inbound: InboundDocument):
                 })
                 continue
             
-            mapping = CodeMapping.objects.filter(
-                supplier=inbound.supplier,
-                supplier_code=r.article_code
-            ).first()
+            mapping = mappings.get(r.article_code)
             
             if not mapping:
                 qty_ordered = float(r.qty_received) if r.qty_received else 0.0
@@ -2946,10 +3743,11 @@ def process_inbound(inbound: InboundDocument):
                     qty_ordered=qty_ordered,
                     confidence=0.5
                 )
+                mappings[r.article_code] = mapping
                 print(f"🆕 CodeMapping criado automaticamente: {r.article_code} → {r.article_code} (qty: {qty_ordered})")
             
             internal_sku = mapping.internal_sku
-            po_line = POLine.objects.filter(po=target_po, internal_sku=internal_sku).first()
+            po_line = po_lines.get((target_po.id, internal_sku))
             
             if not po_line:
                 issues += 1
@@ -2973,10 +3771,13 @@ def process_inbound(inbound: InboundDocument):
                 continue
             
             po_line.qty_received = qty_total_received
-            po_line.save()
+            updated_po_lines[po_line.pk] = po_line
             print(f"✅ {internal_sku} (PO {target_po.number}): recebida {qty_new}, total {qty_total_received}/{qty_ordered}")
             
             ok += 1
+        
+        if updated_po_lines:
+            POLine.objects.bulk_update(updated_po_lines.values(), ["qty_received"], batch_size=500)
 
     res, _ = MatchResult.objects.get_or_create(inbound=inbound)
 
@@ -2986,10 +3787,13 @@ def process_inbound(inbound: InboundDocument):
     lines_read_successfully = ok
     first_error_line = None
     if exceptions:
+        # Linhas com exceção num só texto (uma por linha): "código contido na linha de alguma
+        # exceção" passa a ser uma pesquisa em C por item em vez de um loop pelas exceções
+        error_lines = "\n".join(ex.get("line", "") for ex in exceptions)
         for idx, item in enumerate(doc_items, 1):
             # Tenta ambos os campos (artigo para produtos, supplier_code para lines)
             item_code = item.get("artigo") or item.get("supplier_code") or ""
-            if item_code and any(item_code in ex.get("line", "") for ex in exceptions):
+            if item_code and "\n" not in item_code and item_code in error_lines:
                 first_error_line = idx
                 break
 
@@ -3000,10 +3804,10 @@ def process_inbound(inbound: InboundDocument):
     inbound.exceptions.exclude(line_ref="OCR").delete()
     
     # Criar novas exceções de matching
-    for ex in exceptions:
-        ExceptionTask.objects.create(inbound=inbound,
-                                     line_ref=ex["line"],
-                                     issue=ex["issue"])
+    ExceptionTask.objects.bulk_create([
+        ExceptionTask(inbound=inbound, line_ref=ex["line"], issue=ex["issue"])
+        for ex in exceptions
+    ], batch_size=500)
     
     # Definir status baseado no tipo de problema:
     # - error: falha no OCR/parsing (ficheiro ilegível, OCR falhou, etc.)
@@ -3022,8 +3826,12 @@ def process_inbound(inbound: InboundDocument):
         "first_error_line": first_error_line,
         "last_successful_line": (lines_read_successfully or None),
     }
-    res.certified_id = hashlib.sha256(
-        (str(inbound.id) + str(payload)).encode()).hexdigest()[:16]
+    # Hash do payload serializado de forma canónica (chaves ordenadas, compacto) em vez
+    # do repr(): não depende da ordem das chaves nem cria a string repr do texto OCR inteiro
+    certified_hash = hashlib.sha256(str(inbound.id).encode())
+    certified_hash.update(json.dumps(payload, sort_keys=True, separators=(",", ":"),
+                                     ensure_ascii=False, default=str).encode())
+    res.certified_id = certified_hash.hexdigest()[:16]
     res.save()
 
     return res
@@ -3054,76 +3862,119 @@ def extract_dimensions_from_text(text: str) -> str:
     return ""
 
 
-def export_document_to_excel(inbound_id: int) -> HttpResponse:
-    """Exporta para Excel no formato pedido (Mini Código, Dimensões, Quantidade)."""
-    from .models import MiniCodigo
-    
-    inbound = InboundDocument.objects.get(id=inbound_id)
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Requisição Processada"
+def _write_xlsx(fileobj, title: str, headers: list, rows: list, widths: list):
+    """
+    Escreve uma folha (cabeçalho laranja + linhas) em fileobj.
+    xlsxwriter (constant_memory, serialização mais rápida) se instalado; senão openpyxl
+    em write_only (linhas serializadas direto para o XML, sem grelha de células em memória).
+    """
+    if XLSXWRITER_AVAILABLE:
+        import xlsxwriter
+        wb = xlsxwriter.Workbook(fileobj, {"constant_memory": True})
+        ws = wb.add_worksheet(title)
+        header_format = wb.add_format({"bold": True, "font_color": "#FFFFFF",
+                                       "bg_color": "#FF6B35", "pattern": 1, "align": "center"})
+        for col, width in enumerate(widths):
+            ws.set_column(col, col, width)
+        ws.write_row(0, 0, headers, header_format)
+        for row, values in enumerate(rows, 1):
+            ws.write_row(row, 0, values)
+        wb.close()
+        return
+
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment, PatternFill
+    from openpyxl.utils import get_column_letter
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    # Em write_only as larguras têm de ser definidas antes de escrever as linhas
+    for col, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
 
-    headers = [
-        "Mini Código", "Dimensões (LxCxE)", "Quantidade"
-    ]
     header_font = Font(bold=True, color="FFFFFF")
     header_fill = PatternFill(start_color="FF6B35",
                               end_color="FF6B35",
                               fill_type="solid")
-
-    for col, h in enumerate(headers, 1):
-        c = ws.cell(row=1, column=col, value=h)
+    header_cells = []
+    for h in headers:
+        c = WriteOnlyCell(ws, value=h)
         c.font = header_font
         c.fill = header_fill
         c.alignment = Alignment(horizontal="center")
+        header_cells.append(c)
+    ws.append(header_cells)
+    for values in rows:
+        ws.append(values)
+    wb.save(fileobj)
+
+
+def export_document_to_excel(inbound_id: int) -> FileResponse:
+    """Exporta para Excel no formato pedido (Mini Código, Dimensões, Quantidade)."""
+    from .models import MiniCodigo
+    
+    # Linhas chegam já com o documento (prefetch) e só com as colunas usadas no export
+    inbound = InboundDocument.objects.prefetch_related(
+        Prefetch('lines', queryset=ReceiptLine.objects.only(
+            'inbound', 'article_code', 'supplier_code', 'qty_received',
+            'description', 'maybe_internal_sku', 'unit'))
+    ).get(id=inbound_id)
+
+    headers = [
+        "Mini Código", "Dimensões (LxCxE)", "Quantidade"
+    ]
+    rows = []
+
+    # Índice do payload criado uma vez (1ª ocorrência de cada código, como a pesquisa linear):
+    # Guia de Remessa (novo) → 'produtos' por artigo; formato antigo → 'lines' por supplier_code
+    parsed = inbound.parsed_payload
+    if parsed.get("produtos"):
+        payload_items, item_key, line_attr, desc_key = parsed["produtos"], "artigo", "article_code", "descricao"
+    else:
+        payload_items, item_key, line_attr, desc_key = parsed.get("lines", []), "supplier_code", "supplier_code", "description"
+    # O código vem do LLM/parsers sem tipo garantido: números passam a texto (como os campos
+    # das linhas) e valores não escalares (listas, dicts, None) ficam fora do índice
+    payload_by_code = {}
+    for item in payload_items:
+        code = item.get(item_key)
+        if isinstance(code, (str, int)) and not isinstance(code, bool):
+            payload_by_code.setdefault(str(code), item)
+
+    # Mini códigos de todas as linhas numa só query (1º por ordenação do modelo, como .first())
+    receipt_lines = inbound.lines.all()
+    identificadores = {code for linha in receipt_lines
+                       for code in (linha.article_code, linha.supplier_code) if code}
+    mini_by_identificador = {}
+    if identificadores:
+        try:
+            for mini_obj in MiniCodigo.objects.filter(identificador__in=identificadores).only(
+                    'identificador', 'mini_codigo', 'designacao'):
+                mini_by_identificador.setdefault(mini_obj.identificador, mini_obj)
+        except Exception as e:
+            print(f"⚠️ Erro ao mapear mini códigos: {e}")
 
-    for row, linha in enumerate(inbound.lines.all(), 2):
+    for linha in receipt_lines:
         dimensoes = ""
         mini_codigo_from_payload = ""
         descricao = ""
         article_code_from_doc = linha.article_code
 
-        # Formato Guia de Remessa (novo): procura em 'produtos' usando article_code
-        if inbound.parsed_payload.get("produtos"):
-            for produto in inbound.parsed_payload.get("produtos", []):
-                # Match usando article_code (código do produto único)
-                if produto.get("artigo") == linha.article_code:
-                    dims = produto.get("dimensoes", "")
-                    # dimensoes pode ser string (Tesseract) ou dicionário (formato antigo)
-                    if isinstance(dims, str):
-                        dimensoes = dims
-                    elif isinstance(dims, dict) and any(dims.values()):
-                        larg = dims.get("largura", 0)
-                        comp = dims.get("comprimento", 0)
-                        esp = dims.get("espessura", 0)
-                        if larg and comp and esp:
-                            dimensoes = f"{larg}x{comp}x{esp}"
-                        elif larg and comp:
-                            dimensoes = f"{larg}x{comp}"
-                    mini_codigo_from_payload = produto.get("mini_codigo", "")
-                    descricao = produto.get("descricao", "")
-                    break
-        
-        # Formato antigo: procura em 'lines' usando supplier_code
-        else:
-            for payload_line in inbound.parsed_payload.get("lines", []):
-                if payload_line.get("supplier_code") == linha.supplier_code:
-                    dims = payload_line.get("dimensoes", "")
-                    # dimensoes pode ser string (Tesseract) ou dicionário (formato antigo)
-                    if isinstance(dims, str):
-                        dimensoes = dims
-                    elif isinstance(dims, dict) and any(dims.values()):
-                        larg = dims.get("largura", 0)
-                        comp = dims.get("comprimento", 0)
-                        esp = dims.get("espessura", 0)
-                        if larg and comp and esp:
-                            dimensoes = f"{larg}x{comp}x{esp}"
-                        elif larg and comp:
-                            dimensoes = f"{larg}x{comp}"
-                    mini_codigo_from_payload = payload_line.get("mini_codigo", "")
-                    descricao = payload_line.get("description", "")
-                    break
+        payload_item = payload_by_code.get(getattr(linha, line_attr))
+        if payload_item is not None:
+            dims = payload_item.get("dimensoes", "")
+            # dimensoes pode ser string (Tesseract) ou dicionário (formato antigo)
+            if isinstance(dims, str):
+                dimensoes = dims
+            elif isinstance(dims, dict) and any(dims.values()):
+                larg = dims.get("largura", 0)
+                comp = dims.get("comprimento", 0)
+                esp = dims.get("espessura", 0)
+                if larg and comp and esp:
+                    dimensoes = f"{larg}x{comp}x{esp}"
+                elif larg and comp:
+                    dimensoes = f"{larg}x{comp}"
+            mini_codigo_from_payload = payload_item.get("mini_codigo", "")
+            descricao = payload_item.get(desc_key, "")
 
         # Fallback: se não houver dimensões, tenta extrair da descrição
         if not dimensoes:
@@ -3131,28 +3982,15 @@ def export_document_to_excel(inbound_id: int) -> HttpResponse:
         
         # 🎯 PRIORIDADE 1: MAPEAR MINI CÓDIGO DA BASE DE DADOS
         # Tenta mapear usando article_code → identificador na BD
-        mini_codigo_from_db = None
-        if article_code_from_doc:
-            try:
-                mini_obj = MiniCodigo.objects.filter(identificador=article_code_from_doc).first()
-                if mini_obj:
-                    mini_codigo_from_db = mini_obj.mini_codigo
-                    # Se não temos designação do documento, usa da BD
-                    if not descricao:
-                        descricao = mini_obj.designacao
-            except Exception as e:
-                print(f"⚠️ Erro ao mapear mini código por article_code: {e}")
-        
         # Fallback: tenta mapear usando supplier_code se article_code não funcionou
-        if not mini_codigo_from_db and linha.supplier_code:
-            try:
-                mini_obj = MiniCodigo.objects.filter(identificador=linha.supplier_code).first()
-                if mini_obj:
-                    mini_codigo_from_db = mini_obj.mini_codigo
-                    if not descricao:
-                        descricao = mini_obj.designacao
-            except Exception as e:
-                print(f"⚠️ Erro ao mapear mini código por supplier_code: {e}")
+        mini_codigo_from_db = None
+        mini_obj = (mini_by_identificador.get(article_code_from_doc)
+                    or mini_by_identificador.get(linha.supplier_code))
+        if mini_obj:
+            mini_codigo_from_db = mini_obj.mini_codigo
+            # Se não temos designação do documento, usa da BD
+            if not descricao:
+                descricao = mini_obj.designacao
         
         # Hierarquia de fallback: BD → payload → maybe_internal_sku → article_code
         final_mini_codigo = (
@@ -3162,25 +4000,24 @@ def export_document_to_excel(inbound_id: int) -> HttpResponse:
             article_code_from_doc
         )
 
-        ws.cell(row=row, column=1, value=final_mini_codigo)
-        ws.cell(row=row, column=2, value=dimensoes)
-        ws.cell(row=row, column=3, value=float(linha.qty_received))
+        rows.append((final_mini_codigo, dimensoes, float(linha.qty_received)))
 
     # auto width
-    for column in ws.columns:
-        max_len = 0
-        letter = column[0].column_letter
-        for cell in column:
-            try:
-                max_len = max(max_len, len(str(cell.value)))
-            except Exception:
-                pass
-        ws.column_dimensions[letter].width = min(max_len + 2, 50)
-
-    response = HttpResponse(
+    max_lens = [len(h) for h in headers]
+    for values in rows:
+        for i, value in enumerate(values):
+            max_lens[i] = max(max_lens[i], len(str(value)))
+    widths = [min(max_len + 2, 50) for max_len in max_lens]
+
+    # Grava num ficheiro temporário e envia em blocos (FileResponse) em vez de
+    # acumular o XLSX inteiro em memória dentro do HttpResponse.
+    # O TemporaryFile é apagado quando o FileResponse o fecha no fim do envio.
+    tmp = tempfile.TemporaryFile(suffix=".xlsx")
+    _write_xlsx(tmp, "Requisição Processada", headers, rows, widths)
+    tmp.seek(0)
+    return FileResponse(
+        tmp,
+        as_attachment=True,
+        filename=f"requisicao_{inbound.id}.xlsx",
         content_type=
         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-    response[
-        "Content-Disposition"] = f'attachment; filename="requisicao_{inbound.id}.xlsx"'
-    wb.save(response)
-    return response
@@ -0,0 +1,224 @@
+import datetime
+import json
+import threading
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import SimpleTestCase
+
+from .models import OrjsonEncoder
+from .parsers_pt import parse_fatura_elastron, parse_guia_colmol
+from .services import (_DOC_TYPE_RE, detect_document_type, parse_guia_generica, parse_ordem_compra,
+                       parse_pedido_espanhol, parse_qrcode_fiscal_pt)
+
+
+class PedidoEspanholTests(SimpleTestCase):
+    def _parse(self, text, timeout=5):
+        # O parser corre numa thread para que uma regressão do ciclo infinito falhe o teste
+        # em vez de o bloquear
+        result = {}
+        worker = threading.Thread(
+            target=lambda: result.update(produtos=parse_pedido_espanhol(text)), daemon=True)
+        worker.start()
+        worker.join(timeout)
+        self.assertFalse(worker.is_alive(), "parse_pedido_espanhol não terminou (ciclo infinito)")
+        return result["produtos"]
+
+    def test_formato1_avanca_para_a_linha_seguinte(self):
+        text = "\n".join([
+            "Código Descripción Unidades Precio Importe",
+            "COPR1520 COLCHON PRAGA DE 150X200 CM 5,00 175,00 875,00",
+            "COPR1320 COLCHON PRAGA DE 135X190 CM 2,00 150,00 300,00",
+            "Total 1175,00",
+        ])
+        produtos = self._parse(text)
+        self.assertEqual([p["artigo"] for p in produtos], ["COPR1520", "COPR1320"])
+        self.assertEqual(produtos[0]["quantidade"], 5.0)
+        self.assertEqual(produtos[0]["dimensoes"], "150x200")
+
+    def test_formato1b_codigo_depois_da_descricao(self):
+        text = "\n".join([
+            "Pedido 123",
+            "COLCHON PRAGA DE 150X200 CM*NUEVO* COPR1520 875,00 175,00 5,00",
+            "Total",
+        ])
+        self.assertEqual(self._parse(text), [{
+            "artigo": "COPR1520",
+            "descricao": "COLCHON PRAGA DE 150X200 CM*NUEVO*",
+            "quantidade": 5.0,
+            "unidade": "UN",
+            "preco_unitario": 175.0,
+            "total": 875.0,
+            "dimensoes": "150x200",
+            "pedido_numero": "123",
+            "fecha": "",
+            "proveedor": "",
+            "referencia_ordem": "",
+            "lote_producao": "",
+            "volume": 0,
+            "peso": 0.0,
+            "iva": 21.0,
+        }])
+
+    def test_formato1_na_ultima_linha(self):
+        produtos = self._parse("COPR1520 COLCHON PRAGA DE 150X200 CM 5,00 175,00 875,00")
+        self.assertEqual(len(produtos), 1)
+        self.assertEqual(produtos[0]["total"], 875.0)
+
+    def test_formato1_linhas_repetidas_dao_um_produto_cada(self):
+        linha = "COPR1520 COLCHON PRAGA DE 150X200 CM 5,00 175,00 875,00"
+        produtos = self._parse("\n".join([linha, linha]))
+        self.assertEqual([p["artigo"] for p in produtos], ["COPR1520", "COPR1520"])
+
+
+class DetectDocumentTypeTests(SimpleTestCase):
+    def test_palavra_longa_ganha_ao_prefixo_no_mesmo_ponto(self):
+        for texto, esperado in [("Guia de Remessa", "guia de remessa"),
+                                ("Ordem de Compra", "ordem de compra"),
+                                ("Bon de Commande", "bon de commande")]:
+            with self.subTest(texto=texto):
+                self.assertEqual(_DOC_TYPE_RE.match(texto).group(1).lower(), esperado)
+
+    def test_classificacao(self):
+        casos = {
+            "GUIA DE REMESSA N.º 12": "GUIA_GENERICA",
+            "Guia Remessa 12": "GUIA_GENERICA",
+            "Guia 12": "DOCUMENTO_GENERICO",
+            "COLMOL\nGuia de Remessa": "GUIA_COLMOL",
+            "Ordem de Compra 123": "ORDEM_COMPRA",
+            "ORDEM COMPRA 55": "ORDEM_COMPRA",
+            "BON DE COMMANDE N 3": "BON_COMMANDE",
+            "Commande\nDésignation": "BON_COMMANDE",
+            "Commande 3": "DOCUMENTO_GENERICO",
+            "Pedido\nArtículo Cantidad": "PEDIDO_ESPANHOL",
+            "Pedido España": "PEDIDO_ESPANHOL",
+            "Fatura Elastron": "FATURA_ELASTRON",
+            "Fatura 12": "FATURA_GENERICA",
+            "Recibo": "RECIBO",
+        }
+        for texto, esperado in casos.items():
+            with self.subTest(texto=texto):
+                self.assertEqual(detect_document_type(texto), esperado)
+
+
+class OrjsonEncoderTests(SimpleTestCase):
+    def test_mesmo_json_que_o_django_encoder(self):
+        payload = {
+            "data_documento": datetime.date(2025, 10, 17),
+            "criado": datetime.datetime(2025, 10, 17, 9, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+            "hora": datetime.time(9, 30, 15, 123456),
+            "total": Decimal("875.00"),
+            "produtos": [{"artigo": "COPR1520", "quantidade": 5.0}],
+            1: "chave numérica",
+        }
+        self.assertEqual(json.loads(OrjsonEncoder().encode(payload)),
+                         json.loads(DjangoJSONEncoder().encode(payload)))
+
+
+class ParserGuiaGenericaTests(SimpleTestCase):
+    def test_quantidade_antes_da_unidade_e_numero_do_pedido(self):
+        text = "\n".join([
+            "GUIA DE REMESSA",
+            "PEDIDO: 4500123",
+            "CBAGD00067 CX EUROSPUMA 3044 VE 125,000 UN 1,880 0,150 0,080 84,600 KG",
+            "Obrigado pela preferência",
+        ])
+        self.assertEqual(parse_guia_generica(text), [{
+            "artigo": "CBAGD00067",
+            "descricao": "CX EUROSPUMA 3044 VE",
+            "quantidade": 125000.0,
+            "unidade": "UN",
+            "dimensoes": "",
+            "referencia_ordem": "4500123",
+            "lote_producao": "",
+            "volume": 0,
+            "peso": 0.0,
+            "iva": 23.0,
+            "total": 0.0,
+        }])
+
+
+class ParserOrdemCompraTests(SimpleTestCase):
+    def test_referencias_emparelhadas_com_quantidades(self):
+        text = "\n".join([
+            "ORDEM COMPRA Nº 55",
+            '26.100145 COLCHAO 1,95X1,40=27"SPA CHERRY VISCO"COLMOL',
+            "1.000 UN 2025-10-17",
+            "26.100146 ALMOFADA VISCO",
+            "3,5 KG",
+            "Total",
+        ])
+        produtos = parse_ordem_compra(text)
+        self.assertEqual(
+            [(p["artigo"], p["quantidade"], p["unidade"], p["data_entrega"], p["dimensoes"])
+             for p in produtos],
+            [("26.100145", 1000.0, "UN", "2025-10-17", "1.95x1.40"),
+             ("26.100146", 3.5, "KG", "", "")])
+        self.assertEqual(produtos[0]["descricao"], 'COLCHAO 1,95X1,40=27"SPA CHERRY VISCO"COLMOL')
+
+
+class ParserFaturaElastronTests(SimpleTestCase):
+    def test_linha_de_artigo_com_referencia_e_lote(self):
+        text = "\n".join([
+            "FATURA ELASTRON",
+            "1ORDE Nº 4500123",
+            "E0123456789 450,00 1 100,00 0,00 ML 4,50 23 2025-123# TECIDO MALHA BRANCO",
+            "Total 450,00",
+        ])
+        self.assertEqual(parse_fatura_elastron(text), [{
+            "referencia_ordem": "1ORDE Nº 4500123",
+            "artigo": "E0123456789",
+            "descricao": "TECIDO MALHA BRANCO",
+            "lote_producao": "2025-123#",
+            "quantidade": 100.0,
+            "unidade": "ML",
+            "volume": 1,
+            "preco_unitario": 4.5,
+            "desconto": 0.0,
+            "iva": 23.0,
+            "total": 450.0,
+        }])
+
+
+class ParserGuiaColmolTests(SimpleTestCase):
+    def test_linha_de_produto_com_cabecalho_da_encomenda(self):
+        text = "\n".join([
+            "ENCOMENDA Nº 1-234 REQUISICAO Nº 567",
+            "LUSTOPVS135190 COLCHAO TOP VISCO CX.135 2,000 UN 1,350 1,900 0,300 12,500 23",
+            "TOTAL",
+        ])
+        self.assertEqual(parse_guia_colmol(text), [{
+            "referencia_ordem": "1-234 / Req 567",
+            "artigo": "LUSTOPVS135190",
+            "descricao": "COLCHAO TOP VISCO CX.135",
+            "lote_producao": "",
+            "quantidade": 2000.0,
+            "unidade": "UN",
+            "volume": 0,
+            "dimensoes": "1350.0x1900.0x300.0",
+            "peso": 12500.0,
+            "iva": 23.0,
+            "total": 0.0,
+        }])
+
+
+class QrFiscalTests(SimpleTestCase):
+    def test_campos_com_nomes_descritivos(self):
+        qr = ("A:123456789*B:999999990*C:PT*D:FT*E:N*F:20250101*G:FT A/1*H:ABCD-1*I1:PT"
+              "*I7:100.00*I8:23.00*N:23.00*O:123.00*Q:abcd*R:1234")
+        dados = parse_qrcode_fiscal_pt(qr)
+        self.assertEqual(dados["nif_emitente"], "123456789")
+        self.assertEqual(dados["nif_adquirente"], "999999990")
+        self.assertEqual(dados["identificacao_documento"], "FT A/1")
+        self.assertEqual(dados["base_tributavel_taxa_normal"], "100.00")
+        self.assertEqual(dados["total_documento"], "123.00")
+        self.assertEqual(len(dados), 15)
+
+    def test_sem_nif_emitente_nao_e_fiscal(self):
+        self.assertIsNone(parse_qrcode_fiscal_pt("B:999999990*C:PT"))
+        self.assertIsNone(parse_qrcode_fiscal_pt("https://exemplo.pt"))
+
+    def test_resultado_alteravel_nao_afeta_a_cache(self):
+        qr = "A:123456789*B:999999990"
+        parse_qrcode_fiscal_pt(qr)["nif_emitente"] = "x"
+        self.assertEqual(parse_qrcode_fiscal_pt(qr)["nif_emitente"], "123456789")
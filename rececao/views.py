@@ -3,7 +3,7 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.db.models import Count
 from .models import InboundDocument, Supplier, PurchaseOrder
 from .forms import InboundUploadForm
-from .services import process_inbound, export_document_to_excel
+from .services import process_inbound_async, export_document_to_excel
 
 def dashboard(request):
     # Dashboard mostra TODOS os documentos (FT e GR) mas KPIs focam em GR
@@ -112,7 +112,8 @@ def upload_inbound(request):
         form = InboundUploadForm(request.POST, request.FILES)
         if form.is_valid():
             inbound = form.save()
-            process_inbound(inbound)
+            # OCR em background: o detalhe mostra "Pendente" até haver MatchResult
+            process_inbound_async(inbound)
             return redirect('inbound_detail', pk=inbound.pk)
     else:
         form = InboundUploadForm()